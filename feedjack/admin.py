@@ -31,7 +31,7 @@ class FeedAdmin(admin.ModelAdmin):
       (_('Fields updated automatically by Feedjack'),
         {'classes':('collapse',),
          'fields':('title', 'tagline', 'link', 'etag', 'last_modified',
-                   'last_checked'),
+                   'last_checked', 'lease_owner', 'lease_expires'),
         })
     )
     search_fields = ['feed_url', 'name', 'title']
@@ -51,10 +51,18 @@ class SubscriberAdmin(admin.ModelAdmin):
     list_filter = ('site',)
 
 
+class FeedStatsAdmin(admin.ModelAdmin):
+    list_display = ('feed', 'avg_duration', 'avg_bytes', 'consecutive_errors',
+                    'last_result', 'last_fetched')
+    list_filter = ('last_result',)
+    ordering = ('-avg_duration',)
+
+
 admin.site.register(models.Link, LinkAdmin)
 admin.site.register(models.Site, SiteAdmin)
 admin.site.register(models.Feed, FeedAdmin)
 admin.site.register(models.Post, PostAdmin)
 admin.site.register(models.Subscriber, SubscriberAdmin)
+admin.site.register(models.FeedStats, FeedStatsAdmin)
 
 #~
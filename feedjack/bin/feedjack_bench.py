@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+feedjack_bench.py
+"""
+
+import os
+import sys
+import time
+import optparse
+import tempfile
+import platform
+import itertools
+
+# cases of the benchmark: (name, path or None for the functions)
+CASES = (
+  ('front', '/'),
+  ('deep page', '/?page=50'),
+  ('tag', '/tag/%(tag)s/'),
+  ('user', '/user/%(user)d/'),
+  ('rss', '/feed/rss/'),
+  ('atom', '/feed/atom/'),
+  ('opml', '/opml/'),
+  ('foaf', '/foaf/'),
+  ('fjcloud.cloudata', None),
+)
+
+# numbers of the cache key prefixes of the cold runs
+PREFIXES = itertools.count()
+
+
+def setup(dbname):
+    """ Configures django to use a SQLite database and the feedjack urls.
+    """
+    from django.conf import settings
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        DATABASE_NAME=dbname,
+        INSTALLED_APPS=('feedjack',),
+        ROOT_URLCONF='feedjack.urls',
+        CACHE_BACKEND='locmem:///?max_entries=100000',
+        CACHE_MIDDLEWARE_KEY_PREFIX='bench',
+        MIDDLEWARE_CLASSES=(),
+        MEDIA_URL='',
+    )
+    from django.core.management import call_command
+    call_command('syncdb', verbosity=0, interactive=False)
+
+def median(values):
+    """ Returns the median of a list of numbers.
+    """
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def measure(func, repeat, cold):
+    """ Calls a function repeat times and returns its timings and counters.
+
+    With a cold cache every call uses a new cache key prefix, so nothing is
+    found in the cache. With a warm one the function is called once before
+    the measured calls.
+    """
+    from django.conf import settings
+    from feedjack import fjstats
+
+    if not cold:
+        func()
+    times, queries = [], []
+    for num in range(repeat):
+        if cold:
+            settings.CACHE_MIDDLEWARE_KEY_PREFIX = 'bench%d' % \
+              PREFIXES.next()
+        fjstats.begin()
+        try:
+            status = func()
+        finally:
+            stats = fjstats.end()
+        times.append(stats['time'] * 1000)
+        queries.append(stats['queries'])
+    return {
+      'status': status,
+      'min_ms': round(min(times), 3),
+      'median_ms': round(median(times), 3),
+      'max_ms': round(max(times), 3),
+      'queries': max(queries),
+      'cache': stats['cache'],
+    }
+
+def run(site, repeat):
+    """ Runs the cases against a site and returns the results.
+    """
+    from django.test.client import Client
+    from feedjack import models, fjcloud
+
+    host = site.url.split('://', 1)[-1].rstrip('/')
+    client = Client(HTTP_HOST=host)
+    feed_id = models.Subscriber.objects.filter(site=site) \
+      .order_by('feed')[0].feed_id
+    params = {'tag': models.Tag.objects.order_by('id')[0].name,
+              'user': feed_id}
+
+    def view(path):
+        def get():
+            return client.get(path).status_code
+        return get
+
+    def cloudata():
+        fjcloud.cloudata(site)
+        return None
+
+    results = []
+    for name, path in CASES:
+        if path is None:
+            func = cloudata
+        else:
+            path = path % params
+            func = view(path)
+        for cold in (True, False):
+            result = measure(func, repeat, cold)
+            result['name'] = name
+            result['path'] = path
+            result['cache_state'] = cold and 'cold' or 'warm'
+            results.append(result)
+    return results
+
+def main():
+    """ Generates a SQLite database and measures the latency and the number
+    of queries of the feedjack views against it, with the cache cold and
+    warm. The report is written as JSON, to compare versions.
+    """
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--database',
+      help='SQLite database file to use. It will be created and filled if ' \
+           'it does not exist. A temporary one is used by default.')
+    parser.add_option('--sites', type='int', default=3,
+      help='Number of sites to generate.')
+    parser.add_option('--feeds', type='int', default=200,
+      help='Number of feeds to generate.')
+    parser.add_option('--posts', type='int', default=20000,
+      help='Number of posts to generate.')
+    parser.add_option('--tags', type='int', default=500,
+      help='Number of tags to generate.')
+    parser.add_option('--zipf', type='float', default=1.0,
+      help='Exponent of the Zipf distribution of the tags.')
+    parser.add_option('--seed', type='int', default=0,
+      help='Seed of the generated data.')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+      help='Number of measured calls of every case.')
+    parser.add_option('-o', '--output',
+      help='Write the JSON report to this file instead of the standard ' \
+           'output.')
+    options = parser.parse_args()[0]
+
+    if options.database:
+        dbname = options.database
+        generate = not os.path.exists(dbname)
+    else:
+        dbname = tempfile.mktemp(suffix='.db')
+        generate = True
+    setup(dbname)
+
+    import django
+    from django.db import connection
+    from feedjack import models, fjdataset, fjstats
+    if generate:
+        sys.stderr.write('* Generating %d sites, %d feeds, %d posts, %d ' \
+          'tags in %s\n' % (options.sites, options.feeds, options.posts,
+                            options.tags, dbname))
+        fjdataset.generate(sites=options.sites, feeds=options.feeds,
+          posts=options.posts, tags=options.tags, seed=options.seed,
+          zipf=options.zipf)
+        connection.cursor().execute('ANALYZE')
+    models.Site.objects.update(use_internal_cache=True)
+    site = models.Site.objects.order_by('id')[0]
+
+    fjstats.install()
+    results = run(site, options.repeat)
+
+    if not options.database:
+        os.unlink(dbname)
+
+    for result in results:
+        sys.stderr.write('%-18s %-4s %9.3f ms %4d queries\n' % (
+          result['name'], result['cache_state'], result['median_ms'],
+          result['queries']))
+
+    from django.utils import simplejson
+    report = simplejson.dumps({
+      'python': platform.python_version(),
+      'django': django.get_version(),
+      'dataset': {'sites': options.sites, 'feeds': options.feeds,
+                  'posts': options.posts, 'tags': options.tags,
+                  'zipf': options.zipf, 'seed': options.seed},
+      'repeat': options.repeat,
+      'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+      'results': results,
+    }, sort_keys=True, indent=2)
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            out.write(report)
+        finally:
+            out.close()
+    else:
+        print report
+
+if __name__ == '__main__':
+    main()
+
+#~
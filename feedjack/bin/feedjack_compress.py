@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+feedjack_compress.py
+"""
+
+import os
+import sys
+import optparse
+
+
+def convert(batch, decompress=False, verbose=False):
+    """ Compresses (or decompresses) the content of the posts, reading and
+    writing them in batches. Returns the number of posts that changed.
+    """
+    from django.db import connection, transaction
+    from feedjack import fjfields
+
+    cursor = connection.cursor()
+    last_id, changed, seen = 0, 0, 0
+    while True:
+        cursor.execute('SELECT id, content FROM feedjack_post ' \
+          'WHERE id > %s ORDER BY id LIMIT %s', [last_id, batch])
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        updates = []
+        for post_id, value in rows:
+            text = fjfields.decompress(value)
+            if decompress:
+                newvalue = text
+            else:
+                newvalue = fjfields.compress(text)
+            if newvalue != value:
+                updates.append((newvalue, post_id))
+        if updates:
+            cursor.executemany('UPDATE feedjack_post SET content = %s ' \
+              'WHERE id = %s', updates)
+        transaction.commit_unless_managed()
+        changed += len(updates)
+        seen += len(rows)
+        last_id = rows[-1][0]
+        if verbose:
+            sys.stdout.write('* %d posts read, %d converted\n' % (seen,
+              changed))
+            sys.stdout.flush()
+    return changed
+
+def main():
+    """ Converts the content of the existing posts.
+    """
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--settings',
+      help='Python path to settings module. If this isn\'t provided, ' \
+           'the DJANGO_SETTINGS_MODULE enviroment variable will be used.')
+    parser.add_option('-b', '--batch', type='int', default=500,
+      help='Number of posts read and written at a time.')
+    parser.add_option('-d', '--decompress', action='store_true',
+      dest='decompress', default=False,
+      help='Store the content of every post uncompressed again.')
+    parser.add_option('-v', '--verbose', action='store_true',
+      dest='verbose', default=False, help='Verbose output.')
+    options = parser.parse_args()[0]
+    if options.settings:
+        os.environ["DJANGO_SETTINGS_MODULE"] = options.settings
+
+    from django.conf import settings
+    if not options.decompress and \
+      not getattr(settings, 'FEEDJACK_COMPRESS_CONTENT', False):
+        sys.stdout.write('! FEEDJACK_COMPRESS_CONTENT is not set, the ' \
+          'posts saved from now on will not be compressed.\n')
+
+    changed = convert(options.batch, options.decompress, options.verbose)
+    sys.stdout.write('* %d posts converted\n' % (changed,))
+
+if __name__ == '__main__':
+    main()
+
+#~
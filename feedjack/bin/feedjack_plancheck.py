@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+feedjack_plancheck.py
+"""
+
+import os
+import sys
+import optparse
+import tempfile
+
+
+def setup(dbname):
+    """ Configures django to use an empty SQLite database.
+    """
+    from django.conf import settings
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        DATABASE_NAME=dbname,
+        INSTALLED_APPS=('feedjack',),
+        CACHE_BACKEND='dummy:///',
+        CACHE_MIDDLEWARE_KEY_PREFIX='plancheck',
+        MEDIA_URL='',
+    )
+    from django.core.management import call_command
+    call_command('syncdb', verbosity=0, interactive=False)
+
+def main():
+    """ Generates a big SQLite database and checks the plans of feedjack's
+    hot queries against it (see fjplan.py).
+    """
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--database',
+      help='SQLite database file to use. It will be created and filled if ' \
+           'it does not exist. A temporary one is used by default.')
+    parser.add_option('--feeds', type='int', default=500,
+      help='Number of feeds to generate.')
+    parser.add_option('--posts', type='int', default=100000,
+      help='Number of posts to generate.')
+    parser.add_option('--tags', type='int', default=2000,
+      help='Number of tags to generate.')
+    parser.add_option('-v', '--verbose', action='store_true',
+      dest='verbose', default=False, help='Show every query and its plan.')
+    options = parser.parse_args()[0]
+
+    if options.database:
+        dbname = options.database
+        generate = not os.path.exists(dbname)
+    else:
+        dbname = tempfile.mktemp(suffix='.db')
+        generate = True
+    setup(dbname)
+
+    from django.db import connection
+    from feedjack import models, fjdataset, fjplan
+    if generate:
+        print '* Generating %d feeds, %d posts, %d tags in %s' % (
+          options.feeds, options.posts, options.tags, dbname)
+        fjdataset.generate(sites=3, feeds=options.feeds,
+          posts=options.posts, tags=options.tags)
+        connection.cursor().execute('ANALYZE')
+    site, user_site, created_site = models.Site.objects.order_by('id')[:3]
+    errors = fjplan.check_all(site, user_site, created_site, options.verbose)
+
+    if not options.database:
+        os.unlink(dbname)
+    for error in errors:
+        print '! %s' % (error,)
+    print '* %d plan problems found' % (len(errors),)
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+#~
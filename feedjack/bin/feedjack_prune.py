@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+feedjack_prune.py
+"""
+
+import os
+import sys
+import optparse
+import datetime
+
+
+def prints(tstr):
+    """ lovely unicode
+    """
+    sys.stdout.write('%s\n' % (tstr.encode(sys.getdefaultencoding(),
+                         'replace')))
+    sys.stdout.flush()
+
+def main():
+    """ Archives the posts that are beyond the retention limits of their
+    feeds.
+    """
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--settings',
+      help='Python path to settings module. If this isn\'t provided, ' \
+           'the DJANGO_SETTINGS_MODULE enviroment variable will be used.')
+    parser.add_option('-f', '--feed', action='append', type='int',
+      help='A feed id to be pruned. This option can be given multiple ' \
+           'times (-f 1 -f 4 -f 7).')
+    parser.add_option('-s', '--site', type='int',
+      help='Prune the feeds of a site.')
+    parser.add_option('-b', '--batch', type='int', default=500,
+      help='Number of posts archived in every transaction.')
+    parser.add_option('--delete', action='store_true', dest='delete',
+      default=False,
+      help='Only keep the guid of the pruned posts, not their data.')
+    parser.add_option('--journal-days', type='int',
+      help='Also remove the entries of the change journal older than this ' \
+           'number of days.')
+    parser.add_option('-n', '--dry-run', action='store_true', dest='dry_run',
+      default=False, help='Only count the posts that would be pruned.')
+    parser.add_option('-v', '--verbose', action='store_true',
+      dest='verbose', default=False, help='Verbose output.')
+    options = parser.parse_args()[0]
+    if options.settings:
+        os.environ["DJANGO_SETTINGS_MODULE"] = options.settings
+
+    from feedjack import models, fjcache, fjrouter, fjlib, fjretention, \
+      fjjournal
+
+    fjrouter.PRIMARY_ONLY = True
+
+    prints('* BEGIN: %s' % (unicode(datetime.datetime.now()),))
+
+    if options.feed:
+        feeds = models.Feed.objects.filter(id__in=options.feed)
+    elif options.site:
+        feeds = models.Feed.objects.filter(subscriber__site=options.site)
+    else:
+        feeds = models.Feed.objects.all()
+
+    now = datetime.datetime.now()
+    pruned, total = set(), 0
+    for feed in feeds:
+        count = fjretention.prune_feed(feed, options.batch, \
+          not options.delete, options.dry_run, now)
+        if count:
+            pruned.add(feed.id)
+            total += count
+        if count or options.verbose:
+            prints(u'[%d] %d posts pruned: %s' % (feed.id, count,
+                                                   feed.feed_url))
+
+    if pruned and not options.dry_run:
+        # the post counts and the tag clouds changed
+        for site in models.Site.objects.filter( \
+          subscriber__feed__in=pruned).distinct():
+            fjlib.refresh_summary(site)
+            fjcache.cache_delsite(site.id)
+            fjcache.sidebar_delsite(site.id, list(pruned))
+
+    if options.journal_days is not None and not options.dry_run:
+        prints('* %d journal entries removed' % (
+          fjjournal.trim(options.journal_days),))
+
+    prints('* END: %s (%d posts pruned)' % (unicode(datetime.datetime.now()),
+                                            total))
+
+if __name__ == '__main__':
+    main()
+
+#~
@@ -15,8 +15,6 @@ import socket
 import traceback
 import sys
 
-import feedparser
-
 try:
     import threadpool
 except ImportError:
@@ -28,6 +26,10 @@ USER_AGENT = 'Feedjack %s - %s' % (VERSION, URL)
 SLOWFEED_WARNING = 10
 ENTRY_NEW, ENTRY_UPDATED, ENTRY_SAME, ENTRY_ERR = range(4)
 FEED_OK, FEED_SAME, FEED_ERRPARSE, FEED_ERRHTTP, FEED_ERREXC = range(5)
+# feeds read from the database at a time
+FEED_CHUNK = 500
+# feeds queued or being processed per worker thread
+QUEUE_PER_THREAD = 4
 
 
 def encode(tstr):
@@ -55,12 +57,16 @@ def mtime(ttime):
     return datetime.datetime.fromtimestamp(time.mktime(ttime))
 
 class ProcessEntry:
-    def __init__(self, feed, options, entry, postdict, fpf):
+    def __init__(self, feed, options, entry, postdict, fpf, stages=None):
+        from feedjack import fjmetrics
         self.feed = feed
         self.options = options
         self.entry = entry
         self.postdict = postdict
         self.fpf = fpf
+        if stages is None:
+            stages = fjmetrics.StageTimes()
+        self.stages = stages
 
     def get_tags(self):
         """ Returns a list of tag objects from an entry.
@@ -86,10 +92,10 @@ class ProcessEntry:
                     tagname = tagname.strip()
                     if not tagname or tagname == ' ':
                         continue
-                    if not models.Tag.objects.filter(name=tagname):
-                        cobj = models.Tag(name=tagname)
-                        cobj.save()
-                    fcat.append(models.Tag.objects.get(name=tagname))
+                    # the tag can be created meanwhile by another thread
+                    # or updater, get_or_create gets it then
+                    fcat.append(models.Tag.objects.get_or_create(
+                      name=tagname)[0])
         return fcat
 
     def get_entry_data(self):
@@ -128,7 +134,7 @@ class ProcessEntry:
         else:
             date_modified = None
 
-        fcat = self.get_tags()
+        fcat = self.stages.timed('tags', self.get_tags)
         comments = self.entry.get('comments', '')
 
         return (link, title, guid, author, author_email, content, 
@@ -136,8 +142,22 @@ class ProcessEntry:
 
     def process(self):
         """ Process a post in a feed and saves it in the DB if necessary.
+
+        The post and everything written with it (tags, timeline, search
+        index and journal) are saved in a single transaction.
+
+        The "entry" stage is the whole processing of the entry, the other
+        stages of an entry are parts of it.
         """
-        from feedjack import models
+        from feedjack import fjrouter
+        return self.stages.timed('entry',
+                                 fjrouter.commit_on_success(self.save_entry))
+
+    def save_entry(self):
+        """ Saves a new or changed post.
+        """
+        from feedjack import models, fjtimeline, fjsearch, fjlib, fjdupes, \
+          fjjournal
 
         (link, title, guid, author, author_email, content, date_modified,
          fcat, comments) = self.get_entry_data()
@@ -154,6 +174,12 @@ class ProcessEntry:
                 title, link, guid, author, author_email,
                 u' '.join(tcat.name for tcat in fcat)))
 
+        if guid in self.postdict and self.postdict[guid] is None:
+            # the post was archived by feedjack_prune, don't import it again
+            if self.options.verbose:
+                prints('[%d] Post was archived: %s' % (self.feed.id, link))
+            return ENTRY_SAME
+
         if guid in self.postdict:
             tobj = self.postdict[guid]
             if tobj.content != content or (date_modified and
@@ -168,14 +194,19 @@ class ProcessEntry:
                 tobj.title = title
                 tobj.link = link
                 tobj.content = content
+                tobj.excerpt = fjlib.make_excerpt(content)
                 tobj.guid = guid
                 tobj.date_modified = date_modified
                 tobj.author = author
                 tobj.author_email = author_email
                 tobj.comments = comments
-                tobj.tags.clear()
-                [tobj.tags.add(tcat) for tcat in fcat]
-                tobj.save()
+                self.stages.timed('duplicates', fjdupes.link_post, tobj)
+                self.stages.timed('save', self.save_post, tobj, fcat, True)
+                self.stages.timed('timeline', fjtimeline.index_post, tobj,
+                                  fcat)
+                self.stages.timed('search', fjsearch.index_post, tobj)
+                self.stages.timed('journal', fjjournal.record, tobj,
+                                  models.CHANGE_UPDATED)
             else:
                 retval = ENTRY_SAME
                 if self.options.verbose:
@@ -195,25 +226,49 @@ class ProcessEntry:
             if not date_modified:
                 date_modified = datetime.datetime.now()
             tobj = models.Post(feed=self.feed, title=title, link=link,
-                content=content, guid=guid, date_modified=date_modified,
+                content=content, excerpt=fjlib.make_excerpt(content),
+                guid=guid, date_modified=date_modified,
                 author=author, author_email=author_email,
                 comments=comments)
-            tobj.save()
-            [tobj.tags.add(tcat) for tcat in fcat]
+            self.stages.timed('duplicates', fjdupes.link_post, tobj)
+            self.stages.timed('save', self.save_post, tobj, fcat)
+            self.stages.timed('timeline', fjtimeline.index_post, tobj, fcat)
+            self.stages.timed('search', fjsearch.index_post, tobj)
+            self.stages.timed('journal', fjjournal.record, tobj,
+                              models.CHANGE_NEW)
         return retval
 
+    def save_post(self, tobj, fcat, clear_tags=False):
+        """ Saves a post and its tags.
+        """
+        tobj.save()
+        if clear_tags:
+            tobj.tags.clear()
+        [tobj.tags.add(tcat) for tcat in fcat]
+
 
 class ProcessFeed:
-    def __init__(self, feed, options):
+    def __init__(self, feed, options, stages=None, source=None):
+        from feedjack import fjmetrics, fjfetch
         self.feed = feed
         self.options = options
         self.fpf = None
+        if stages is None:
+            stages = fjmetrics.StageTimes()
+        self.stages = stages
+        # where the feed is downloaded from, see fjrecord.py
+        if source is None:
+            source = fjfetch.Fetcher(USER_AGENT, stages=stages)
+        self.source = source
+        # HTTP status and size of the response, for the metrics
+        self.status = None
+        self.nbytes = 0
 
     def process_entry(self, entry, postdict):
         """ wrapper for ProcessEntry
         """
         entry = ProcessEntry(self.feed, self.options, entry, postdict,
-                             self.fpf)
+                             self.fpf, self.stages)
         ret_entry = entry.process()
         del entry
         return ret_entry
@@ -221,7 +276,7 @@ class ProcessFeed:
     def process(self):
         """ Downloads and parses a feed.
         """
-        from feedjack import models
+        from feedjack import fjfetch, fjparse
 
         ret_values = {
             ENTRY_NEW:0,
@@ -232,35 +287,50 @@ class ProcessFeed:
         prints(u'[%d] Processing feed %s' % (self.feed.id,
                                              self.feed.feed_url))
 
-        # we check the etag and the modified time to save bandwith and
-        # avoid bans
+        # we check the etag to save bandwith and avoid bans
+        # the DNS lookups of the download are the dns stage, timed by the
+        # DNS cache of the fetcher
         try:
-            self.fpf = feedparser.parse(self.feed.feed_url,
-                                        agent=USER_AGENT,
-                                        etag=self.feed.etag)
+            response = self.stages.timed_apart('fetch', 'dns',
+              self.source.fetch, self.feed.feed_url, self.feed.etag)
+        except fjfetch.FetchError, err:
+            prints('[%d] !FETCH_ERROR! %s: %s' % (self.feed.id, err,
+                                                  self.feed.feed_url))
+            return FEED_ERRHTTP, ret_values
+
+        self.status = response.status
+        self.nbytes = len(response.body)
+        if self.options.verbose:
+            prints(u'[%d] HTTP status %d: %s' % (self.feed.id,
+                                                 response.status,
+                                                 self.feed.feed_url))
+        if response.status == 304:
+            # this means the feed has not changed
+            if self.options.verbose:
+                prints('[%d] Feed has not changed since ' \
+                       'last check: %s' % (self.feed.id,
+                                           self.feed.feed_url))
+            return FEED_SAME, ret_values
+
+        if response.status >= 400:
+            # http error, ignore
+            prints('[%d] !HTTP_ERROR! %d: %s' % (self.feed.id,
+                                                 response.status,
+                                                 self.feed.feed_url))
+            return FEED_ERRHTTP, ret_values
+
+        if self.options.parser == 'fast':
+            parse = fjparse.parse
+        else:
+            parse = fjfetch.parse
+        try:
+            self.fpf = self.stages.timed('parse', parse, response)
         except:
             prints('! ERROR: feed cannot be parsed')
             return FEED_ERRPARSE, ret_values
-        
-        if hasattr(self.fpf, 'status'):
-            if self.options.verbose:
-                prints(u'[%d] HTTP status %d: %s' % (self.feed.id,
-                                                     self.fpf.status,
-                                                     self.feed.feed_url))
-            if self.fpf.status == 304:
-                # this means the feed has not changed
-                if self.options.verbose:
-                    prints('[%d] Feed has not changed since ' \
-                           'last check: %s' % (self.feed.id,
-                                               self.feed.feed_url))
-                return FEED_SAME, ret_values
-
-            if self.fpf.status >= 400:
-                # http error, ignore
-                prints('[%d] !HTTP_ERROR! %d: %s' % (self.feed.id,
-                                                     self.fpf.status,
-                                                     self.feed.feed_url))
-                return FEED_ERRHTTP, ret_values
+        if self.options.verbose:
+            prints('[%d] Parsed with %s: %s' % (self.feed.id,
+              self.fpf.get('parser', 'feedparser'), self.feed.feed_url))
 
         if hasattr(self.fpf, 'bozo') and self.fpf.bozo:
             prints('[%d] !BOZO! Feed is not well formed: %s' % (
@@ -300,13 +370,8 @@ class ProcessFeed:
                 guids.append(entry.title)
             elif entry.link:
                 guids.append(entry.link)
-        self.feed.save()
-        if guids:
-            postdict = dict([(post.guid, post) 
-              for post in models.Post.objects.filter(
-                   feed=self.feed.id).filter(guid__in=guids)])
-        else:
-            postdict = {}
+        self.stages.timed('feed_save', self.feed.save)
+        postdict = self.stages.timed('lookup', self.get_postdict, guids)
 
         for entry in self.fpf.entries:
             try:
@@ -320,10 +385,26 @@ class ProcessFeed:
                 ret_entry = ENTRY_ERR
             ret_values[ret_entry] += 1
 
-        self.feed.save()
+        self.stages.timed('feed_save', self.feed.save)
 
         return FEED_OK, ret_values
 
+    def get_postdict(self, guids):
+        """ Returns a dictionary of the posts of the feed with a list of
+        guids, by guid.
+        """
+        from feedjack import models, fjretention
+
+        if not guids:
+            return {}
+        postdict = dict([(post.guid, post) 
+          for post in models.Post.objects.filter(
+               feed=self.feed.id).filter(guid__in=guids)])
+        # the pruned posts are marked with None
+        for guid in fjretention.archived_guids(self.feed.id, guids):
+            postdict.setdefault(guid, None)
+        return postdict
+
 class Dispatcher:
     def __init__(self, options, num_threads):
         self.options = options
@@ -349,19 +430,46 @@ class Dispatcher:
             FEED_ERRPARSE:'cant_parse',
             FEED_ERRHTTP:'http_error',
             FEED_ERREXC:'exception'}
+        # feeds with new or updated posts
+        self.changed_feeds = set()
+        # every feed processed
+        self.processed_feeds = set()
+        from feedjack import fjmetrics, fjfetch, fjrecord
+        # the fetches of every feed are only kept for the --metrics file
+        self.metrics = fjmetrics.RunMetrics(bool(options.metrics))
+        # the connections and DNS cache of the downloads
+        self.pool = None
+        if options.replay:
+            self.source = fjrecord.Replayer(options.replay)
+        else:
+            self.source = fjfetch.Fetcher(USER_AGENT, options.max_size,
+                                          options.deadline,
+                                          self.metrics.stages)
+            self.pool = self.source.pool
+            if options.record:
+                self.source = fjrecord.Recorder(options.record, self.source)
         self.entry_keys = sorted(self.entry_trans.keys())
         self.feed_keys = sorted(self.feed_trans.keys())
-        if threadpool:
+        if threadpool and num_threads > 0:
             self.tpool = threadpool.ThreadPool(num_threads)
         else:
             self.tpool = None
+        self.max_pending = num_threads * QUEUE_PER_THREAD
         self.time_start = datetime.datetime.now()
 
 
     def add_job(self, feed):
-        """ adds a feed processing job to the pool
+        """ adds a feed processing job to the pool, waiting while there are
+        max_pending jobs queued or running
         """
         if self.tpool:
+            while len(self.tpool.workRequests) >= self.max_pending:
+                time.sleep(0.05)
+                try:
+                    # forgets the finished jobs
+                    self.tpool.poll()
+                except threadpool.NoResultsPending:
+                    pass
             req = threadpool.WorkRequest(self.process_feed_wrapper,
                 (feed,))
             self.tpool.putRequest(req)
@@ -372,11 +480,16 @@ class Dispatcher:
     def process_feed_wrapper(self, feed):
         """ wrapper for ProcessFeed
         """
+        from django.db import reset_queries
+        from feedjack import fjmetrics
+        # with DEBUG, django keeps every query of the thread in memory
+        reset_queries()
         start_time = datetime.datetime.now()
+        pfeed = None
         try:
-            pfeed = ProcessFeed(feed, self.options)
+            pfeed = ProcessFeed(feed, self.options, self.metrics.stages,
+                                self.source)
             ret_feed, ret_entries = pfeed.process()
-            del pfeed
         except:
             (etype, eobj, etb) = sys.exc_info()
             print '[%d] ! -------------------------' % (feed.id,)
@@ -387,6 +500,22 @@ class Dispatcher:
             ret_entries = {}
 
         delta = datetime.datetime.now() - start_time
+        duration = delta.days * 86400 + delta.seconds + \
+          delta.microseconds / 1000000.0
+        status = getattr(pfeed, 'status', None)
+        nbytes = getattr(pfeed, 'nbytes', 0)
+        del pfeed
+        entries = dict([(self.entry_trans[key], ret_entries.get(key, 0)) \
+          for key in self.entry_keys])
+        self.metrics.add(feed.id, feed.feed_url, self.feed_trans[ret_feed],
+                         duration, nbytes, status, entries)
+        try:
+            fjmetrics.record_fetch(feed.id, self.feed_trans[ret_feed],
+              duration, nbytes, status, entries['new'], entries['updated'])
+        except:
+            prints('[%d] ! Cannot save the feed statistics: %s' % (
+                   feed.id, sys.exc_info()[1]))
+
         if delta.seconds > SLOWFEED_WARNING:
             comment = u' (SLOW FEED!)'
         else:
@@ -395,15 +524,35 @@ class Dispatcher:
             feed.id, feed.feed_url, unicode(delta),
             self.feed_trans[ret_feed],
             u' '.join(u'%s=%d' % (self.entry_trans[key],
-                      ret_entries[key]) for key in self.entry_keys),
+                      ret_entries.get(key, 0)) for key in self.entry_keys),
             comment))
 
         self.feed_stats[ret_feed] += 1
+        if ret_entries.get(ENTRY_NEW) or ret_entries.get(ENTRY_UPDATED):
+            self.changed_feeds.add(feed.id)
+        self.processed_feeds.add(feed.id)
         for key, val in ret_entries.items():
             self.entry_stats[key] += val
 
         return ret_feed, ret_entries
 
+    def wait(self):
+        """ waits for the queued jobs to finish
+        """
+        if self.tpool:
+            self.tpool.wait()
+
+    def close(self):
+        """ closes the source of the feeds and stops the worker threads,
+        the interpreter can crash on exit if they are still waiting for jobs
+        """
+        self.source.close()
+        if self.tpool:
+            workers = list(self.tpool.workers)
+            self.tpool.dismissWorkers(len(workers))
+            for worker in workers:
+                worker.join()
+
     def poll(self):
         """ polls the active threads
         """
@@ -430,6 +579,275 @@ class Dispatcher:
                 break
 
 
+def update_feeds(disp, options):
+    """ Updates the feeds selected in the options.
+
+    The feeds are queued by URL, so the feeds of the same host are downloaded
+    one after the other through the connections that are kept open.
+    """
+    from feedjack import models
+
+    if options.feed:
+        feeds = models.Feed.objects.filter(id__in=options.feed)
+        known_ids = list(feeds.values_list('id', flat=True))
+        for feed in options.feed:
+            if feed not in known_ids:
+                prints('! Unknown feed id: %d' % (feed,))
+    elif options.site:
+        try:
+            site = models.Site.objects.get(pk=int(options.site))
+        except models.Site.DoesNotExist:
+            prints('! Unknown site id: %d' % (options.site,))
+            return
+        feeds = models.Feed.objects.filter(subscriber__site=site)
+    else:
+        feeds = models.Feed.objects.filter(is_active=True)
+
+    if options.lease:
+        lease_feeds(disp, options, feeds)
+    else:
+        from feedjack import fjlease
+        for feed in chunked(feeds):
+            if options.shard and fjlease.shard(feed.feed_url,
+                                               options.shard[1]) != \
+              options.shard[0]:
+                continue
+            disp.add_job(feed)
+
+    disp.poll()
+
+def chunked(feeds, size=FEED_CHUNK):
+    """ Iterates over a queryset of feeds by url, reading size feeds at a
+    time, so they are never all in memory.
+    """
+    last_url = None
+    while True:
+        chunk = feeds.order_by('feed_url')
+        if last_url is not None:
+            chunk = chunk.filter(feed_url__gt=last_url)
+        chunk = list(chunk[:size])
+        for feed in chunk:
+            yield feed
+        if len(chunk) < size:
+            break
+        last_url = chunk[-1].feed_url
+
+def lease_feeds(disp, options, feeds):
+    """ Claims the feeds in batches and updates them, until every feed has
+    been claimed by this or another updater since the start of the run (see
+    fjlease.py).
+    """
+    from feedjack import fjlease
+
+    owner = fjlease.owner()
+    started = fjlease.run_start()
+    while True:
+        batch = fjlease.claim(feeds, owner, options.lease,
+                              options.lease_batch, started)
+        if not batch:
+            break
+        prints(u'* Claimed %d feeds for %d seconds as %s' % (len(batch),
+               options.lease, owner))
+        for feed in batch:
+            disp.add_job(feed)
+        disp.wait()
+
+class QueryCounter:
+    """ Counts the queries of every database connection, from any thread.
+    """
+    def __init__(self):
+        from django.db.backends import BaseDatabaseWrapper
+        import threading
+        self.lock = threading.Lock()
+        self.count = 0
+        cursor = BaseDatabaseWrapper.cursor
+        counter = self
+        def counting_cursor(self):
+            return CountingCursor(cursor(self), counter)
+        BaseDatabaseWrapper.cursor = counting_cursor
+
+    def add(self):
+        self.lock.acquire()
+        self.count += 1
+        self.lock.release()
+
+class CountingCursor:
+    """ Cursor wrapper that counts the statements executed through it.
+    """
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        self.counter.add()
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.add()
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def benchmark_passes(farm, threads, options):
+    """ Updates the feeds of a farm in an empty SQLite database three times
+    (every post new, every feed unchanged and a new post in every feed)
+    and returns the results of every pass and the peak memory.
+    """
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp(prefix='feedjack-benchmark-')
+    try:
+        results = run_passes(farm, threads, options,
+                             os.path.join(directory, 'benchmark.db'))
+    finally:
+        shutil.rmtree(directory, True)
+    peak = resource_peak()
+    return results, peak
+
+def run_passes(farm, threads, options, dbname):
+    """ Runs the passes of benchmark_passes with a new database in dbname.
+    """
+    import urllib
+    from django.conf import settings
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        DATABASE_NAME=dbname,
+        DATABASE_OPTIONS={'timeout': 60},
+        INSTALLED_APPS=('feedjack',),
+        CACHE_BACKEND='dummy:///',
+        CACHE_MIDDLEWARE_KEY_PREFIX='benchmark',
+        MEDIA_URL='',
+    )
+    from django.core.management import call_command
+    call_command('syncdb', verbosity=0, interactive=False)
+
+    from django.db import transaction
+    from feedjack import models, fjrouter, fjdataset
+    fjrouter.PRIMARY_ONLY = True
+    site = models.Site(name='Benchmark', url='http://benchmark.example.com',
+      title='Benchmark', description='Benchmark')
+    site.save()
+    fjdataset.bulk_insert(models.Feed, [{'feed_url': farm.url(num),
+      'name': 'Feed %d' % num, 'shortname': 'feed%d' % num, \
+      'is_active': True} for num in range(farm.feeds)])
+    fjdataset.bulk_insert(models.Subscriber, [{'site_id': site.id,
+      'feed_id': feed_id, 'name': 'Feed %d' % feed_id,
+      'shortname': 'feed%d' % feed_id, 'is_active': True} \
+      for feed_id in models.Feed.objects.values_list('id', flat=True)])
+    transaction.commit_unless_managed()
+
+    counter = QueryCounter()
+    results = []
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for name, version in (('new', 0), ('unchanged', 0), ('updated', 1)):
+            urllib.urlopen('http://%s:%d/version/%d/' % (farm.host,
+                                                        farm.port, version))
+            disp = Dispatcher(options, threads)
+            counter.count = 0
+            start = time.time()
+            for feed in models.Feed.objects.filter(is_active=True):
+                disp.add_job(feed)
+            disp.poll()
+            duration = time.time() - start
+            disp.close()
+            results.append({'pass': name, 'duration': duration,
+              'feeds': sum(disp.feed_stats.values()),
+              'entries': sum(disp.entry_stats.values()),
+              'queries': counter.count, 'connections': disp.pool.opened})
+    finally:
+        sys.stdout = stdout
+    return results
+
+def resource_peak():
+    """ Returns the peak memory of the process in kilobytes.
+    """
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes in Mac OS X, kilobytes everywhere else
+        peak /= 1024
+    return peak
+
+def per(total, count):
+    """ Returns total / count for the benchmark report, n/a if count is 0.
+    """
+    if not count:
+        return u'n/a'
+    return u'%.2f' % (total / float(count),)
+
+def benchmark(options):
+    """ Updates the feeds of a local farm (see fjfarm.py) with every number of
+    worker threads of --benchmark-threads, each one in a new process, and
+    prints the throughput of each configuration.
+    """
+    import cPickle
+    from feedjack import fjfarm
+
+    farm = fjfarm.FeedFarm(feeds=options.benchmark,
+      entries=options.farm_entries, latency=options.farm_latency,
+      size=options.farm_size, error_rate=options.farm_errors,
+      bozo_rate=options.farm_bozo, etags=options.farm_etags)
+    farm.start()
+    prints('* Serving %d feeds on port %d, parsed with %s' % (farm.feeds,
+      farm.port, options.parser))
+    try:
+        for threads in [int(num) for num in \
+          options.benchmark_threads.split(',')]:
+            read, write = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(read)
+                status = 1
+                try:
+                    try:
+                        os.write(write, cPickle.dumps(benchmark_passes(farm,
+                          threads, options)))
+                        status = 0
+                    except:
+                        traceback.print_exc()
+                finally:
+                    os._exit(status)
+            os.close(write)
+            data = []
+            while True:
+                chunk = os.read(read, 65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            os.close(read)
+            status = os.waitpid(pid, 0)[1]
+            if status or not data:
+                # the child printed the traceback
+                if os.WIFSIGNALED(status):
+                    reason = 'killed by signal %d' % (os.WTERMSIG(status),)
+                else:
+                    reason = 'exit status %d' % (os.WEXITSTATUS(status),)
+                prints('! threads=%d: the benchmark failed (%s)' % (threads,
+                  reason))
+                continue
+            results, peak = cPickle.loads(''.join(data))
+            for result in results:
+                prints(u'* threads=%d %s: %.1f feeds/s, %.1f entries/s, ' \
+                  u'%s queries/entry, %s queries/feed (%d feeds, %d ' \
+                  u'entries in %.2fs, %d connections)' % (threads,
+                  result['pass'], result['feeds'] / result['duration'],
+                  result['entries'] / result['duration'],
+                  per(result['queries'], result['entries']),
+                  per(result['queries'], result['feeds']),
+                  result['feeds'], result['entries'], result['duration'],
+                  result['connections']))
+            prints(u'* threads=%d peak memory: %d kB' % (threads, peak))
+    finally:
+        farm.stop()
+    prints('* Responses: %s' % (u' '.join([u'%d=%d' % (status, count) \
+      for status, count in sorted(farm.responses.items())]),))
+
 def main():
     """ Main function. Nothing to see here. Move along.
     """
@@ -450,12 +868,165 @@ def main():
       help='Wait timeout in seconds when connecting to feeds.')
     parser.add_option('-w', '--workerthreads', type='int', default=10,
       help='Worker threads that will fetch feeds in parallel.')
+    parser.add_option('--max-size', type='int', dest='max_size',
+      default=10 * 1024 * 1024,
+      help='Maximum size in bytes of a feed, compressed or not (10MB by ' \
+           'default). 0 for no limit.')
+    parser.add_option('--deadline', type='int', default=60,
+      help='Maximum time in seconds to download a feed, including the ' \
+           'redirects. 0 for no limit.')
+    parser.add_option('--metrics',
+      help='Write a summary of the run to this file: a Prometheus textfile ' \
+           'if the name ends with .prom, JSON otherwise.')
+    parser.add_option('--timings', action='store_true', dest='timings',
+      default=False,
+      help='Print the time spent in every stage of the update at the end.')
+    parser.add_option('--profile',
+      help='Profile the update and write the stats to this file (readable ' \
+           'with pstats). The feeds are fetched one at a time, use -f or ' \
+           '-s to profile a subset of the feeds.')
+    parser.add_option('--record', metavar='DIR',
+      help='Keep the downloaded feeds in an archive in this directory.')
+    parser.add_option('--replay', metavar='DIR',
+      help='Update the feeds from the archive in this directory instead of ' \
+           'downloading them.')
+    parser.add_option('--lease', type='int', metavar='SECONDS',
+      help='Claim the feeds in batches for this number of seconds before ' \
+           'updating them, so several updaters can share the feeds. A ' \
+           'feed is updated at most once per run, and not by another ' \
+           'updater until its lease expires.')
+    parser.add_option('--lease-batch', type='int', dest='lease_batch',
+      default=50,
+      help='Number of feeds claimed at a time with --lease.')
+    parser.add_option('--shard', metavar='I/N',
+      help='Only update the feeds of the shard I (from 0 to N-1) of N. The ' \
+           'feeds are split by host, and only the cache of the sites of ' \
+           'the updated feeds is invalidated.')
+    parser.add_option('--parser', type='choice',
+      choices=('feedparser', 'fast'), default='feedparser',
+      help='Parser of the feeds: feedparser (the default) or fast, a ' \
+           'faster one for the well formed RSS 2.0 and Atom 1.0 feeds that ' \
+           'uses feedparser for the rest.')
+    parser.add_option('--search-reindex', action='store_true',
+      dest='search_reindex', default=False,
+      help='Rebuild the search index of all the posts (or of the posts of ' \
+           'the feeds given with -f) instead of updating the feeds.')
+    parser.add_option('--find-duplicates', action='store_true',
+      dest='find_duplicates', default=False,
+      help='Look for the duplicates among all the posts instead of ' \
+           'updating the feeds.')
+    parser.add_option('--rebuild-timeline', action='store_true',
+      dest='rebuild_timeline', default=False,
+      help='Build or drop the timelines of the sites whose "use timeline" ' \
+           'option has changed (or rebuild the timeline of the site given ' \
+           'with -s) instead of updating the feeds. The other runs do it ' \
+           'before updating the feeds, except with --lease or a shard ' \
+           'other than 0.')
+    parser.add_option('--rebuild-excerpts', action='store_true',
+      dest='rebuild_excerpts', default=False,
+      help='Rebuild the excerpts of all the posts (or of the posts of the ' \
+           'feeds given with -f) instead of updating the feeds.')
+
+    group = optparse.OptionGroup(parser, 'Benchmark',
+      'Update the feeds of a local HTTP server in temporary SQLite ' \
+      'databases instead of the configured feeds, and print the feeds and ' \
+      'entries per second, the queries per entry and the peak memory.')
+    group.add_option('--benchmark', type='int', metavar='FEEDS',
+      help='Number of feeds of the local server.')
+    group.add_option('--benchmark-threads', default='1,10',
+      metavar='THREADS',
+      help='Comma separated numbers of worker threads to compare.')
+    group.add_option('--farm-entries', type='int', default=20,
+      help='Entries per feed.')
+    group.add_option('--farm-latency', type='float', default=0.0,
+      help='Seconds every response is delayed.')
+    group.add_option('--farm-size', type='int', default=500,
+      help='Size of the content of every entry, in bytes.')
+    group.add_option('--farm-errors', type='float', default=0.0,
+      help='Fraction of the feeds that answer with an HTTP error.')
+    group.add_option('--farm-bozo', type='float', default=0.0,
+      help='Fraction of the feeds that are not well formed.')
+    group.add_option('--farm-no-etags', action='store_false',
+      dest='farm_etags', default=True,
+      help='The feeds don\'t send ETags and never answer 304.')
+    parser.add_option_group(group)
     options = parser.parse_args()[0]
+    if options.record and options.replay:
+        parser.error('--record and --replay can\'t be used together')
+    if options.shard:
+        try:
+            index, count = [int(num) for num in options.shard.split('/')]
+        except ValueError:
+            parser.error('--shard must be I/N, as in 0/4')
+        if not 0 <= index < count:
+            parser.error('the shard must be from 0 to N-1')
+        if options.lease:
+            parser.error('--shard and --lease can\'t be used together')
+        options.shard = (index, count)
+    if options.lease is not None and options.lease < 1:
+        parser.error('--lease must be at least 1 second')
+    if options.benchmark:
+        socket.setdefaulttimeout(options.timeout)
+        benchmark(options)
+        return
     if options.settings:
         os.environ["DJANGO_SETTINGS_MODULE"] = options.settings
+    if options.profile:
+        # the profiler only sees the main thread
+        options.workerthreads = 0
+
+
+    from feedjack import models, fjcache, fjrouter, fjlib
 
+    # the updater reads what it is about to write, never use the replicas
+    fjrouter.PRIMARY_ONLY = True
 
-    from feedjack import models, fjcache
+    if options.search_reindex:
+        from feedjack import fjsearch
+        if options.feed:
+            count = 0
+            for feed in models.Feed.objects.filter(id__in=options.feed):
+                count += fjsearch.reindex(feed)
+        else:
+            count = fjsearch.reindex()
+        prints('* Indexed %d posts' % (count,))
+        return
+
+    if options.find_duplicates:
+        from feedjack import fjdupes
+        prints('* Found %d duplicates' % (fjdupes.rebuild(),))
+        return
+
+    if options.rebuild_excerpts:
+        from feedjack import fjfields
+        posts = models.Post.objects.all()
+        if options.feed:
+            posts = posts.filter(feed__in=options.feed)
+        count = 0
+        for post_id, content in posts.values_list('id', 'content').iterator():
+            models.Post.objects.filter(id=post_id).update( \
+              excerpt=fjlib.make_excerpt(fjfields.decompress(content)))
+            count += 1
+        prints('* Rebuilt %d excerpts' % (count,))
+        return
+
+    if options.rebuild_timeline:
+        from feedjack import fjtimeline
+        if options.site:
+            sites = list(models.Site.objects.filter(pk=options.site))
+            for site in sites:
+                fjtimeline.rebuild_site(site)
+        else:
+            sites = fjtimeline.rebuild_pending()
+        prints('* Rebuilt the timeline of %d sites' % (len(sites),))
+        return
+
+    if not options.lease and (not options.shard or options.shard[0] == 0):
+        # the timelines of the sites changed in the admin, only one of the
+        # updaters that run at the same time does it
+        from feedjack import fjtimeline
+        for site in fjtimeline.rebuild_pending():
+            prints('* Rebuilt the timeline of site %d' % (site.id,))
 
     # settting socket timeout (default= 10 seconds)
     socket.setdefaulttimeout(options.timeout)
@@ -465,37 +1036,54 @@ def main():
     
     prints('* BEGIN: %s' % (unicode(datetime.datetime.now()),))
 
-    if options.feed:
-        feeds = models.Feed.objects.filter(id__in=options.feed)
-        known_ids = []
-        for feed in feeds:
-            known_ids.append(feed.id)
-            disp.add_job(feed)
-        for feed in options.feed:
-            if feed not in known_ids:
-                prints('! Unknown feed id: %d' % (feed,))
-    elif options.site:
+    if options.profile:
         try:
-            site = models.Site.objects.get(pk=int(options.site))
-        except models.Site.DoesNotExist:
-            site = None
-            prints('! Unknown site id: %d' % (options.site,))
-        if site:
-            feeds = [sub.feed for sub in site.subscriber_set.all()]
-            for feed in feeds:
-                disp.add_job(feed)
+            import cProfile as profile
+        except ImportError:
+            import profile
+        prof = profile.Profile()
+        prof.runcall(update_feeds, disp, options)
+        prof.dump_stats(options.profile)
+        prints('* Profile written to %s' % (options.profile,))
     else:
-        for feed in models.Feed.objects.filter(is_active=True):
-            disp.add_job(feed)
+        update_feeds(disp, options)
 
-    disp.poll()
+    # refreshing the summaries and removing the cached data in all sites,
+    # this will only work with the memcached, db and file backends. The
+    # sidebars are only removed for the subscribers that got new posts.
+    # A shard only does it for the sites of its feeds, the other shards do
+    # it for theirs.
+    sites = models.Site.objects.all()
+    if options.shard:
+        site_ids = set([site_id for site_id, feed_id in \
+          models.Subscriber.objects.values_list('site', 'feed') \
+          if feed_id in disp.processed_feeds])
+        sites = [site for site in sites if site.id in site_ids]
+    for site in sites:
+        fjlib.refresh_summary(site)
+        fjcache.cache_delsite(site.id)
+        fjcache.sidebar_delsite(site.id, [feed_id for feed_id in \
+          site.subscriber_set.values_list('feed', flat=True) \
+          if feed_id in disp.changed_feeds])
+
+    disp.close()
+
+    if options.timings:
+        prints(u'* Stages:')
+        for line in disp.metrics.stages.report():
+            prints(u'  ' + line)
+        if disp.pool:
+            prints(u'* Connections: %d opened, %d reused, %d DNS ' \
+                   u'lookups' % (disp.pool.opened, disp.pool.reused,
+                                 disp.pool.dns.lookups))
 
-    # removing the cached data in all sites, this will only work with the
-    # memcached, db and file backends
-    [fjcache.cache_delsite(site.id) for site in models.Site.objects.all()]
+    if options.metrics:
+        disp.metrics.write(options.metrics)
 
-    if threadpool:
+    if disp.tpool:
         tcom = u'%d threads' % (options.workerthreads,)
+    elif threadpool:
+        tcom = u'no worker threads, no parallel fetching'
     else:
         tcom = u'no threadpool module available, no parallel fetching'
 
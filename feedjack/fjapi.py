@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjapi.py
+
+Helpers for the JSON views.
+
+The listings are paginated with a cursor instead of a page number: the
+cursor has the sort key of the last post that was returned, and the next
+page is read from the index starting right after it, so deep pages cost the
+same than the first one and don't skip or repeat posts when new ones are
+added. A null in the sort key is an empty value in the cursor, and the nulls
+are placed where the database sorts them.
+"""
+
+import md5
+import base64
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import smart_str, smart_unicode
+
+from feedjack import models
+from feedjack import fjlib
+from feedjack import fjfields
+from feedjack import fjjournal
+from feedjack import fjrouter
+
+POST_FIELDS = ('id', 'title', 'link', 'content', 'excerpt', 'date_modified',
+  'date_created', 'guid', 'author', 'author_email', 'comments', 'feed',
+  'tags')
+
+SUBSCRIBER_FIELDS = ('id', 'name', 'shortname', 'title', 'link', 'feed_url',
+  'last_modified', 'last_checked', 'post_count')
+
+MAX_LIMIT = 100
+
+CHANGE_NAMES = {
+    models.CHANGE_NEW: 'new',
+    models.CHANGE_UPDATED: 'updated',
+    models.CHANGE_DELETED: 'deleted',
+}
+
+
+class APIError(Exception):
+    """ A request the API can't answer, the message is returned to the
+    client.
+    """
+
+
+def get_fields(request, allowed):
+    """ Returns the list of fields asked in the "fields" parameter, or all
+    of them.
+    """
+    fields = request.GET.get('fields')
+    if not fields:
+        return list(allowed)
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    for field in fields:
+        if field not in allowed:
+            raise APIError('unknown field: %s' % (field,))
+    return fields
+
+def get_limit(request, site):
+    """ Returns the number of posts asked in the "limit" parameter.
+    """
+    try:
+        limit = int(request.GET.get('limit', site.posts_per_page))
+    except ValueError:
+        raise APIError('invalid limit')
+    return max(1, min(limit, MAX_LIMIT))
+
+def cursor_keys(site):
+    """ Returns the fields of the sort key of a listing, the row id breaks
+    the ties.
+    """
+    return [field.lstrip('-') for field in fjlib.listing_order(site)] + \
+      ['id']
+
+def encode_cursor(values):
+    """ Returns the cursor string of a sort key, the nulls are empty.
+    """
+    return base64.urlsafe_b64encode('|'.join([value is not None and \
+      smart_str(value) or '' for value in values]))
+
+def decode_cursor(cursor, model, keys):
+    """ Returns the sort key of a cursor string.
+    """
+    try:
+        values = base64.urlsafe_b64decode(smart_str(cursor)).split('|')
+        if len(values) != len(keys):
+            raise ValueError
+        result = []
+        for key, value in zip(keys, values):
+            field = model._meta.get_field(key)
+            if not value:
+                if not field.null:
+                    raise ValueError
+                result.append(None)
+            else:
+                result.append(field.to_python(smart_unicode(value)))
+        return result
+    except Exception:
+        raise APIError('invalid cursor')
+
+def nulls_first(queryset):
+    """ Returns True if the database of a queryset sorts the nulls first in a
+    descending order (PostgreSQL and Oracle), False if it sorts them last
+    (SQLite and MySQL).
+    """
+    alias = getattr(queryset, 'db', None)
+    if alias:
+        # django with multiple database support
+        engine = fjrouter.get_connection(alias).settings_dict['ENGINE']
+    else:
+        engine = settings.DATABASE_ENGINE
+    return 'postgresql' in engine or 'oracle' in engine
+
+def after_cursor(queryset, keys, values):
+    """ Filters a queryset sorted (descending) by keys to the rows that come
+    after a sort key.
+    """
+    # (k1 after v1) OR (k1 = v1 AND k2 after v2) OR ...
+    first = nulls_first(queryset)
+    query = None
+    for num in range(len(keys)):
+        cond = Q()
+        for pos in range(num):
+            if values[pos] is None:
+                cond &= Q(**{'%s__isnull' % (keys[pos],): True})
+            else:
+                cond &= Q(**{keys[pos]: values[pos]})
+        key, value = keys[num], values[num]
+        if value is None:
+            if not first:
+                # nothing comes after the nulls
+                continue
+            cond &= Q(**{'%s__isnull' % (key,): False})
+        elif first:
+            cond &= Q(**{'%s__lt' % (key,): value})
+        else:
+            cond &= Q(**{'%s__lt' % (key,): value}) | \
+              Q(**{'%s__isnull' % (key,): True})
+        if query is None:
+            query = cond
+        else:
+            query = query | cond
+    return queryset.filter(query)
+
+def post_values(ids, fields):
+    """ Returns the asked fields of a list of posts, in the same order.
+    """
+    dbfields = [field for field in fields if field != 'tags']
+    if 'id' not in dbfields:
+        dbfields.append('id')
+    rows = {}
+    for row in models.Post.objects.filter(id__in=ids).values(*dbfields):
+        if 'feed_id' in row:
+            row['feed'] = row.pop('feed_id')
+        if 'content' in row:
+            row['content'] = fjfields.decompress(row['content'])
+        rows[row['id']] = row
+    if 'tags' in fields:
+        for row in rows.values():
+            row['tags'] = []
+        for post_id, name in fjlib.get_tag_names(ids):
+            if post_id in rows:
+                rows[post_id]['tags'].append(name)
+    result = []
+    for post_id in ids:
+        if post_id in rows:
+            row = rows[post_id]
+            if 'id' not in fields:
+                del row['id']
+            result.append(row)
+    return result
+
+def posts(request, site, sfeeds_ids, tag=None, user=None):
+    """ Returns the data of a page of a listing.
+    """
+    fields = get_fields(request, POST_FIELDS)
+    limit = get_limit(request, site)
+    queryset = fjlib.get_listing(site, sfeeds_ids, tag, user)
+    keys = cursor_keys(site)
+    if request.GET.get('cursor'):
+        queryset = after_cursor(queryset, keys, \
+          decode_cursor(request.GET['cursor'], queryset.model, keys))
+    if queryset.model is models.TimelineEntry:
+        post_key = 'post'
+    else:
+        post_key = 'id'
+    rows = list(queryset.order_by(*['-%s' % key for key in keys]) \
+      .values_list(*(keys + [post_key]))[:limit + 1])
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][:len(keys)])
+    else:
+        next_cursor = None
+    return {
+        'posts': post_values([row[-1] for row in rows], fields),
+        'next': next_cursor,
+    }
+
+def subscribers(request, site, sfeeds_obj):
+    """ Returns the data of the subscribers of a site.
+    """
+    fields = get_fields(request, SUBSCRIBER_FIELDS)
+    result = []
+    for sub in sfeeds_obj:
+        feed = sub.feed
+        values = {
+            'id': feed.id,
+            'name': sub.name,
+            'shortname': sub.shortname,
+            'title': feed.title,
+            'link': feed.link,
+            'feed_url': feed.feed_url,
+            'last_modified': feed.last_modified,
+            'last_checked': feed.last_checked,
+            'post_count': sub.post_count,
+        }
+        result.append(dict([(field, values[field]) for field in fields]))
+    return {'subscribers': result}
+
+def changes(request, site, sfeeds_ids):
+    """ Returns the entries of the change journal of the site's feeds after
+    the sequence number in the "after" parameter.
+    """
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        raise APIError('invalid after')
+    result = []
+    for change in fjjournal.read(after, get_limit(request, site), \
+      sfeeds_ids):
+        result.append({
+            'sequence': change.id,
+            'post': change.post_id,
+            'feed': change.feed_id,
+            'change': CHANGE_NAMES[change.change_type],
+            'date': change.date_created,
+        })
+        after = change.id
+    return {'changes': result, 'last': after}
+
+def dumps(data):
+    """ Serializes the data of a response.
+    """
+    return simplejson.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False)
+
+def etag(content):
+    """ Returns the ETag of a response body.
+    """
+    return '"%s"' % (md5.new(smart_str(content)).hexdigest(),)
+
+
+#~
@@ -7,15 +7,27 @@ fjcache.py
 """
 
 import md5
+import time
 
 from django.core.cache import cache
 
 from django.conf import settings
 
+from feedjack import fjstats
+
 
 T_HOST = 1
 T_ITEM = 2
 T_META = 3
+T_FRESH = 4
+T_POST = 5
+T_SIDEBAR = 6
+T_SIDEBARMETA = 7
+T_POSTVERSION = 8
+
+T_NAMES = {T_HOST: 'host', T_ITEM: 'item', T_META: 'meta', T_FRESH: 'fresh',
+  T_POST: 'post', T_SIDEBAR: 'sidebar', T_SIDEBARMETA: 'sidebarmeta',
+  T_POSTVERSION: 'postversion'}
 
 
 def str2md5(key):
@@ -35,12 +47,31 @@ def getkey(stype, site_id=None, key=None):
         return '%s.%d.item.%s' % (base, site_id, str2md5(key))
     elif stype == T_META:
         return '%s.%d.meta' % (base, site_id)
+    elif stype == T_FRESH:
+        return '%s.%d.fresh' % (base, site_id)
+    elif stype == T_POST:
+        return '%s.%d.post.%s' % (base, site_id, str2md5(key))
+    elif stype == T_SIDEBAR:
+        return '%s.%d.sidebar.%s' % (base, site_id, str2md5(key))
+    elif stype == T_SIDEBARMETA:
+        return '%s.%d.sidebarmeta' % (base, site_id)
+    elif stype == T_POSTVERSION:
+        return '%s.%d.postversion' % (base, site_id)
+
+def lookup(stype, key):
+    """ Retrieves a key of a type from the cache, counting the hit or the
+    miss in the stats of the request (see fjstats.py).
+    """
+    value = cache.get(key)
+    if fjstats.ENABLED:
+        fjstats.cache_access(T_NAMES[stype], value is not None)
+    return value
 
 
 def hostcache_get():
     """ Retrieves the hostcache dictionary
     """
-    return cache.get(getkey(T_HOST))
+    return lookup(T_HOST, getkey(T_HOST))
 
 def hostcache_set(value):
     """ Sets the hostcache dictionary
@@ -50,7 +81,7 @@ def hostcache_set(value):
 def cache_get(site_id, key):
     """ Retrieves cache data from a site.
     """
-    return cache.get(getkey(T_ITEM, site_id, key))
+    return lookup(T_ITEM, getkey(T_ITEM, site_id, key))
 
 def cache_set(site, key, data):
     """ Sets cache data for a site.
@@ -59,7 +90,7 @@ def cache_set(site, key, data):
     """
     tkey = getkey(T_ITEM, site.id, key)
     mkey = getkey(T_META, site.id)
-    tmp = cache.get(mkey)
+    tmp = lookup(T_META, mkey)
     longdur = 365*24*60*60
     if not tmp:
         tmp = [tkey]
@@ -71,13 +102,145 @@ def cache_set(site, key, data):
 
 def cache_delsite(site_id):
     """ Removes all cache data from a site.
+
+    The site is also marked as fresh, see fresh_get.
     """
+    cache.set(getkey(T_FRESH, site_id), True,
+      getattr(settings, 'FEEDJACK_REPLICA_LAG', 60))
     mkey = getkey(T_META, site_id)
-    tmp = cache.get(mkey)
+    tmp = lookup(T_META, mkey)
     if not tmp:
         return
     for tkey in tmp:
         cache.delete(tkey)
     cache.delete(mkey)
 
+def fresh_get(site_id):
+    """ Returns True if the site's cache was removed recently, and the pages
+    should be rebuilt with data from the primary database.
+    """
+    return bool(lookup(T_FRESH, getkey(T_FRESH, site_id)))
+
+def post_digest(post):
+    """ Returns a digest of the data of a post shown in the pages and feeds,
+    with the tags set by fjlib.get_posts_tags. The digest is kept in the post
+    object.
+    """
+    if not hasattr(post, '_digest'):
+        if getattr(post, '_deferred', False):
+            # the listings of the sites that show excerpts don't load the
+            # content
+            body = post.excerpt
+        else:
+            body = post.content
+        post._digest = str2md5(u'\n'.join([unicode(val) for val in (
+          post.feed.name, post.title, post.link, post.date_modified,
+          post.author, post.author_email, post.comments, body)] + \
+          [tag.name for tag in getattr(post, 'qtags', [])]))
+    return post._digest
+
+def fragment_version(site_id):
+    """ Returns the version of the post fragments of a site, part of their
+    keys. A new version is started when there is none in the cache.
+    """
+    key = getkey(T_POSTVERSION, site_id)
+    version = lookup(T_POSTVERSION, key)
+    if version is None:
+        version = fragment_delsite(site_id)
+    return version
+
+def fragment_delsite(site_id):
+    """ Starts a new version of the post fragments of a site, the ones that
+    show something of the site or of its subscribers that has changed. Returns
+    the new version.
+    """
+    version = '%.6f' % (time.time(),)
+    cache.set(getkey(T_POSTVERSION, site_id), version, 365*24*60*60)
+    return version
+
+def fragment_key(site_id, version, post, name):
+    """ Returns the cache key of a fragment of a post.
+    """
+    return getkey(T_POST, site_id, u'%s.%s.%d.%s' % (name, version, post.id,
+      post_digest(post)))
+
+def fragments_get(site_id, posts, name):
+    """ Retrieves the rendered fragments of a list of posts in a single round
+    trip. Returns the list of fragments, None for the missing ones. They are
+    also kept in the post objects for fragment_get.
+    """
+    version = fragment_version(site_id)
+    keys = [fragment_key(site_id, version, post, name) for post in posts]
+    values = cache.get_many(keys)
+    fragments = []
+    for post, key in zip(posts, keys):
+        value = values.get(key)
+        if fjstats.ENABLED:
+            fjstats.cache_access(T_NAMES[T_POST], value is not None)
+        post.__dict__.setdefault('_fragments', {})[name] = value
+        fragments.append(value)
+    return fragments
+
+def fragment_get(site_id, post, name, page=()):
+    """ Retrieves a rendered fragment of a post. The fragments of the other
+    posts of the page are retrieved with it (see fragments_get).
+    """
+    if name not in getattr(post, '_fragments', {}):
+        fragments_get(site_id, [post] + [other for other in page \
+          if other is not post], name)
+    return post._fragments[name]
+
+def fragment_set(site, post, name, data):
+    """ Sets a rendered fragment of a post.
 
+    Fragments are not removed by cache_delsite. The key changes with the
+    post's digest, so only the posts that changed are rendered again, and
+    with the version of the site, see fragment_delsite.
+    """
+    cache.set(fragment_key(site.id, fragment_version(site.id), post, name),
+      data, site.cache_duration)
+
+def sidebar_get(site_id, feed_id, name):
+    """ Retrieves a rendered sidebar fragment of a site (feed_id 0) or one of
+    its subscribers.
+    """
+    return lookup(T_SIDEBAR, getkey(T_SIDEBAR, site_id, u'%d.%s' % (feed_id,
+      name)))
+
+def sidebar_set(site, feed_id, name, data):
+    """ Sets a rendered sidebar fragment of a site or one of its subscribers.
+
+    The keys are stored in a per-site meta key, apart from the pages, so
+    they can be removed by subscriber.
+    """
+    tkey = getkey(T_SIDEBAR, site.id, u'%d.%s' % (feed_id, name))
+    mkey = getkey(T_SIDEBARMETA, site.id)
+    tmp = lookup(T_SIDEBARMETA, mkey)
+    if not tmp:
+        tmp = {}
+    if tkey not in tmp.get(feed_id, []):
+        tmp.setdefault(feed_id, []).append(tkey)
+        cache.set(mkey, tmp, 365*24*60*60)
+    cache.set(tkey, data, site.cache_duration)
+
+def sidebar_delsite(site_id, feed_ids=None):
+    """ Removes the sidebar fragments of a site.
+
+    If a list of feed ids is given, only the fragments of those subscribers
+    and the site wide ones are removed, and nothing is removed if the list is
+    empty.
+    """
+    mkey = getkey(T_SIDEBARMETA, site_id)
+    tmp = lookup(T_SIDEBARMETA, mkey)
+    if not tmp:
+        return
+    if feed_ids is None:
+        feed_ids = tmp.keys()
+    elif not feed_ids:
+        return
+    else:
+        feed_ids = [0] + list(feed_ids)
+    for feed_id in feed_ids:
+        for tkey in tmp.pop(feed_id, []):
+            cache.delete(tkey)
+    cache.set(mkey, tmp, 365*24*60*60)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjdataset.py
+"""
+
+import bisect
+import random
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+from feedjack import models
+
+
+def bulk_insert(model, rows):
+    """ Inserts a list of dictionaries (keyed by attribute name) in a model's
+    table with a single executemany.
+
+    Fields missing in a row get their default value, so this keeps working
+    when fields are added to the models.
+    """
+    fields = [field for field in model._meta.fields \
+      if not isinstance(field, AutoField)]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+      connection.ops.quote_name(model._meta.db_table),
+      ', '.join([connection.ops.quote_name(field.column) \
+        for field in fields]),
+      ', '.join(['%s'] * len(fields)))
+    values = []
+    for row in rows:
+        values.append([field.get_db_prep_save(row.get(field.attname,
+          field.get_default())) for field in fields])
+    cursor = connection.cursor()
+    cursor.executemany(sql, values)
+
+def bulk_insert_m2m(table, column1, column2, pairs):
+    """ Inserts a list of pairs in a many to many table.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (
+      qn(table), qn(column1), qn(column2)), pairs)
+
+def zipf_weights(count, exponent=1.0):
+    """ Returns the cumulative weights of count ranks that follow Zipf's law.
+    """
+    total, weights = 0.0, []
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        weights.append(total)
+    return weights
+
+def zipf_sample(rnd, items, weights, count):
+    """ Returns count different items of a list chosen with a list of
+    cumulative weights.
+    """
+    chosen = set()
+    count = min(count, len(items))
+    while len(chosen) < count:
+        chosen.add(bisect.bisect_right(weights, rnd.random() * weights[-1]))
+    return [items[pos] for pos in chosen]
+
+def generate(sites=1, feeds=200, posts=20000, tags=500, tags_per_post=3,
+             seed=0, batch=5000, zipf=1.0):
+    """ Fills an empty feedjack database with synthetic data.
+
+    The first site is subscribed to every feed, the others to a random
+    third of them. The tags of the posts follow Zipf's law with the given
+    exponent (tag0 is the most used one), 0 gives every tag the same
+    chance. Returns the list of generated sites.
+    """
+    rnd = random.Random(seed)
+
+    siteobjs = []
+    for num in range(sites):
+        site = models.Site(name='Site %d' % num,
+          url='http://site%d.example.com' % num, title='Site %d' % num,
+          description='Synthetic site %d' % num, use_internal_cache=False)
+        site.save()
+        siteobjs.append(site)
+
+    now = datetime.datetime.now()
+    bulk_insert(models.Feed, [{
+      'feed_url': 'http://feed%d.example.com/rss/' % num,
+      'name': 'Feed %d' % num,
+      'shortname': 'feed%d' % num,
+      'title': 'Feed %d' % num,
+      'link': 'http://feed%d.example.com/' % num,
+      'is_active': True,
+      'last_checked': now - datetime.timedelta(minutes=rnd.randint(0, 600))}
+      for num in range(feeds)])
+    feed_ids = [feed.id for feed in models.Feed.objects.all()]
+
+    subscribers = []
+    for site in siteobjs:
+        if site is siteobjs[0]:
+            sfeeds = feed_ids
+        else:
+            sfeeds = rnd.sample(feed_ids, max(1, len(feed_ids) / 3))
+        for feed_id in sfeeds:
+            subscribers.append({'site_id': site.id, 'feed_id': feed_id,
+              'name': 'Subscriber %d' % feed_id,
+              'shortname': 'sub%d' % feed_id, 'is_active': True})
+    bulk_insert(models.Subscriber, subscribers)
+
+    bulk_insert(models.Tag, [{'name': 'tag%d' % num} for num in range(tags)])
+    tag_ids = [tag.id for tag in models.Tag.objects.order_by('id')]
+    tag_weights = zipf_weights(len(tag_ids), zipf)
+
+    start = now - datetime.timedelta(days=3*365)
+    span = int((now - start).days * 24 * 60 * 60)
+    first_id = None
+    for offset in range(0, posts, batch):
+        rows = []
+        for num in range(offset, min(posts, offset + batch)):
+            date = start + datetime.timedelta(seconds=rnd.randint(0, span))
+            rows.append({
+              'feed_id': rnd.choice(feed_ids),
+              'title': 'Post %d' % num,
+              'link': 'http://example.com/post/%d/' % num,
+              'content': '<p>Synthetic post %d</p>' % num,
+              'guid': 'http://example.com/post/%d/' % num,
+              'date_modified': date,
+              'date_created': date.date()})
+        bulk_insert(models.Post, rows)
+        if first_id is None:
+            first_id = models.Post.objects.order_by('id')[0].id
+    if posts:
+        pairs = []
+        for post_id in range(first_id, first_id + posts):
+            for tag_id in zipf_sample(rnd, tag_ids, tag_weights,
+                                      tags_per_post):
+                pairs.append((post_id, tag_id))
+                if len(pairs) >= batch:
+                    bulk_insert_m2m('feedjack_post_tags', 'post_id',
+                      'tag_id', pairs)
+                    pairs = []
+        bulk_insert_m2m('feedjack_post_tags', 'post_id', 'tag_id', pairs)
+    transaction.commit_unless_managed()
+    return siteobjs
+
+
+#~
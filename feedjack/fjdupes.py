@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjdupes.py
+
+Detection of the posts that are published in more than one feed (a blog's
+main feed and one of its category feeds, an aggregator, etc).
+
+Every post has a key of its normalized link and a fingerprint of its title
+and text. When feedjack_update saves a post with the key or the fingerprint
+of a post of another feed, the new post points to it as its canonical post,
+and the listings of the sites that are subscribed to both feeds only show the
+canonical one. The text alone is not enough: different posts often have the
+same text (a "continue reading" teaser, a podcast description, a footer).
+"""
+
+import cgi
+import md5
+import urllib
+import urlparse
+
+from django.utils.encoding import smart_str
+
+from feedjack import models
+from feedjack import fjlib
+
+# short texts ("Link", "via twitter") are the same in many unrelated posts
+MIN_FINGERPRINT_TEXT = 200
+
+# query parameters added by the feed and analytics services
+TRACKING_PARAMS = ('utm_source', 'utm_medium', 'utm_campaign', 'utm_term',
+  'utm_content', 'fbclid', 'gclid')
+
+
+def normalize_link(link):
+    """ Returns a link without the differences that don't change the page it
+    points to (scheme, www, default port, fragment, trailing slash, tracking
+    parameters and their order).
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit( \
+      smart_str(link).strip())
+    scheme = scheme.lower()
+    if scheme == 'https':
+        scheme = 'http'
+    netloc = netloc.lower()
+    for port in (':80', ':443'):
+        if netloc.endswith(port):
+            netloc = netloc[:-len(port)]
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    path = path.rstrip('/')
+    params = [(key, value) for key, value in cgi.parse_qsl(query, True) \
+      if key not in TRACKING_PARAMS]
+    params.sort()
+    return urlparse.urlunsplit((scheme, netloc, path, \
+      urllib.urlencode(params), ''))
+
+def link_key(link):
+    """ Returns the key of a post's link.
+    """
+    if not link:
+        return ''
+    return md5.new(normalize_link(link)).hexdigest()
+
+def fingerprint(title, content):
+    """ Returns the fingerprint of a post's title and text, or an empty
+    string if the post has no title or if its text is too short to tell it
+    apart from others.
+    """
+    title = fjlib.plain_text(title).lower()
+    text = fjlib.plain_text(content).lower()
+    if not title or len(text) < MIN_FINGERPRINT_TEXT:
+        return ''
+    return md5.new(smart_str(u'%s\n%s' % (title, text))).hexdigest()
+
+def set_keys(post):
+    """ Sets the link key and the fingerprint of a post.
+    """
+    post.link_key = link_key(post.link)
+    post.fingerprint = fingerprint(post.title, post.content)
+
+def find_canonical(post):
+    """ Returns the canonical post of a post (a post of another feed with
+    the same link, or with the same title and text), or None.
+    """
+    posts = models.Post.objects.filter(canonical__isnull=True) \
+      .exclude(feed=post.feed_id)
+    if post.id:
+        posts = posts.exclude(id=post.id)
+    for field in ('link_key', 'fingerprint'):
+        value = getattr(post, field)
+        if not value:
+            continue
+        matches = list(posts.filter(**{field: value}).order_by('id')[:1])
+        if matches:
+            return matches[0]
+    return None
+
+def link_post(post):
+    """ Sets the keys of a post and links it to its canonical post. The post
+    is not saved.
+    """
+    set_keys(post)
+    if post.canonical_id is None:
+        canonical = find_canonical(post)
+        if canonical is not None:
+            post.canonical = canonical
+
+def rebuild(batch=1000):
+    """ Sets the keys and canonical posts of all the posts, oldest first,
+    replacing the ones found before. Returns the number of duplicates found.
+    """
+    count, last_id = 0, 0
+    posts = models.Post.objects.order_by('id')
+    while True:
+        chunk = list(posts.filter(id__gt=last_id)[:batch])
+        if not chunk:
+            return count
+        for post in chunk:
+            post.canonical_id = None
+            link_post(post)
+            models.Post.objects.filter(id=post.id).update( \
+              link_key=post.link_key, fingerprint=post.fingerprint, \
+              canonical=post.canonical_id)
+            if post.canonical_id:
+                count += 1
+        last_id = chunk[-1].id
+
+
+#~
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjfarm.py
+
+A local HTTP server with thousands of synthetic RSS and Atom feeds, used by
+"feedjack_update.py --benchmark" to measure the updater without depending on
+real feeds:
+
+    farm = fjfarm.FeedFarm(feeds=1000, latency=0.05, error_rate=0.01)
+    farm.start()
+    ... update farm.url(0) ... farm.url(999)
+    farm.version += 1   # every feed gets a new entry
+    farm.stop()
+
+Every feed is built from its number and the seed, so two runs with the same
+options serve the same data. The feeds send an ETag that changes with the
+version and answer 304 to a request with the current one. The version can
+also be changed from another process with a request to /version/<number>/.
+"""
+
+import re
+import time
+import random
+import threading
+import SocketServer
+import BaseHTTPServer
+from xml.sax.saxutils import escape
+
+FEED_PATH = re.compile(r'^/feed/(\d+)/$')
+VERSION_PATH = re.compile(r'^/version/(\d+)/$')
+
+# date of the first entry of every feed, an entry is published every hour
+START = 1230768000
+
+LOREM = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do ' \
+        'eiusmod tempor incididunt ut labore et dolore magna aliqua. '
+
+
+class FarmServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FarmHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the feeds of the farm of the server.
+    """
+
+    # keep-alive, as most of the real servers. The response is buffered and
+    # sent at once, small writes on a kept-alive connection wait for the
+    # delayed ACK of the client
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_GET(self):
+        farm = self.server.farm
+        match = VERSION_PATH.match(self.path)
+        if match:
+            farm.version = int(match.group(1))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        match = FEED_PATH.match(self.path)
+        if not match or int(match.group(1)) >= farm.feeds:
+            self.send_error(404)
+            return
+        if farm.latency:
+            time.sleep(farm.latency)
+        status, headers, body = farm.response(int(match.group(1)),
+          self.headers.get('If-None-Match'))
+        farm.count(status)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FeedFarm(object):
+    """ A set of synthetic feeds served over HTTP.
+
+    feeds: number of feeds.
+    entries: entries per feed.
+    latency: seconds every response is delayed.
+    size: approximate size of the content of every entry, in bytes.
+    error_rate: fraction of the feeds that answer with an HTTP error.
+    bozo_rate: fraction of the feeds that are not well formed.
+    etags: whether the feeds send ETags and answer 304.
+    """
+
+    def __init__(self, feeds=1000, entries=20, latency=0.0, size=500,
+                 error_rate=0.0, bozo_rate=0.0, etags=True, seed=0,
+                 host='127.0.0.1', port=0):
+        self.feeds = feeds
+        self.entries = entries
+        self.latency = latency
+        self.size = size
+        self.error_rate = error_rate
+        self.bozo_rate = bozo_rate
+        self.etags = etags
+        self.seed = seed
+        self.host = host
+        self.port = port
+        # changing the version adds a new entry to every feed
+        self.version = 0
+        self.server = None
+        self.lock = threading.Lock()
+        self.responses = {}
+
+    def start(self):
+        """ Starts serving the feeds in a thread.
+        """
+        self.server = FarmServer((self.host, self.port), FarmHandler)
+        self.server.farm = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        """ Stops the server.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, num):
+        """ Returns the URL of a feed.
+        """
+        return 'http://%s:%d/feed/%d/' % (self.host, self.port, num)
+
+    def count(self, status):
+        """ Counts a response by status.
+        """
+        self.lock.acquire()
+        try:
+            self.responses[status] = self.responses.get(status, 0) + 1
+        finally:
+            self.lock.release()
+
+    def response(self, num, etag=None):
+        """ Returns the (status, headers, body) of a request to a feed.
+        """
+        rnd = random.Random('%s.%d' % (self.seed, num))
+        if rnd.random() < self.error_rate:
+            return rnd.choice((404, 500, 503)), [], 'error'
+        bozo = rnd.random() < self.bozo_rate
+        headers = []
+        if self.etags:
+            current = '"%d.%d"' % (num, self.version)
+            if etag == current:
+                return 304, [], ''
+            headers.append(('ETag', current))
+        if num % 2:
+            body = self.atom(num, rnd)
+            headers.append(('Content-Type', 'application/atom+xml'))
+        else:
+            body = self.rss(num, rnd)
+            headers.append(('Content-Type', 'application/rss+xml'))
+        if bozo:
+            # an unescaped ampersand and a missing closing tag
+            body = body.replace('<title>', '<title>Q&A ', 1)
+            body = body[:body.rindex('<')]
+        return 200, headers, body
+
+    def items(self, num):
+        """ Returns the (number, title, link, content, date) of the entries of
+        a feed, newest first.
+        """
+        text = escape((LOREM * (self.size / len(LOREM) + 1))[:self.size])
+        items = []
+        for entry in range(self.version + self.entries - 1, self.version - 1,
+                           -1):
+            items.append((entry, 'Entry %d of feed %d' % (entry, num),
+              'http://feed%d.example.com/entry/%d/' % (num, entry),
+              '<p>%s</p>' % (text,), START + entry * 3600))
+        return items
+
+    def rss(self, num, rnd):
+        """ Returns the body of an RSS 2.0 feed.
+        """
+        items = []
+        for entry, title, link, content, date in self.items(num):
+            items.append('<item><title>%s</title><link>%s</link>' \
+              '<guid>%s</guid><description>%s</description>' \
+              '<category>tag%d</category><pubDate>%s</pubDate></item>' % (
+              title, link, link, escape(content), rnd.randint(0, 50),
+              time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(date))))
+        return '<?xml version="1.0" encoding="utf-8"?>\n' \
+          '<rss version="2.0"><channel><title>Feed %d</title>' \
+          '<link>http://feed%d.example.com/</link>' \
+          '<description>Synthetic feed %d</description>%s' \
+          '</channel></rss>\n' % (num, num, num, ''.join(items))
+
+    def atom(self, num, rnd):
+        """ Returns the body of an Atom 1.0 feed.
+        """
+        entries = []
+        for entry, title, link, content, date in self.items(num):
+            entries.append('<entry><title>%s</title>' \
+              '<link href="%s"/><id>%s</id><updated>%s</updated>' \
+              '<category term="tag%d"/><author><name>Author %d</name>' \
+              '</author><content type="html">%s</content></entry>' % (
+              title, link, link,
+              time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(date)),
+              rnd.randint(0, 50), num, escape(content)))
+        updated = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(START + \
+          (self.version + self.entries) * 3600))
+        return '<?xml version="1.0" encoding="utf-8"?>\n' \
+          '<feed xmlns="http://www.w3.org/2005/Atom">' \
+          '<title>Feed %d</title><link href="http://feed%d.example.com/"/>' \
+          '<id>http://feed%d.example.com/</id><updated>%s</updated>%s' \
+          '</feed>\n' % (num, num, num, updated, ''.join(entries))
+
+
+#~
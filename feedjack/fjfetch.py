@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjfetch.py
+
+Download of the feeds. feedjack_update downloads a feed and parses it apart,
+so the response can be kept exactly as it was served (see fjrecord.py).
+
+The body is read in chunks and the download is abandoned when the body (or
+the body once decompressed) is larger than max_size bytes or when it takes
+more than deadline seconds, including the redirects. The socket timeout only
+bounds every read, a feed that sends a byte every few seconds would never
+time out: a single watchdog thread shuts down the sockets of the downloads
+that pass their deadline.
+
+A Fetcher keeps the connections open between the downloads (HTTP/1.1
+keep-alive) and the addresses of the hosts for DNS_TTL seconds, the feeds of
+the same host are downloaded through the same connections.
+"""
+
+import time
+import zlib
+import heapq
+import itertools
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+from cStringIO import StringIO
+from email.Utils import parsedate_tz, mktime_tz
+
+import feedparser
+
+# limits of a download, in bytes and seconds
+MAX_SIZE = 10 * 1024 * 1024
+DEADLINE = 60
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+# idle connections kept open per host
+MAX_IDLE = 4
+DNS_TTL = 300
+
+
+class FetchError(Exception):
+    """ The feed could not be downloaded (DNS, connection, timeout, size...).
+    """
+
+
+class StaleConnection(Exception):
+    """ The server closed a kept-alive connection before the request.
+    """
+
+
+class Response(object):
+    """ A response to the request of a feed. The headers have lowercase names
+    and the body is the one that was served, it may be compressed.
+    """
+
+    def __init__(self, url, status, headers, body, href=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        # the url of the feed after the redirects
+        self.href = href or url
+        # the body without its content encoding, see decode()
+        self.data = None
+
+
+class Fetcher(object):
+    """ Downloads the feeds from the network.
+    """
+
+    def __init__(self, agent=None, max_size=MAX_SIZE, deadline=DEADLINE,
+                 stages=None):
+        self.agent = agent
+        self.max_size = max_size
+        self.deadline = deadline
+        self.pool = ConnectionPool(stages=stages)
+
+    def fetch(self, url, etag=None):
+        return fetch(url, etag, self.agent, self.max_size, self.deadline,
+                     self.pool)
+
+    def close(self):
+        self.pool.close()
+
+
+class DNSCache(object):
+    """ The addresses of the hosts, kept for ttl seconds. The lookups are
+    timed as the dns stage of stages (a fjmetrics.StageTimes) if given.
+    """
+
+    def __init__(self, ttl=DNS_TTL, stages=None):
+        self.ttl = ttl
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.addresses = {}
+        self.lookups = 0
+
+    def lookup(self, host, port):
+        """ Returns the addresses of a host, raises socket.error if it can't
+        be resolved.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            cached = self.addresses.get((host, port))
+        finally:
+            self.lock.release()
+        if cached and cached[0] > now:
+            return cached[1]
+        if self.stages is not None:
+            infos = self.stages.timed('dns', socket.getaddrinfo, host, port,
+                                      0, socket.SOCK_STREAM)
+        else:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        addresses = [info[4][0] for info in infos]
+        self.lock.acquire()
+        try:
+            self.addresses[(host, port)] = (now + self.ttl, addresses)
+            self.lookups += 1
+        finally:
+            self.lock.release()
+        return addresses
+
+
+class Watchdog(object):
+    """ Shuts down the sockets of the downloads that are still running at
+    their deadline, from a single thread for all the downloads.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # [deadline, sequence, socket] lists, the socket is None once the
+        # download is over
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.thread = None
+
+    def watch(self, deadline, sock):
+        """ Shuts down a socket at a deadline (a time.time() value) unless
+        cancel is called before with the returned entry.
+        """
+        entry = [deadline, self.sequence.next(), sock]
+        self.condition.acquire()
+        try:
+            heapq.heappush(self.deadlines, entry)
+            # the thread doesn't survive a fork
+            if self.thread is None or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.run,
+                                               name='fjfetch watchdog')
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return entry
+
+    def cancel(self, entry):
+        self.condition.acquire()
+        try:
+            entry[2] = None
+        finally:
+            self.condition.release()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while True:
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    sock = heapq.heappop(self.deadlines)[2]
+                    if sock is not None:
+                        shutdown(sock)
+                if self.deadlines:
+                    self.condition.wait(self.deadlines[0][0] - now)
+                else:
+                    self.condition.wait()
+        finally:
+            self.condition.release()
+
+# the watchdog of every download of the process
+watchdog = Watchdog()
+
+
+class HTTPConnection(httplib.HTTPConnection):
+    """ An HTTP connection that takes the address of its host from a
+    DNSCache.
+    """
+
+    def __init__(self, host, dns=None):
+        httplib.HTTPConnection.__init__(self, host)
+        self.dns = dns
+
+    def connect(self):
+        if self.dns is None:
+            return httplib.HTTPConnection.connect(self)
+        error = None
+        for address in self.dns.lookup(self.host, self.port):
+            try:
+                self.sock = socket.create_connection((address, self.port),
+                                                     self.timeout)
+                return
+            except socket.error, err:
+                error = err
+        raise error
+
+
+class ConnectionPool(object):
+    """ The idle connections to the hosts of the feeds, at most max_idle per
+    host. The HTTPS connections don't use the DNS cache, but they are kept
+    open as the other ones.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE, ttl=DNS_TTL, stages=None):
+        self.max_idle = max_idle
+        self.dns = DNSCache(ttl, stages)
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+
+    def get(self, scheme, netloc):
+        """ Returns an idle connection to a host or a new one, and whether it
+        was idle.
+        """
+        self.lock.acquire()
+        try:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                self.reused += 1
+                return connections.pop(), True
+            self.opened += 1
+        finally:
+            self.lock.release()
+        return connect(scheme, netloc, self.dns), False
+
+    def put(self, connection):
+        """ Keeps a connection whose last response has been read.
+        """
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(connection.key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def close(self):
+        """ Closes the idle connections.
+        """
+        self.lock.acquire()
+        try:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+def fetch(url, etag=None, agent=None, max_size=None, deadline=None,
+          pool=None):
+    """ Downloads a feed and returns its Response, raises FetchError if there
+    is no response or if it breaks the limits. Without a pool the connections
+    are closed after every request.
+
+    As in feedparser, an url without a scheme is a local file.
+    """
+    if '://' not in url:
+        try:
+            data = open(url, 'rb').read()
+        except IOError, err:
+            raise FetchError(str(err))
+        return Response(url, 200, {}, data)
+
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    if agent:
+        headers['User-Agent'] = agent
+    if etag:
+        headers['If-None-Match'] = etag
+    if deadline:
+        deadline = time.time() + deadline
+    href = url
+    for num in range(MAX_REDIRECTS + 1):
+        status, response_headers, body = request(href, headers, max_size,
+                                                 deadline, pool)
+        if status not in (301, 302, 303, 307) or \
+          not response_headers.get('location'):
+            break
+        href = urlparse.urljoin(href, response_headers['location'])
+    else:
+        raise FetchError('more than %d redirects' % (MAX_REDIRECTS,))
+    response = Response(url, status, response_headers, body, href)
+    decode(response, max_size)
+    return response
+
+def request(url, headers, max_size=None, deadline=None, pool=None):
+    """ Sends a GET request and returns the (status, headers, body) of the
+    response. deadline is a time.time() value.
+    """
+    scheme, netloc, path, query = urlparse.urlsplit(url)[:4]
+    if scheme not in ('http', 'https'):
+        raise FetchError('unsupported scheme: %s' % (url,))
+    path = path or '/'
+    if query:
+        path = '%s?%s' % (path, query)
+    if pool is None:
+        pool = ConnectionPool(0)
+    connection, reused = pool.get(scheme, netloc)
+    try:
+        response, body = exchange(connection, path, headers, max_size,
+                                  deadline, reused)
+    except StaleConnection:
+        connection.close()
+        connection = connect(scheme, netloc, pool.dns)
+        response, body = exchange(connection, path, headers, max_size,
+                                  deadline)
+    if deadline and time.time() >= deadline:
+        # the body may have been cut by the watchdog
+        connection.close()
+        raise FetchError('the download took more than the deadline')
+    if response.will_close:
+        connection.close()
+    else:
+        pool.put(connection)
+    return response.status, dict(response.getheaders()), body
+
+def exchange(connection, path, headers, max_size=None, deadline=None,
+             reused=False):
+    """ Sends a request through a connection and returns the response and
+    its body. The connection is closed if there is an error, raises
+    StaleConnection if a reused connection had been closed by the server.
+    """
+    watched = None
+    try:
+        try:
+            if connection.sock is None:
+                connection.connect()
+            if deadline:
+                # a read that is still waiting at the deadline fails. The
+                # connection closes its socket object when the response has
+                # no keep-alive, the watchdog needs the system socket that
+                # the response keeps reading from
+                sock = getattr(connection.sock, '_sock', connection.sock)
+                watched = watchdog.watch(deadline, sock)
+            try:
+                if connection.proxied and connection.key[0] == 'http':
+                    path = '%s://%s%s' % (connection.key + (path,))
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.BadStatusLine, socket.error):
+                if reused and not (deadline and time.time() >= deadline):
+                    raise StaleConnection
+                raise
+            body = read(response, max_size)
+        except (httplib.HTTPException, socket.error, IOError), err:
+            connection.close()
+            if deadline and time.time() >= deadline:
+                raise FetchError('the download took more than the deadline')
+            raise FetchError(str(err))
+    finally:
+        if watched:
+            watchdog.cancel(watched)
+    return response, body
+
+def connect(scheme, netloc, dns=None):
+    """ Returns a connection to a host, through the proxy of the environment
+    if there is one.
+    """
+    proxy = urllib.getproxies().get(scheme)
+    proxied = bool(proxy) and not urllib.proxy_bypass(netloc.split(':')[0])
+    if proxied:
+        proxy = urlparse.urlsplit(proxy)[1] or proxy
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(proxy)
+            connection.set_tunnel(netloc)
+        else:
+            connection = HTTPConnection(proxy, dns)
+    elif scheme == 'https':
+        connection = httplib.HTTPSConnection(netloc)
+    else:
+        connection = HTTPConnection(netloc, dns)
+    # the pool of the connection and whether the requests need the full url
+    connection.key = (scheme, netloc)
+    connection.proxied = proxied
+    return connection
+
+def shutdown(sock):
+    """ Shuts down a socket, its reads fail.
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+def read(response, max_size=None):
+    """ Reads the body of a response in chunks, raises FetchError if it is
+    larger than max_size.
+    """
+    length = response.getheader('content-length', '')
+    if max_size and length.isdigit() and int(length) > max_size:
+        raise FetchError('the body has %s bytes' % (length,))
+    chunks, size = [], 0
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise FetchError('the body has more than %d bytes' % (max_size,))
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+def decode(response, max_size=None):
+    """ Returns the body of a response without its content encoding, raises
+    FetchError if it is larger than max_size.
+    """
+    if response.data is not None:
+        return response.data
+    encoding = response.headers.get('content-encoding', '')
+    data = response.body
+    try:
+        if 'gzip' in encoding:
+            data = inflate(response.body, 16 + zlib.MAX_WBITS, max_size)
+        elif 'deflate' in encoding:
+            try:
+                data = inflate(response.body, zlib.MAX_WBITS, max_size)
+            except zlib.error:
+                # deflate without the zlib header
+                data = inflate(response.body, -zlib.MAX_WBITS, max_size)
+    except zlib.error:
+        # a broken body, feedparser will say the feed is not well formed
+        pass
+    response.data = data
+    return data
+
+def inflate(body, wbits, max_size=None):
+    """ Decompresses a gzip or deflate body, without decompressing more than
+    max_size bytes.
+    """
+    decompressor = zlib.decompressobj(wbits)
+    if not max_size:
+        return decompressor.decompress(body) + decompressor.flush()
+    data = decompressor.decompress(body, max_size + 1)
+    if len(data) > max_size:
+        raise FetchError('the body has more than %d bytes once ' \
+                         'decompressed' % (max_size,))
+    return data
+
+def parse(response):
+    """ Parses the body of a response with feedparser. The result has the
+    HTTP data of the response, as if feedparser had downloaded it.
+    """
+    headers = dict(response.headers)
+    headers.pop('content-encoding', None)
+    body = StringIO(decode(response))
+    try:
+        result = feedparser.parse(body, response_headers=headers)
+    except TypeError:
+        # feedparser older than 5.0
+        result = feedparser.parse(body)
+    add_response(result, response)
+    return result
+
+def add_response(result, response):
+    """ Adds the HTTP data of a response to the result of a parser.
+    """
+    headers = dict(response.headers)
+    headers.pop('content-encoding', None)
+    result['status'] = response.status
+    result['href'] = response.href
+    result['headers'] = headers
+    if headers.get('etag'):
+        result['etag'] = headers['etag']
+    if headers.get('last-modified'):
+        # a time tuple in UTC, as in the older versions of feedparser
+        modified = parsedate_tz(headers['last-modified'])
+        if modified:
+            result['modified'] = time.gmtime(mktime_tz(modified))
+        else:
+            result.pop('modified', None)
+
+
+#~
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjfields.py
+"""
+
+import zlib
+import base64
+
+from django.conf import settings
+from django.db import models
+from django.utils.encoding import smart_str, force_unicode
+
+# compressed values are stored as this prefix and the base64 of the zlib
+# data, so they fit in a text column and can live next to plain values
+PREFIX = 'zlib:'
+
+
+def compress(text):
+    """ Returns the stored form of a text, compressed if that makes it
+    shorter.
+    """
+    if not text:
+        return text
+    data = smart_str(text)
+    value = PREFIX + base64.b64encode(zlib.compress(data, 9))
+    if len(value) >= len(data):
+        return text
+    return value
+
+def decompress(value):
+    """ Returns the text of a stored value, compressed or not.
+    """
+    if value and value.startswith(PREFIX):
+        try:
+            return force_unicode(zlib.decompress(base64.b64decode( \
+              smart_str(value[len(PREFIX):]))))
+        except (TypeError, zlib.error):
+            # not ours, a text that happens to start with the prefix
+            pass
+    return value
+
+
+class CompressedTextField(models.TextField):
+    """ A text field that is compressed in the database when
+    FEEDJACK_COMPRESS_CONTENT is set.
+
+    The values are always decompressed when they are read, so the rows
+    written with and without the setting can be mixed. The lookups and the
+    values()/values_list() querysets see the stored value, use decompress
+    on the latter.
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        return decompress(value)
+
+    def get_db_prep_save(self, value):
+        if getattr(settings, 'FEEDJACK_COMPRESS_CONTENT', False):
+            value = compress(value)
+        return super(CompressedTextField, self).get_db_prep_save(value)
+
+    def get_internal_type(self):
+        return 'TextField'
+
+
+#~
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjjournal.py
+
+Append only journal of the changes to the posts.
+
+feedjack_update writes an entry for every new or updated post in the same
+transaction as the post, and feedjack_prune one for every deleted post. The
+id of an entry is its sequence number. A consumer keeps the last sequence it
+has processed in a named checkpoint and reads the entries after it:
+
+    changes = fjjournal.pending('indexer')
+    for change in changes:
+        ...
+    if changes:
+        fjjournal.set_checkpoint('indexer', changes[-1].id)
+
+The ids are given when the entries are written, but the updater threads
+commit their transactions in any order, so an entry can become visible after
+entries with higher ids and a consumer that had already moved past them
+would never read it. The entries are only read once they are older than
+FEEDJACK_JOURNAL_LAG seconds (60 by default), and never past a younger
+entry: the journal is read in order and without gaps as long as no
+transaction that writes to it lasts longer than the lag and the clocks of the
+updaters and the readers are within the lag of each other. A lag of 0 reads
+the entries as soon as they are committed, without this guarantee.
+"""
+
+import datetime
+
+from django.conf import settings
+
+from feedjack import models
+from feedjack import fjrouter
+
+
+def record(post, change):
+    """ Writes the journal entry of a change to a post.
+    """
+    models.PostChange(post_id=post.id, feed_id=post.feed_id,
+      change_type=change).save()
+
+def record_deleted(ids):
+    """ Writes the journal entries of a list of deleted posts. Must be called
+    before the posts are deleted.
+    """
+    if not ids:
+        return
+    cursor = fjrouter.connection_for_write().cursor()
+    cursor.execute("""
+      INSERT INTO feedjack_postchange (post_id, feed_id, change_type,
+                                      date_created)
+      SELECT id, feed_id, %%s, %%s FROM feedjack_post WHERE id IN (%s)
+      ORDER BY id""" % (', '.join([str(int(post_id)) for post_id in ids]),),
+      [models.CHANGE_DELETED, datetime.datetime.now()])
+
+def read(after=0, limit=1000, feed_ids=None):
+    """ Returns the journal entries after a sequence number, in order, up to
+    the first entry that is younger than the lag.
+    """
+    changes = models.PostChange.objects.filter(id__gt=after)
+    lag = getattr(settings, 'FEEDJACK_JOURNAL_LAG', 60)
+    if lag:
+        # the entries of all the feeds, a younger entry of another feed can
+        # still hide an older one that is not committed yet
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=lag)
+        younger = list(changes.filter(date_created__gt=cutoff) \
+          .order_by('id').values_list('id', flat=True)[:1])
+        if younger:
+            changes = changes.filter(id__lt=younger[0])
+    if feed_ids is not None:
+        changes = changes.filter(feed_id__in=feed_ids)
+    return list(changes.order_by('id')[:limit])
+
+def last_sequence():
+    """ Returns the sequence number of the last entry of the journal.
+    """
+    changes = list(models.PostChange.objects.order_by('-id')[:1])
+    if changes:
+        return changes[0].id
+    return 0
+
+def get_checkpoint(name):
+    """ Returns the last sequence number read by a consumer.
+    """
+    try:
+        return models.JournalCheckpoint.objects.get(name=name).sequence
+    except models.JournalCheckpoint.DoesNotExist:
+        return 0
+
+def set_checkpoint(name, sequence):
+    """ Saves the last sequence number read by a consumer.
+    """
+    try:
+        checkpoint = models.JournalCheckpoint.objects.get(name=name)
+    except models.JournalCheckpoint.DoesNotExist:
+        checkpoint = models.JournalCheckpoint(name=name)
+    checkpoint.sequence = sequence
+    checkpoint.save()
+    fjrouter.commit_unless_managed()
+
+def pending(name, limit=1000, feed_ids=None):
+    """ Returns the journal entries a consumer hasn't read yet.
+    """
+    return read(get_checkpoint(name), limit, feed_ids)
+
+def trim(days):
+    """ Removes the journal entries older than a number of days. Returns the
+    number of removed entries.
+
+    The last entry is always kept, SQLite reuses the ids of an empty table
+    and the sequence would start again.
+    """
+    old = models.PostChange.objects.filter(date_created__lt= \
+      datetime.datetime.now() - datetime.timedelta(days=days), \
+      id__lt=last_sequence())
+    count = old.count()
+    old.delete()
+    return count
+
+
+#~
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjlease.py
+
+Leases of the feeds, to run feedjack_update on several nodes at the same
+time. An updater started with --lease SECONDS claims the feeds in batches. A
+feed can be claimed when it has no lease or when its lease has expired, and
+the claim sets the owner and the expiration of the lease with an UPDATE that
+checks the expiration again, so two updaters can't claim the same feed.
+
+The lease is kept after the feed has been processed, and an updater only
+claims the feeds whose lease expired before it started: every claim made
+during a run expires after the start of the run, so a feed is updated at most
+once per run, however long the run takes, and the run ends when every feed
+has been claimed. The feeds of an updater that crashed are claimed by the
+updaters started after their leases expired. The lease period has to be
+longer than the time needed to process a batch, so that another updater
+doesn't start to update the feeds of a batch while it is being processed.
+
+The feeds can also be split statically between updaters with "--shard I/N":
+the shard of a feed comes from a hash of its host, so every feed of a host
+is updated by the same updater.
+"""
+
+import os
+import md5
+import socket
+import urlparse
+import datetime
+
+from django.db.models import Q
+
+from feedjack import models
+
+
+def owner():
+    """ Returns the name of this updater in the leases.
+    """
+    return ('%s:%d' % (socket.gethostname(), os.getpid()))[:100]
+
+def run_start():
+    """ Returns the start time of a run, to give to claim.
+    """
+    return datetime.datetime.now().replace(microsecond=0)
+
+def available(started):
+    """ Returns the condition of the feeds that can be claimed by an updater
+    started at this time: the ones whose lease expired before it started.
+    """
+    return Q(lease_expires__isnull=True) | Q(lease_expires__lte=started)
+
+def claim(feeds, owner, period, batch, started):
+    """ Claims at most batch feeds of a queryset for period seconds, the ones
+    that were checked the longest ago, and returns them. started is the start
+    time of the run, from run_start(). An empty list means that there is
+    nothing left to claim in this run.
+    """
+    while True:
+        now = datetime.datetime.now().replace(microsecond=0)
+        expires = now + datetime.timedelta(seconds=period)
+        ids = list(feeds.filter(available(started)) \
+          .order_by('last_checked').values_list('id', flat=True)[:batch])
+        if not ids:
+            return []
+        models.Feed.objects.filter(available(started), id__in=ids) \
+          .update(lease_owner=owner, lease_expires=expires)
+        claimed = list(models.Feed.objects.filter(id__in=ids,
+          lease_owner=owner, lease_expires=expires).order_by('feed_url'))
+        if claimed:
+            return claimed
+        # another updater claimed them first, trying with the next ones
+
+def host(url):
+    """ Returns the host of a feed url, lowercase and without the port.
+    """
+    return urlparse.urlsplit(url)[1].split('@')[-1].split(':')[0].lower()
+
+def shard(url, count):
+    """ Returns the shard of a feed url among count shards, from 0 to
+    count - 1.
+    """
+    return int(md5.new(host(url)).hexdigest()[:8], 16) % count
+
+
+#~
@@ -6,14 +6,22 @@ Gustavo Picón
 fjlib.py
 """
 
+from HTMLParser import HTMLParser
+
 from django.conf import settings
 from django.db import connection
 from django.core.paginator import Paginator, InvalidPage
 from django.http import Http404
-from django.utils.encoding import smart_unicode
+from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import smart_unicode, force_unicode
+from django.utils.html import strip_tags
+from django.utils.text import truncate_words
 
 from feedjack import models
 from feedjack import fjcache
+from feedjack import fjrouter
+from feedjack import fjstats
 
 
 # this is taken from django, it was removed in r8191
@@ -92,7 +100,7 @@ def getquery(query):
     """ Performs a query and get the results.
     """
     try:
-        conn = connection.cursor()
+        conn = fjrouter.connection_for_read().cursor()
         conn.execute(query)
         data = conn.fetchall()
         conn.close()
@@ -100,29 +108,116 @@ def getquery(query):
         data = []
     return data
 
-def get_extra_content(site, sfeeds_ids, ctx):
-    """ Returns extra data useful to the templates.
+def model_values(obj):
+    """ Returns a dictionary with the field values of a model instance.
     """
+    return dict([(field.attname, getattr(obj, field.attname)) \
+      for field in obj._meta.fields])
 
-    # get the subscribers' feeds
-    if sfeeds_ids:
-        basefeeds = models.Feed.objects.filter(id__in=sfeeds_ids)
-        try:
-            ctx['feeds'] = basefeeds.order_by('name').select_related()
-        except:
-            ctx['feeds'] = []
+def from_values(model, values):
+    """ Builds a model instance from the dictionary returned by model_values,
+    after a round trip through JSON (the dates are strings).
 
-        # get the last_checked time
-        try:
-            ctx['last_modified'] = basefeeds.filter(\
-              last_checked__isnull=False).order_by(\
-              '-last_checked').select_related()[0].last_checked.ctime()
+    Fields that are not in the model anymore are ignored.
+    """
+    fields = dict([(field.attname, field) for field in model._meta.fields])
+    kwargs = {}
+    for key, val in values.items():
+        if key not in fields:
+            continue
+        if val is not None:
+            val = fields[key].to_python(val)
+        kwargs[str(key)] = val
+    return model(**kwargs)
+
+def refresh_summary(site):
+    """ Rebuilds and saves the summary of a site.
+    """
+    subscribers = list(sitefeeds(site))
+    feed_ids = [sub.feed.id for sub in subscribers]
+    post_counts = {}
+    last_checked = None
+    feeds = []
+    if feed_ids:
+        feeds = list(models.Feed.objects.filter(id__in=feed_ids).order_by(\
+          'name'))
+        for feed in feeds:
+            if feed.last_checked and (not last_checked or \
+              feed.last_checked > last_checked):
+                last_checked = feed.last_checked
+        post_counts = dict(getquery("""
+          SELECT feed_id, COUNT(*)
+          FROM feedjack_post
+          WHERE feed_id IN (%s)
+          GROUP BY feed_id""" % ', '.join([str(fid) for fid in feed_ids])))
+    data = {
+        'subscribers': [model_values(sub) for sub in subscribers],
+        'feeds': [model_values(feed) for feed in feeds],
+        # JSON objects only have string keys
+        'post_counts': post_counts.items(),
+    }
+    try:
+        summary = models.SiteSummary.objects.get(site=site)
+    except models.SiteSummary.DoesNotExist:
+        summary = models.SiteSummary(site=site)
+    summary.data = simplejson.dumps(data, cls=DjangoJSONEncoder)
+    summary.last_checked = last_checked
+    summary.post_count = sum(post_counts.values())
+    summary.save()
+    return summary
+
+def site_summary(site):
+    """ Returns the summary of a site, building it if it doesn't exist.
+
+    The summary gets these extra properties:
+    - feeds: the feeds of the active subscribers, ordered by name
+    - subscribers: the active subscribers, with their feed and site already
+      loaded
+    - feed_ids: the ids of the feeds of the active subscribers
+
+    Every feed and subscriber has a post_count property. The summary is kept
+    in the site object, so it is only read once per request.
+    """
+    if hasattr(site, '_summary'):
+        return site._summary
+    try:
+        summary = models.SiteSummary.objects.get(site=site)
+        data = simplejson.loads(summary.data)
+    except (models.SiteSummary.DoesNotExist, ValueError):
+        # the summaries saved by the older versions are not JSON
+        summary = refresh_summary(site)
+        data = simplejson.loads(summary.data)
+    data['post_counts'] = dict(data['post_counts'])
+    feedd = {}
+    summary.feeds = []
+    for values in data['feeds']:
+        feed = from_values(models.Feed, values)
+        feed.post_count = data['post_counts'].get(feed.id, 0)
+        feedd[feed.id] = feed
+        summary.feeds.append(feed)
+    summary.subscribers = []
+    for values in data['subscribers']:
+        sub = from_values(models.Subscriber, values)
+        if sub.feed_id not in feedd:
+            continue
+        sub._site_cache = site
+        sub._feed_cache = feedd[sub.feed_id]
+        sub.post_count = sub.feed.post_count
+        summary.subscribers.append(sub)
+    summary.feed_ids = [sub.feed_id for sub in summary.subscribers]
+    site._summary = summary
+    return summary
 
-        except:
-            ctx['last_modified'] = '??'
+def get_extra_content(site, sfeeds_ids, ctx):
+    """ Returns extra data useful to the templates.
+    """
+    summary = site_summary(site)
+    ctx['feeds'] = summary.feeds
+    if summary.last_checked:
+        ctx['last_modified'] = summary.last_checked.ctime()
     else:
-        ctx['feeds'] = []
         ctx['last_modified'] = '??'
+    ctx['post_count'] = summary.post_count
     ctx['site'] = site
     ctx['media_url'] = '%s/feedjack/%s' % (settings.MEDIA_URL, site.template)
 
@@ -168,6 +263,19 @@ def get_posts_tags(object_list, sfeeds_obj, user_id, tag_name):
             user_obj = post.subscriber
     return user_obj, tag_obj
 
+def get_tag_names(ids):
+    """ Returns the (post id, tag name) pairs of a list of posts.
+    """
+    if not ids:
+        return []
+    return getquery("""
+      SELECT feedjack_post_tags.post_id, feedjack_tag.name
+      FROM feedjack_post_tags, feedjack_tag
+      WHERE feedjack_post_tags.tag_id=feedjack_tag.id AND
+      feedjack_post_tags.post_id IN (%s)
+      ORDER BY feedjack_tag.name""" % (', '.join([str(int(post_id)) \
+        for post_id in ids]),))
+
 def getcurrentsite(http_post, path_info, query_string):
     """ Returns the site id and the page cache key based on the request.
     """
@@ -204,10 +312,24 @@ def getcurrentsite(http_post, path_info, query_string):
 
     return hostdict[url], pagecachekey
 
-def get_paginator(site, sfeeds_ids, page=0, tag=None, user=None):
-    """ Returns a paginator object and a requested page from it.
+def listing_order(site):
+    """ Returns the fields the listings of a site are sorted by (newest
+    first).
+    """
+    if site.order_posts_by == 2:
+        return ('-date_created', '-date_modified')
+    return ('-date_modified',)
+
+def get_listing(site, sfeeds_ids, tag=None, user=None):
+    """ Returns the sorted queryset of a listing.
+
+    It is a queryset of posts, or of timeline entries (every entry has a
+    post attribute) if the site uses a timeline.
     """
 
+    if site.use_timeline and site.timeline_ready and not user:
+        return get_timeline(site, tag)
+
     if tag:
         try:
             localposts = models.Tag.objects.get(name=tag).post_set.filter(\
@@ -222,13 +344,85 @@ def get_paginator(site, sfeeds_ids, page=0, tag=None, user=None):
             localposts = localposts.filter(feed=user)
         except:
             raise Http404
-    if site.order_posts_by == 2:
-        localposts = localposts.order_by('-date_created', '-date_modified')
     else:
-        localposts = localposts.order_by('-date_modified')
+        localposts = exclude_duplicates(localposts, sfeeds_ids)
+    return localposts.order_by(*listing_order(site))
+
+def exclude_duplicates(queryset, sfeeds_ids):
+    """ Excludes from a queryset of posts the duplicates of the posts of a
+    list of feeds (see fjdupes.py).
+
+    The duplicates are found in a subquery that only reads the posts with a
+    canonical post (the range of the canonical_id index without the nulls),
+    so the listing can still be read from the indexes without looking at
+    every post.
+    """
+    if not sfeeds_ids:
+        return queryset
+    qn = connection.ops.quote_name
+    return queryset.extra(where=['%s.%s NOT IN (SELECT dupe.%s FROM %s dupe, ' \
+      '%s canonical WHERE dupe.%s IS NOT NULL AND dupe.%s = canonical.%s ' \
+      'AND canonical.%s IN (%s))' % (
+        qn('feedjack_post'), qn('id'), qn('id'), qn('feedjack_post'),
+        qn('feedjack_post'), qn('canonical_id'), qn('canonical_id'),
+        qn('id'), qn('feed_id'),
+        ', '.join([str(int(feed_id)) for feed_id in sfeeds_ids]))])
+
+def get_timeline(site, tag=None):
+    """ Returns the sorted timeline entries of the river or of a tag page.
+    """
+
+    entries = models.TimelineEntry.objects.filter(site=site)
+    if tag:
+        try:
+            entries = entries.filter(tag=models.Tag.objects.get(name=tag))
+        except models.Tag.DoesNotExist:
+            raise Http404
+    else:
+        entries = entries.filter(tag__isnull=True)
+    return entries.order_by(*listing_order(site))
 
-    paginator = ObjectPaginator(localposts.select_related(), \
-      site.posts_per_page)
+def get_paginator(site, sfeeds_ids, page=0, tag=None, user=None):
+    """ Returns a paginator object and a requested page from it.
+    """
+
+    queryset = get_listing(site, sfeeds_ids, tag, user)
+    paginator, object_list = get_page(queryset, site, page)
+    if queryset.model is models.TimelineEntry:
+        object_list = [entry.post for entry in object_list]
+    return (paginator, object_list)
+
+def plain_text(content):
+    """ Returns the text of a post's content, without markup and with its
+    whitespace collapsed.
+    """
+    text = HTMLParser().unescape(strip_tags(force_unicode(content or u'')))
+    return u' '.join(text.split())
+
+def make_excerpt(content):
+    """ Returns the excerpt of a post's content: the first words of its
+    text, without markup.
+    """
+    return truncate_words(plain_text(content), \
+      getattr(settings, 'FEEDJACK_EXCERPT_WORDS', 50))
+
+def defer_content(queryset, site, field='content'):
+    """ Defers the loading of the posts' content if the site only shows
+    excerpts (django 1.1 or newer).
+    """
+    if site.show_excerpts and hasattr(queryset, 'defer'):
+        return queryset.defer(field)
+    return queryset
+
+def get_page(queryset, site, page):
+    """ Returns a paginator object for a queryset and a requested page from it.
+    """
+    if queryset.model is models.TimelineEntry:
+        queryset = defer_content(queryset.select_related(), site, \
+          'post__content')
+    else:
+        queryset = defer_content(queryset.select_related(), site)
+    paginator = ObjectPaginator(queryset, site.posts_per_page)
     try:
         object_list = paginator.get_page(page)
     except InvalidPage:
@@ -238,23 +432,58 @@ def get_paginator(site, sfeeds_ids, page=0, tag=None, user=None):
             raise Http404
     return (paginator, object_list)
 
-def page_context(request, site, tag=None, user_id=None, sfeeds=None):
-    """ Returns the context dictionary for a page view.
+class LazyList(object):
+    """ A list that is built the first time it is used.
+
+    Used for the context values that are expensive to build and that the
+    template may not need, like the tag cloud when the sidebar is cached.
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.value = None
+
+    def get(self):
+        if self.value is None:
+            self.value = list(self.func(*self.args))
+        return self.value
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __len__(self):
+        return len(self.get())
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __nonzero__(self):
+        return bool(self.get())
+
+def page_context(request, site, tag=None, user_id=None, sfeeds=None,
+                 query=None):
+    """ Returns the context dictionary for a page view, or for the results of
+    a search if there is a query.
     """
     sfeeds_obj, sfeeds_ids = sfeeds
     try:
         page = int(request.GET.get('page', 0))
     except ValueError:
         page = 0
-    paginator, object_list = get_paginator(site, sfeeds_ids, \
-      page=page, tag=tag, user=user_id)
+    if query is not None:
+        from feedjack import fjsearch
+        paginator, object_list = fjstats.timed('pagination', \
+          fjsearch.get_paginator, site, sfeeds_ids, query, page)
+    else:
+        paginator, object_list = fjstats.timed('pagination', get_paginator, \
+          site, sfeeds_ids, page=page, tag=tag, user=user_id)
     if object_list:
         # This will hit the DB once per page instead of once for every post in
         # a page. To take advantage of this the template designer must call
         # the qtags property in every item, instead of the default tags
         # property.
-        user_obj, tag_obj = get_posts_tags(object_list, sfeeds_obj, \
-          user_id, tag)
+        user_obj, tag_obj = fjstats.timed('tags', get_posts_tags, \
+          object_list, sfeeds_obj, user_id, tag)
     else:
         user_obj, tag_obj = None, None
     ctx = {
@@ -271,11 +500,15 @@ def page_context(request, site, tag=None, user_id=None, sfeeds=None):
     }
     get_extra_content(site, sfeeds_ids, ctx)
     from feedjack import fjcloud
-    ctx['tagcloud'] = fjcloud.getcloud(site, user_id)
+    # only built if the template needs it, the sidebar fragments may be
+    # cached
+    ctx['tagcloud'] = LazyList(fjstats.timed, 'cloud', fjcloud.getcloud, \
+      site, user_id)
     ctx['user_id'] = user_id
     ctx['user'] = user_obj
     ctx['tag'] = tag_obj
     ctx['subscribers'] = sfeeds_obj
+    ctx['query'] = query
     return ctx
 
 
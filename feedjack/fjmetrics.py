@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjmetrics.py
+
+Metrics of the feed fetches.
+
+feedjack_update keeps rolling statistics of every feed in FeedStats (to find
+the feeds that are always slow, big or broken) and, with --metrics, writes a
+summary of every run to a file: a Prometheus textfile if the name ends with
+.prom (for the node exporter's textfile collector) or JSON otherwise.
+
+The time spent in every stage of the update (fetching a feed, looking up its
+posts, saving a post, indexing it...) is also added up in a histogram per
+stage, printed with --timings and included in the --metrics file.
+"""
+
+import os
+import time
+import datetime
+import tempfile
+import threading
+
+from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
+
+from feedjack import models
+
+# weight of the last fetch in the rolling averages
+AVERAGE_WEIGHT = 0.2
+
+# results of a fetch that are not errors
+OK_RESULTS = ('ok', 'unchanged')
+
+# upper bounds of the buckets of the stage histograms, in seconds
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+def rolling(average, value, count):
+    """ Returns a rolling average updated with a new value.
+    """
+    if count <= 1:
+        return float(value)
+    return average + AVERAGE_WEIGHT * (value - average)
+
+def record_fetch(feed_id, result, duration, nbytes=0, status=None, new=0,
+                 updated=0, now=None):
+    """ Updates the statistics of a feed with a fetch.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    try:
+        stats = models.FeedStats.objects.get(feed=feed_id)
+    except models.FeedStats.DoesNotExist:
+        stats = models.FeedStats(feed_id=feed_id)
+    stats.fetches += 1
+    if result in OK_RESULTS:
+        stats.consecutive_errors = 0
+    else:
+        stats.errors += 1
+        stats.consecutive_errors += 1
+        stats.last_error = now
+    stats.last_result = result
+    stats.last_status = status
+    stats.last_duration = duration
+    stats.avg_duration = rolling(stats.avg_duration, duration, stats.fetches)
+    stats.max_duration = max(stats.max_duration, duration)
+    if result == 'ok':
+        # 304s and errors have no body, they would drag the average size down
+        stats.last_bytes = nbytes
+        stats.avg_bytes = rolling(stats.avg_bytes, nbytes, stats.fetches)
+    stats.last_new = new
+    stats.last_updated = updated
+    stats.total_new += new
+    stats.total_updated += updated
+    stats.last_fetched = now
+    stats.save()
+    return stats
+
+
+class StageTimes(object):
+    """ The time spent in every stage of an updater run. Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        # the total time of every stage in the current thread, see
+        # timed_apart
+        self.local = threading.local()
+
+    def add(self, stage, duration):
+        """ Adds the duration of a stage.
+        """
+        totals = self.local.__dict__.setdefault('totals', {})
+        totals[stage] = totals.get(stage, 0.0) + duration
+        self.lock.acquire()
+        try:
+            if stage not in self.stages:
+                self.stages[stage] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                  'buckets': [0] * (len(STAGE_BUCKETS) + 1)}
+            times = self.stages[stage]
+            times['count'] += 1
+            times['total'] += duration
+            times['max'] = max(times['max'], duration)
+            for pos, limit in enumerate(STAGE_BUCKETS):
+                if duration <= limit:
+                    break
+            else:
+                pos = len(STAGE_BUCKETS)
+            times['buckets'][pos] += 1
+        finally:
+            self.lock.release()
+
+    def timed(self, stage, func, *args, **kwargs):
+        """ Calls a function, adding its duration to a stage.
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(stage, time.time() - start)
+
+    def timed_apart(self, stage, nested, func, *args, **kwargs):
+        """ Calls a function, adding its duration to a stage without the time
+        spent meanwhile by the current thread in a nested stage, which is
+        reported on its own.
+        """
+        totals = self.local.__dict__.setdefault('totals', {})
+        start, before = time.time(), totals.get(nested, 0.0)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(stage, time.time() - start - \
+                            (totals.get(nested, 0.0) - before))
+
+    def summary(self):
+        """ Returns a copy of the times of the stages.
+        """
+        self.lock.acquire()
+        try:
+            return dict([(stage, dict(times, buckets=list(times['buckets']))) \
+              for stage, times in self.stages.items()])
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """ Returns the times of the stages as a list of lines of text, the
+        slowest stages first.
+        """
+        lines = []
+        stages = self.summary().items()
+        stages.sort(key=lambda item: -item[1]['total'])
+        for stage, times in stages:
+            lines.append(u'%s: %d times, %.3fs total, %.4fs avg, ' \
+              u'%.4fs max' % (stage, times['count'], times['total'],
+                              times['total'] / times['count'], times['max']))
+            buckets = []
+            for pos, count in enumerate(times['buckets']):
+                if not count:
+                    continue
+                if pos < len(STAGE_BUCKETS):
+                    buckets.append(u'<=%ss:%d' % (STAGE_BUCKETS[pos], count))
+                else:
+                    buckets.append(u'>%ss:%d' % (STAGE_BUCKETS[-1], count))
+            lines.append(u'  ' + u' '.join(buckets))
+        return lines
+
+
+class RunMetrics(object):
+    """ The fetches of an updater run. The totals are kept as the fetches are
+    added, the fetches themselves only with keep_fetches (they are written
+    to the --metrics file, one per feed).
+    """
+
+    def __init__(self, keep_fetches=True):
+        self.start = datetime.datetime.now()
+        self.start_time = time.time()
+        self.keep_fetches = keep_fetches
+        self.fetches = []
+        self.feeds = {}
+        self.entries = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stages = StageTimes()
+
+    def add(self, feed_id, feed_url, result, duration, nbytes=0, status=None,
+            entries=None):
+        """ Adds a fetch, entries is a dictionary of entry result name:
+        count.
+        """
+        entries = entries or {}
+        self.lock.acquire()
+        try:
+            self.feeds[result] = self.feeds.get(result, 0) + 1
+            for name, count in entries.items():
+                self.entries[name] = self.entries.get(name, 0) + count
+            self.bytes += nbytes
+            if self.keep_fetches:
+                self.fetches.append({
+                    'feed': feed_id,
+                    'url': feed_url,
+                    'result': result,
+                    'status': status,
+                    'duration': duration,
+                    'bytes': nbytes,
+                    'entries': entries,
+                })
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """ Returns the summary of the run as a dictionary.
+        """
+        self.lock.acquire()
+        try:
+            return {
+                'start': self.start,
+                'end': datetime.datetime.now(),
+                'duration': time.time() - self.start_time,
+                'feeds': dict(self.feeds),
+                'entries': dict(self.entries),
+                'bytes': self.bytes,
+                'fetches': list(self.fetches),
+                'stages': self.stages.summary(),
+            }
+        finally:
+            self.lock.release()
+
+    def write(self, path):
+        """ Writes the summary of the run to a file, replacing it atomically
+        so a collector never reads half of it.
+        """
+        summary = self.summary()
+        if path.endswith('.prom'):
+            data = prometheus(summary)
+        else:
+            data = simplejson.dumps(summary, cls=DjangoJSONEncoder, indent=2)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, path)
+
+
+def prometheus(summary):
+    """ Returns a run summary in the Prometheus text format.
+    """
+    lines = []
+    def metric(name, text, values):
+        lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s gauge' % (name,))
+        for labels, value in values:
+            if labels:
+                labels = '{%s}' % (','.join(['%s="%s"' % (key, val) \
+                  for key, val in labels]),)
+            lines.append('%s%s %s' % (name, labels, value))
+
+    metric('feedjack_update_last_run_timestamp_seconds',
+      'Time the last run of feedjack_update ended.',
+      [('', '%.3f' % time.mktime(summary['end'].timetuple()))])
+    metric('feedjack_update_duration_seconds',
+      'Duration of the last run of feedjack_update.',
+      [('', '%.3f' % summary['duration'])])
+    metric('feedjack_update_feeds', 'Feeds processed, by result.',
+      [([('result', result)], count) \
+        for result, count in sorted(summary['feeds'].items())])
+    metric('feedjack_update_entries', 'Entries processed, by result.',
+      [([('result', result)], count) \
+        for result, count in sorted(summary['entries'].items())])
+    metric('feedjack_update_bytes', 'Bytes downloaded.',
+      [('', summary['bytes'])])
+    fetches = sorted(summary['fetches'], key=lambda fetch: fetch['feed'])
+    metric('feedjack_feed_fetch_duration_seconds',
+      'Duration of the last fetch of a feed.',
+      [([('feed', fetch['feed'])], '%.3f' % fetch['duration']) \
+        for fetch in fetches])
+    metric('feedjack_feed_fetch_bytes', 'Size of the last fetch of a feed.',
+      [([('feed', fetch['feed'])], fetch['bytes']) for fetch in fetches])
+    metric('feedjack_feed_fetch_ok',
+      'Whether the last fetch of a feed succeeded.',
+      [([('feed', fetch['feed'])], int(fetch['result'] in OK_RESULTS)) \
+        for fetch in fetches])
+    name = 'feedjack_update_stage_seconds'
+    lines.append('# HELP %s Time spent in every stage of the last run of ' \
+      'feedjack_update.' % (name,))
+    lines.append('# TYPE %s histogram' % (name,))
+    for stage, times in sorted(summary['stages'].items()):
+        # the buckets of a Prometheus histogram are cumulative
+        count = 0
+        for limit, bucket in zip(STAGE_BUCKETS + ('+Inf',),
+                                 times['buckets']):
+            count += bucket
+            lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, stage,
+                                                              limit, count))
+        lines.append('%s_sum{stage="%s"} %.3f' % (name, stage,
+                                                 times['total']))
+        lines.append('%s_count{stage="%s"} %d' % (name, stage,
+                                                 times['count']))
+    return '\n'.join(lines) + '\n'
+
+
+#~
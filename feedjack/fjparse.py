@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjparse.py
+
+A fast parser for the well formed RSS 2.0 and Atom 1.0 feeds, used by
+"feedjack_update.py --parser fast". The document is read with iterparse and
+every entry is turned into a FeedParserDict as soon as it has been read and
+then dropped from the tree, so the whole document is never kept as a DOM and
+feedparser's encoding detection and heuristics are skipped. The result has
+the fields that feedjack_update uses, with the same names as in feedparser.
+
+Anything this parser doesn't know how to read (RSS 0.9x/1.0, xhtml content,
+an HTML element inside a field, a charset in the HTTP headers that doesn't
+match the one of the document, a document that is not well formed...) is
+parsed with feedparser instead. So is every feed when the installed feedparser
+doesn't have the private helpers used to resolve the relative URIs, sanitize
+the HTML and parse the dates as feedparser does.
+"""
+
+import re
+import codecs
+import urlparse
+from cStringIO import StringIO
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+import feedparser
+
+try:
+    from feedparser import _resolveRelativeURIs, _sanitizeHTML, _parse_date
+except ImportError:
+    # private helpers, missing in feedparser 6.0 and newer
+    _resolveRelativeURIs = _sanitizeHTML = _parse_date = None
+
+from feedjack import fjfetch
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+CONTENT = '{http://purl.org/rss/1.0/modules/content/}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+
+CHARSET = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+DECLARATION = re.compile(r'^<\?xml[^>]*encoding\s*=\s*["\']([\w.:-]+)["\']')
+# "email (Name)", the usual value of the author of an RSS item
+RSS_AUTHOR = re.compile(r'^(\S+@\S+)\s*(?:\((.*)\))?$')
+# a closing tag or an entity, how feedparser tells the RSS titles that are
+# HTML from the plain text ones
+LOOKS_LIKE_HTML = re.compile(r'</\w+>|&#?\w+;')
+
+
+class Fallback(Exception):
+    """ The feed has to be parsed by feedparser.
+    """
+
+
+def parse(response):
+    """ Parses the body of a response, with feedparser if it is not a well
+    formed RSS 2.0 or Atom 1.0 feed. The result is the same as the one of
+    fjfetch.parse, with a 'parser' key that says which parser was used.
+    """
+    body = fjfetch.decode(response)
+    try:
+        check_charset(response, body)
+        result = parse_feed(body, response.href)
+    except (Fallback, SyntaxError, LookupError, ValueError, UnicodeError):
+        # cElementTree raises a SyntaxError for the documents that are not
+        # well formed
+        result = fjfetch.parse(response)
+        result['parser'] = 'feedparser'
+        return result
+    result['parser'] = 'fast'
+    fjfetch.add_response(result, response)
+    return result
+
+def check_charset(response, body):
+    """ Raises Fallback if the charset of the HTTP headers is not the one of
+    the XML declaration, feedparser knows which one to use.
+    """
+    match = CHARSET.search(response.headers.get('content-type', ''))
+    if not match:
+        return
+    declared = DECLARATION.match(body)
+    if declared:
+        declared = declared.group(1)
+    else:
+        declared = 'utf-8'
+    if codecs.lookup(match.group(1)).name != codecs.lookup(declared).name:
+        raise Fallback
+
+def parse_feed(body, base):
+    """ Reads a feed with iterparse and returns a FeedParserDict.
+    """
+    if None in (_resolveRelativeURIs, _sanitizeHTML, _parse_date):
+        raise Fallback
+    result = feedparser.FeedParserDict()
+    result['bozo'] = 0
+    result['feed'] = feed = feedparser.FeedParserDict()
+    result['entries'] = entries = []
+
+    events = iter(ElementTree.iterparse(StringIO(body),
+                                        events=('start', 'end')))
+    root = events.next()[1]
+    if root.tag == 'rss' and root.get('version', '').startswith('2.'):
+        result['version'] = 'rss20'
+        container, item = 'channel', 'item'
+        feed_field, entry = rss_feed_field, rss_entry
+    elif root.tag == ATOM + 'feed':
+        result['version'] = 'atom10'
+        container, item = ATOM + 'feed', ATOM + 'entry'
+        feed_field, entry = atom_feed_field, atom_entry
+    else:
+        raise Fallback
+
+    # the open elements, the entries are removed from their parent when they
+    # have been read
+    stack = [root]
+    for event, elem in events:
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if not stack or stack[-1].tag != container:
+            continue
+        if elem.tag == item:
+            entries.append(entry(elem, base))
+            stack[-1].remove(elem)
+        else:
+            feed_field(feed, elem, base)
+    return result
+
+def text(elem):
+    """ Returns the text of an element that has no children.
+    """
+    if len(elem):
+        # markup that is not escaped, feedparser keeps it
+        raise Fallback
+    return unicode(elem.text or u'').strip()
+
+def private(func, *args):
+    """ Calls a private helper of feedparser with the arguments it takes in
+    feedparser 5.x, or without the last one (the content type) as in the older
+    versions. Raises Fallback if the helper takes other arguments.
+    """
+    try:
+        return func(*args)
+    except TypeError:
+        pass
+    try:
+        # feedparser older than 5.0
+        return func(*args[:-1])
+    except TypeError:
+        raise Fallback
+
+def html(elem, base):
+    """ Returns the HTML of an element, with the relative URIs resolved and
+    sanitized as feedparser does.
+    """
+    return sanitize(text(elem), base)
+
+def sanitize(value, base):
+    """ Resolves the relative URIs of some HTML and sanitizes it as feedparser
+    does.
+    """
+    if '<' not in value and '&' not in value:
+        return value
+    if feedparser.RESOLVE_RELATIVE_URIS:
+        value = private(_resolveRelativeURIs, value, base, 'utf-8',
+                        'text/html')
+    if feedparser.SANITIZE_HTML:
+        value = private(_sanitizeHTML, value, 'utf-8', 'text/html')
+    if isinstance(value, str):
+        # the sanitizer returns utf-8
+        value = value.decode('utf-8')
+    return value
+
+def set_date(data, elem, override=True):
+    """ Sets the modified_parsed of an entry or a feed from a date element.
+    """
+    if not override and 'modified_parsed' in data:
+        return
+    date = _parse_date(text(elem))
+    if date:
+        data['modified_parsed'] = date
+
+def rss_text(elem, base):
+    """ Returns the value of an RSS title, sanitized if it looks like HTML as
+    feedparser does.
+    """
+    value = text(elem)
+    if LOOKS_LIKE_HTML.search(value):
+        return sanitize(value, base)
+    return value
+
+def set_author(entry, name, email):
+    """ Sets the author and author_detail of an entry.
+    """
+    detail = feedparser.FeedParserDict()
+    if name:
+        detail['name'] = entry['author'] = name
+    elif email:
+        entry['author'] = email
+    if email:
+        detail['email'] = email
+    if detail:
+        entry['author_detail'] = detail
+
+def new_tag(term, scheme=None, label=None):
+    """ Returns a tag as in feedparser.
+    """
+    return feedparser.FeedParserDict(term=term, scheme=scheme, label=label)
+
+def rss_feed_field(feed, elem, base):
+    """ Reads an element of the channel of an RSS feed.
+    """
+    if elem.tag == 'title':
+        feed['title'] = rss_text(elem, base)
+    elif elem.tag == 'link':
+        feed['link'] = urlparse.urljoin(base, text(elem))
+    elif elem.tag == 'description':
+        feed['subtitle'] = html(elem, base)
+    elif elem.tag in ('lastBuildDate', 'pubDate', DC + 'date'):
+        set_date(feed, elem, elem.tag == 'lastBuildDate')
+
+def rss_entry(elem, base):
+    """ Returns the FeedParserDict of an RSS item.
+    """
+    entry = feedparser.FeedParserDict()
+    tags = []
+    permalink = None
+    for child in elem:
+        tag = child.tag
+        if tag == 'title':
+            entry['title'] = rss_text(child, base)
+        elif tag == 'link':
+            entry['link'] = urlparse.urljoin(base, text(child))
+        elif tag == 'guid':
+            entry['id'] = text(child)
+            if child.get('isPermaLink', 'true').lower() != 'false':
+                permalink = entry['id']
+        elif tag == 'description':
+            entry['summary'] = html(child, base)
+        elif tag == CONTENT + 'encoded':
+            entry['content'] = [feedparser.FeedParserDict(
+              value=html(child, base), type='text/html')]
+        elif tag in ('pubDate', DC + 'date'):
+            set_date(entry, child, False)
+        elif tag == 'author':
+            value = text(child)
+            match = RSS_AUTHOR.match(value)
+            if match:
+                set_author(entry, match.group(2), match.group(1))
+            else:
+                set_author(entry, value, None)
+        elif tag == DC + 'creator' and 'author' not in entry:
+            set_author(entry, text(child), None)
+        elif tag in ('category', DC + 'subject'):
+            term = text(child)
+            if term:
+                tags.append(new_tag(term, child.get('domain')))
+        elif tag == 'comments':
+            entry['comments'] = urlparse.urljoin(base, text(child))
+    if permalink and 'link' not in entry:
+        entry['link'] = urlparse.urljoin(base, permalink)
+    if tags:
+        entry['tags'] = tags
+    return entry
+
+def atom_text(elem, base):
+    """ Returns the value of an Atom text construct.
+    """
+    kind = elem.get('type', 'text')
+    if kind == 'html':
+        return html(elem, base)
+    if kind == 'text':
+        return text(elem)
+    # xhtml
+    raise Fallback
+
+def atom_link(elem, base):
+    """ Returns the URL of an alternate Atom link or None.
+    """
+    if elem.get('rel', 'alternate') == 'alternate' and elem.get('href'):
+        return urlparse.urljoin(base, elem.get('href'))
+    return None
+
+def atom_feed_field(feed, elem, base):
+    """ Reads an element of an Atom feed.
+    """
+    if elem.tag == ATOM + 'title':
+        feed['title'] = atom_text(elem, base)
+    elif elem.tag == ATOM + 'link' and 'link' not in feed:
+        link = atom_link(elem, base)
+        if link:
+            feed['link'] = link
+    elif elem.tag == ATOM + 'subtitle':
+        feed['subtitle'] = atom_text(elem, base)
+    elif elem.tag == ATOM + 'updated':
+        set_date(feed, elem)
+
+def atom_entry(elem, base):
+    """ Returns the FeedParserDict of an Atom entry.
+    """
+    entry = feedparser.FeedParserDict()
+    tags = []
+    for child in elem:
+        tag = child.tag
+        if tag == ATOM + 'title':
+            entry['title'] = atom_text(child, base)
+        elif tag == ATOM + 'link' and 'link' not in entry:
+            link = atom_link(child, base)
+            if link:
+                entry['link'] = link
+        elif tag == ATOM + 'id':
+            entry['id'] = text(child)
+        elif tag == ATOM + 'summary':
+            entry['summary'] = atom_text(child, base)
+        elif tag == ATOM + 'content':
+            if child.get('src'):
+                continue
+            entry['content'] = [feedparser.FeedParserDict(
+              value=atom_text(child, base),
+              type=child.get('type') == 'html' and 'text/html' or \
+                   'text/plain')]
+        elif tag == ATOM + 'updated':
+            set_date(entry, child)
+        elif tag == ATOM + 'published':
+            set_date(entry, child, False)
+        elif tag == ATOM + 'author':
+            name = child.find(ATOM + 'name')
+            email = child.find(ATOM + 'email')
+            set_author(entry, name is not None and text(name) or None,
+                       email is not None and text(email) or None)
+        elif tag == ATOM + 'category':
+            if child.get('term'):
+                tags.append(new_tag(child.get('term'), child.get('scheme'),
+                                    child.get('label')))
+    if tags:
+        entry['tags'] = tags
+    return entry
+
+
+#~
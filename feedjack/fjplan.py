@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjplan.py
+
+Checks of the SQLite query plans of feedjack's hot queries, used by
+feedjack_plancheck.py on a big generated database and by the tests.
+
+A plan has a problem when it reads a whole post table: a SCAN of
+feedjack_post, feedjack_post_tags or feedjack_timelineentry (or of an alias
+of one of them) without an index, or with an index inside a subquery, where
+there is no LIMIT to stop the scan. The outer SCAN of a table through an
+index is how the sorted listings are read and is allowed, but a listing that
+should come from an index must not sort its result.
+"""
+
+import re
+
+from django.db import connection
+
+from feedjack import models
+from feedjack import fjlib
+from feedjack import fjcloud
+
+BIG_TABLES = ('feedjack_post', 'feedjack_post_tags', 'feedjack_timelineentry')
+
+# "SCAN TABLE feedjack_post AS dupe USING INDEX ..." in the old versions of
+# SQLite, "SCAN dupe USING INDEX ..." in the new ones
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?( USING .*)?$')
+# the aliases of the tables in a statement, as in '"feedjack_post" dupe'
+ALIAS = re.compile(r'"?(%s)"?\s+(?:AS\s+)?(\w+)' % ('|'.join(BIG_TABLES),),
+                   re.I)
+SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+
+class RecordingCursor:
+    """ Cursor wrapper that remembers every statement executed through it.
+    """
+    def __init__(self, cursor, log):
+        self.cursor = cursor
+        self.log = log
+
+    def execute(self, sql, params=()):
+        self.log.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+
+def explain(sql, params):
+    """ Returns the SQLite query plan of a statement as a list of (line, in
+    a subquery) tuples.
+    """
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+    rows = cursor.fetchall()
+    details = dict([(row[0], row[-1]) for row in rows])
+    parents = dict([(row[0], row[1]) for row in rows])
+    plan = []
+    for row in rows:
+        subquery, parent = False, row[1]
+        while parent in details:
+            if 'SUBQUERY' in details[parent]:
+                subquery = True
+            parent = parents[parent]
+        plan.append((row[-1].strip(), subquery))
+    return plan
+
+def big_names(sql):
+    """ Returns the names of the big tables and of their aliases in a
+    statement.
+    """
+    names = set(BIG_TABLES)
+    for table, alias in ALIAS.findall(sql):
+        names.add(alias)
+    return names
+
+def record(func):
+    """ Runs a function and returns the SELECT statements it executed.
+    """
+    log = []
+    orig_cursor = connection.cursor
+    connection.cursor = lambda: RecordingCursor(orig_cursor(), log)
+    try:
+        func()
+    finally:
+        connection.cursor = orig_cursor
+    return [(sql, params) for sql, params in log \
+      if sql.lstrip().upper().startswith('SELECT')]
+
+def check(name, func, sorted_listing=False, verbose=False):
+    """ Checks the plans of the queries executed by a function.
+
+    Returns a list of error strings.
+    """
+    errors = []
+    for sql, params in record(func):
+        plan = explain(sql, params)
+        if verbose:
+            print '%s:\n  %s\n  %s' % (name, sql,
+              '\n  '.join([line for line, subquery in plan]))
+        names = big_names(sql)
+        for line, subquery in plan:
+            match = SCAN.match(line)
+            if not match or not names.intersection(match.group(1, 2)):
+                continue
+            if not match.group(3) or subquery:
+                errors.append('%s: full table scan (%s)\n  %s' % (name,
+                  line, sql))
+        # only the statement with the LIMIT is a listing, the other is the
+        # paginator's COUNT
+        if sorted_listing and ' LIMIT ' in sql.upper() and \
+          SORT in [line for line, subquery in plan]:
+            errors.append('%s: sorts the result instead of reading it from ' \
+              'an index\n  %s' % (name, sql))
+    return errors
+
+def checks(site, user_site, created_site):
+    """ Returns the list of (name, function, sorted listing) to check.
+    """
+    def sfeeds(site):
+        sfeeds_obj = fjlib.sitefeeds(site)
+        return sfeeds_obj, [sub.feed.id for sub in sfeeds_obj]
+    sfeeds_obj, sfeeds_ids = sfeeds(site)
+    created_ids = sfeeds(created_site)[1]
+    user = created_ids[0]
+    tag = models.Tag.objects.all()[0].name
+    page = list(fjlib.get_paginator(site, sfeeds_ids)[1])
+
+    def extra_content():
+        ctx = {}
+        fjlib.get_extra_content(site, sfeeds_ids, ctx)
+        list(ctx['feeds'])
+
+    def listing(site, sfeeds_ids, **kwargs):
+        # the page is a lazy queryset, evaluate it to run the listing query
+        return lambda: list(fjlib.get_paginator(site, sfeeds_ids,
+                                                **kwargs)[1])
+
+    return [
+      ('get_paginator (river)', listing(site, sfeeds_ids), True),
+      ('get_paginator (deep page)', listing(site, sfeeds_ids, page=50), True),
+      ('get_paginator (user)', listing(site, sfeeds_ids, user=user), True),
+      ('get_paginator (tag)', listing(site, sfeeds_ids, tag=tag), False),
+      ('get_paginator (user, date created)',
+        listing(created_site, created_ids, user=user), True),
+      ('get_paginator (small site)',
+        listing(user_site, sfeeds(user_site)[1]), False),
+      ('exclude_duplicates', lambda: list(fjlib.exclude_duplicates( \
+        models.Post.objects.filter(feed__in=created_ids), created_ids) \
+        .values_list('id', flat=True)[:1]), False),
+      ('get_posts_tags',
+        lambda: fjlib.get_posts_tags(page, sfeeds_obj, None, None), False),
+      ('get_extra_content', extra_content, False),
+      ('fjcloud.cloudata', lambda: fjcloud.cloudata(site), False),
+    ]
+
+def check_all(site, user_site, created_site, verbose=False):
+    """ Checks the plans of all the hot queries against a database filled by
+    fjdataset.generate, with three sites. created_site is sorted by the date
+    the posts were created. Returns a list of error strings.
+    """
+    created_site.order_posts_by = 2
+    errors = []
+    for name, func, sorted_listing in checks(site, user_site, created_site):
+        errors.extend(check(name, func, sorted_listing, verbose))
+    return errors
+
+
+#~
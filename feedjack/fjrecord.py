@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjrecord.py
+
+Record and replay of the feed downloads. "feedjack_update.py --record DIR"
+keeps every response (or download error) in an archive in DIR, and
+"feedjack_update.py --replay DIR" updates the feeds from the archive without
+using the network, to reproduce a run or to profile it offline.
+
+The archive has two files that are only appended to, so later runs can
+record to the same archive:
+
+    bodies: the zlib compressed bodies, one after the other.
+    index: a JSON object per line with the url, date, status, headers and
+           error of every download and the offset and length of its body.
+
+The index line is written after the body, a run that is interrupted never
+leaves a line without its body. When a feed was recorded several times, the
+replay serves the recorded responses in order and then repeats the last one.
+"""
+
+import os
+import zlib
+import time
+import threading
+
+from django.utils import simplejson
+
+from feedjack import fjfetch
+
+INDEX = 'index'
+BODIES = 'bodies'
+
+
+class Recorder(object):
+    """ Downloads the feeds with another fetcher and records the responses.
+    """
+
+    def __init__(self, directory, fetcher):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.fetcher = fetcher
+        self.lock = threading.Lock()
+        self.index = open(os.path.join(directory, INDEX), 'a')
+        self.bodies = open(os.path.join(directory, BODIES), 'ab')
+
+    def fetch(self, url, etag=None):
+        try:
+            response = self.fetcher.fetch(url, etag)
+        except fjfetch.FetchError, err:
+            self.write({'url': url, 'etag': etag, 'error': str(err)}, '')
+            raise
+        self.write({'url': url, 'etag': etag, 'status': response.status,
+                    'headers': response.headers, 'href': response.href},
+                   response.body)
+        return response
+
+    def write(self, record, body):
+        """ Appends a body and its index line to the archive.
+        """
+        data = zlib.compress(body)
+        record['date'] = time.time()
+        self.lock.acquire()
+        try:
+            self.bodies.seek(0, 2)
+            record['offset'] = self.bodies.tell()
+            record['length'] = len(data)
+            self.bodies.write(data)
+            self.bodies.flush()
+            self.index.write(simplejson.dumps(record) + '\n')
+            self.index.flush()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.fetcher.close()
+        self.index.close()
+        self.bodies.close()
+
+
+class Replayer(object):
+    """ Serves the responses of an archive.
+    """
+
+    def __init__(self, directory):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.positions = {}
+        index = open(os.path.join(directory, INDEX))
+        try:
+            for line in index:
+                try:
+                    record = simplejson.loads(line)
+                except ValueError:
+                    # the last line of an interrupted run
+                    continue
+                self.records.setdefault(record['url'], []).append(record)
+        finally:
+            index.close()
+        self.bodies = open(os.path.join(directory, BODIES), 'rb')
+
+    def fetch(self, url, etag=None):
+        self.lock.acquire()
+        try:
+            records = self.records.get(url)
+            if not records:
+                raise fjfetch.FetchError('%s is not in the archive' % (url,))
+            position = self.positions.get(url, 0)
+            self.positions[url] = position + 1
+            record = records[min(position, len(records) - 1)]
+            self.bodies.seek(record['offset'])
+            data = self.bodies.read(record['length'])
+        finally:
+            self.lock.release()
+        if record.get('error'):
+            raise fjfetch.FetchError(record['error'])
+        return fjfetch.Response(url, record['status'], record['headers'],
+                                zlib.decompress(data), record['href'])
+
+    def close(self):
+        self.bodies.close()
+
+
+#~
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjretention.py
+
+Retention of the posts. Every feed keeps its posts for keep_days days and
+at most keep_posts posts, or the limits of the sites it is subscribed to if
+it has no limits of its own. feedjack_prune moves the older posts to the
+ArchivedPost table (or only keeps their guid there), removing them from the
+post, tag, timeline and search tables.
+"""
+
+import datetime
+
+from feedjack import models
+from feedjack import fjlib
+from feedjack import fjsearch
+from feedjack import fjrouter
+from feedjack import fjjournal
+
+
+def site_limit(values):
+    """ Returns the most generous of the limits of the sites of a feed, None
+    if one of them keeps everything.
+    """
+    if not values or None in values:
+        return None
+    return max(values)
+
+def policy(feed):
+    """ Returns the (keep_days, keep_posts) limits of a feed.
+    """
+    sites = [sub.site for sub in \
+      models.Subscriber.objects.filter(feed=feed).select_related()]
+    keep_days, keep_posts = feed.keep_days, feed.keep_posts
+    if keep_days is None:
+        keep_days = site_limit([site.keep_days for site in sites])
+    if keep_posts is None:
+        keep_posts = site_limit([site.keep_posts for site in sites])
+    return keep_days, keep_posts
+
+def expired_ids(feed, keep_days=None, keep_posts=None, now=None):
+    """ Returns the ids of the posts of a feed that are beyond its limits.
+    """
+    posts = models.Post.objects.filter(feed=feed)
+    ids = set()
+    if keep_days is not None:
+        if now is None:
+            now = datetime.datetime.now()
+        ids.update(posts.filter(date_modified__lt=now - \
+          datetime.timedelta(days=keep_days)).values_list('id', flat=True))
+    if keep_posts is not None:
+        ids.update(posts.order_by('-date_modified', '-id') \
+          .values_list('id', flat=True)[keep_posts:])
+    return sorted(ids)
+
+def archived_guids(feed, guids):
+    """ Returns the guids of a list that belong to archived posts of a feed.
+    """
+    archived = set()
+    guids = list(guids)
+    for offset in range(0, len(guids), 500):
+        archived.update(models.ArchivedPost.objects.filter(feed=feed, \
+          guid__in=guids[offset:offset + 500]).values_list('guid', flat=True))
+    return archived
+
+def archive_posts(ids, keep_data=True):
+    """ Moves a list of posts to the archive, in a single transaction.
+    """
+    if keep_data:
+        tagd = {}
+        for post_id, name in fjlib.get_tag_names(ids):
+            tagd.setdefault(post_id, []).append(name)
+    for post in models.Post.objects.filter(id__in=ids):
+        if models.ArchivedPost.objects.filter(feed=post.feed_id, \
+          guid=post.guid).count():
+            continue
+        archived = models.ArchivedPost(feed_id=post.feed_id, guid=post.guid)
+        if keep_data:
+            archived.title = post.title
+            archived.link = post.link
+            archived.content = post.content
+            archived.date_modified = post.date_modified
+            archived.author = post.author
+            archived.author_email = post.author_email
+            archived.comments = post.comments
+            archived.tags = u'\n'.join(tagd.get(post.id, []))
+            archived.date_created = post.date_created
+        archived.save()
+    delete_posts(ids)
+archive_posts = fjrouter.commit_on_success(archive_posts)
+
+def delete_posts(ids):
+    """ Deletes a list of posts and the rows that point to them.
+
+    Raw SQL is used so the posts are not loaded to be deleted one by one.
+    """
+    fjjournal.record_deleted(ids)
+    fjsearch.unindex_posts(ids)
+    ids = ', '.join([str(int(post_id)) for post_id in ids])
+    cursor = fjrouter.connection_for_write().cursor()
+    # the duplicates of the deleted posts are shown again
+    cursor.execute('UPDATE feedjack_post SET canonical_id = NULL ' \
+      'WHERE canonical_id IN (%s)' % (ids,))
+    for table, column in (('feedjack_timelineentry', 'post_id'),
+                          ('feedjack_post_tags', 'post_id'),
+                          ('feedjack_post', 'id')):
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (table, column, \
+          ids))
+
+def prune_feed(feed, batch=500, keep_data=True, dry_run=False, now=None):
+    """ Archives the posts of a feed that are beyond its limits. Returns the
+    number of archived posts.
+    """
+    keep_days, keep_posts = policy(feed)
+    if keep_days is None and keep_posts is None:
+        return 0
+    ids = expired_ids(feed, keep_days, keep_posts, now)
+    if not dry_run:
+        for offset in range(0, len(ids), batch):
+            archive_posts(ids[offset:offset + batch], keep_data)
+    return len(ids)
+
+
+#~
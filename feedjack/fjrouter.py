@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjrouter.py
+
+Database router that sends feedjack's reads to a set of replicas and its
+writes to the primary database. To use it (django 1.2 or newer):
+
+    DATABASES = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': 'primary.db'},
+        'replica': {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': 'replica.db',
+                    'TEST_MIRROR': 'default'},
+    }
+    DATABASE_ROUTERS = ['feedjack.fjrouter.FeedjackRouter']
+    FEEDJACK_DB_PRIMARY = 'default'
+    FEEDJACK_DB_REPLICAS = ('replica',)
+    FEEDJACK_REPLICA_LAG = 60
+
+These two local SQLite databases are enough to try the router, and the
+RouterTest of the tests ("django-admin.py test feedjack") checks its routes
+with them. The replica has to be filled by copying primary.db, there is no
+replication between them, and TEST_MIRROR makes the tests use the primary
+as the replica.
+
+feedjack_update sends all of its queries to the primary. After the updater
+invalidates the cache of a site, the pages of that site are rebuilt from the
+primary for FEEDJACK_REPLICA_LAG seconds so they don't get cached with data
+the replicas haven't seen yet.
+"""
+
+import random
+import threading
+
+from django.conf import settings
+
+# Set by feedjack_update, every query goes to the primary database.
+PRIMARY_ONLY = False
+
+_state = threading.local()
+
+
+def primary():
+    """ Returns the alias of the primary database.
+    """
+    return getattr(settings, 'FEEDJACK_DB_PRIMARY', 'default')
+
+def replicas():
+    """ Returns the aliases of the replica databases.
+    """
+    return getattr(settings, 'FEEDJACK_DB_REPLICAS', ())
+
+def use_primary(value=True):
+    """ Sends (or stops sending) the reads of the current thread to the
+    primary database.
+    """
+    _state.pinned = value
+
+def read_alias():
+    """ Returns the alias of the database the next read should go to.
+    """
+    dbs = replicas()
+    if PRIMARY_ONLY or getattr(_state, 'pinned', False) or not dbs:
+        return primary()
+    return random.choice(dbs)
+
+def get_connection(alias):
+    """ Returns the connection for a database alias.
+
+    django.db is imported here and not at the top of the module because
+    django imports the routers while django.db is being loaded.
+    """
+    try:
+        from django.db import connections
+    except ImportError:
+        # django without multiple database support, everything goes through
+        # the default connection
+        from django.db import connection
+        return connection
+    return connections[alias]
+
+def connection_for_read():
+    """ Returns a connection for the raw SQL reads.
+    """
+    return get_connection(read_alias())
+
+def connection_for_write():
+    """ Returns a connection to the primary database for the raw SQL used
+    when writing.
+    """
+    return get_connection(primary())
+
+def commit_on_success(func):
+    """ Wraps a function in a transaction of the primary database.
+    """
+    from django.db import transaction
+    try:
+        return transaction.commit_on_success(using=primary())(func)
+    except TypeError:
+        # django without multiple database support
+        return transaction.commit_on_success(func)
+
+def on_primary(name, *args):
+    """ Calls a function of django.db.transaction on the primary database.
+    """
+    from django.db import transaction
+    try:
+        return getattr(transaction, name)(*args, **{'using': primary()})
+    except TypeError:
+        # django without multiple database support
+        return getattr(transaction, name)(*args)
+
+def savepoint():
+    """ Creates a savepoint in the transaction of the primary database and
+    returns its id.
+    """
+    return on_primary('savepoint')
+
+def savepoint_commit(sid):
+    """ Releases a savepoint of the primary database.
+    """
+    on_primary('savepoint_commit', sid)
+
+def savepoint_rollback(sid):
+    """ Rolls the primary database back to a savepoint.
+    """
+    on_primary('savepoint_rollback', sid)
+
+def commit_unless_managed():
+    """ Commits the primary database if it is not in a managed transaction.
+    """
+    on_primary('commit_unless_managed')
+
+
+class FeedjackRouter(object):
+    """ Routes the models of the feedjack application. Other applications
+    are left to the next router or the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'feedjack':
+            return None
+        return read_alias()
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'feedjack':
+            return None
+        return primary()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same data than the primary
+        if obj1._meta.app_label == 'feedjack' and \
+          obj2._meta.app_label == 'feedjack':
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if model._meta.app_label != 'feedjack':
+            return None
+        return db == primary()
+
+
+#~
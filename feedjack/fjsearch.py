@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjsearch.py
+
+Full text search over the posts of a site.
+
+Every word of a post is stored once in SearchTerm, and every (term, post)
+pair in SearchPosting with the number of times the word appears in the post
+(words in the title count more). feedjack_update indexes the posts as it
+writes them. The search only reads the postings of the query's terms, and
+ranks the posts that have all of them by tf-idf.
+"""
+
+import re
+import math
+
+from django.db import IntegrityError
+from django.core.paginator import InvalidPage
+from django.http import Http404
+from django.utils.encoding import force_unicode
+from django.utils.html import strip_tags
+
+from feedjack import models
+from feedjack import fjlib
+from feedjack import fjrouter
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+ENTITY_RE = re.compile(r'&#?\w+;')
+
+# a word in the title counts as many words in the content
+TITLE_WEIGHT = 3
+MIN_LENGTH = 2
+MAX_LENGTH = 50
+MAX_QUERY_TERMS = 10
+
+STOPWORDS = set(u"""
+a an and are as at be but by for from has have he her his i if in into is it
+its of on or our she so than that the their them then there these they this
+to was we were what when which who will with you your
+""".split())
+
+
+def tokenize(text):
+    """ Returns the list of words in a text (HTML or plain), lowercased.
+    """
+    text = ENTITY_RE.sub(u' ', strip_tags(force_unicode(text or u'')))
+    return [word for word in WORD_RE.findall(text.lower()) \
+      if MIN_LENGTH <= len(word) <= MAX_LENGTH and word not in STOPWORDS]
+
+def post_terms(post):
+    """ Returns a dictionary with the weight of every word in a post.
+    """
+    terms = {}
+    for weight, text in ((TITLE_WEIGHT, post.title), (1, post.content)):
+        for word in tokenize(text):
+            terms[word] = terms.get(word, 0) + weight
+    return terms
+
+def get_terms(words):
+    """ Returns a dictionary of word: term id, the terms that don't exist
+    are created.
+    """
+    termd = {}
+    words = list(words)
+    # keep the number of parameters below the backend limits
+    for offset in range(0, len(words), 500):
+        for term in models.SearchTerm.objects.filter( \
+          term__in=words[offset:offset + 500]):
+            termd[term.term] = term.id
+    for word in words:
+        if word in termd:
+            continue
+        term = models.SearchTerm(term=word)
+        # the post is saved in a transaction (see feedjack_update), a
+        # savepoint keeps it usable if the insert fails
+        sid = fjrouter.savepoint()
+        try:
+            term.save()
+            fjrouter.savepoint_commit(sid)
+        except IntegrityError:
+            # another thread of the updater created it
+            fjrouter.savepoint_rollback(sid)
+            term = models.SearchTerm.objects.get(term=word)
+        termd[word] = term.id
+    return termd
+
+def unindex_posts(ids):
+    """ Removes the postings of a list of posts.
+    """
+    if not ids:
+        return
+    ids = ', '.join([str(int(post_id)) for post_id in ids])
+    cursor = fjrouter.connection_for_write().cursor()
+    cursor.execute("""
+      UPDATE feedjack_searchterm SET post_count = post_count -
+        (SELECT COUNT(*) FROM feedjack_searchposting
+         WHERE feedjack_searchposting.term_id = feedjack_searchterm.id AND
+         feedjack_searchposting.post_id IN (%s))
+      WHERE id IN (SELECT term_id FROM feedjack_searchposting
+                   WHERE post_id IN (%s))""" % (ids, ids))
+    cursor.execute('DELETE FROM feedjack_searchposting WHERE post_id IN ' \
+      '(%s)' % (ids,))
+
+def unindex_post(post):
+    """ Removes the postings of a post.
+    """
+    unindex_posts([post.id])
+
+def index_post(post):
+    """ Writes the postings of a new or updated post.
+    """
+    unindex_post(post)
+    terms = post_terms(post)
+    if terms:
+        termd = get_terms(terms.keys())
+        cursor = fjrouter.connection_for_write().cursor()
+        cursor.executemany("""
+          INSERT INTO feedjack_searchposting (term_id, post_id, feed_id, weight)
+          VALUES (%s, %s, %s, %s)""", [(termd[word], post.id, post.feed_id, \
+          weight) for word, weight in terms.items()])
+        # the increment is done by the database, so concurrent updaters
+        # don't lose counts
+        cursor.execute("""
+          UPDATE feedjack_searchterm SET post_count = post_count + 1
+          WHERE id IN (%s)""" % ', '.join(['%s'] * len(termd)), \
+          termd.values())
+    fjrouter.commit_unless_managed()
+
+def reindex(feed=None, batch=1000):
+    """ Indexes all the posts (or the posts of a feed). Returns the number
+    of indexed posts.
+    """
+    posts = models.Post.objects.order_by('id')
+    if feed is not None:
+        posts = posts.filter(feed=feed)
+    count, last_id = 0, 0
+    while True:
+        chunk = list(posts.filter(id__gt=last_id)[:batch])
+        if not chunk:
+            return count
+        for post in chunk:
+            index_post(post)
+        count += len(chunk)
+        last_id = chunk[-1].id
+
+def parse_query(query):
+    """ Returns the list of words of a query, without duplicates.
+    """
+    words = []
+    for word in tokenize(query):
+        if word not in words:
+            words.append(word)
+    return words[:MAX_QUERY_TERMS]
+
+
+class SearchResults(object):
+    """ The posts that match a query in a set of feeds, best first.
+
+    It has the count and slicing interface of a queryset, so it can be
+    paginated, and only reads the rows of the requested page.
+    """
+
+    def __init__(self, query, sfeeds_ids, total=None, site=None):
+        self.site = site
+        self.terms = {}
+        self.sfeeds_ids = list(sfeeds_ids)
+        self._count = None
+        words = parse_query(query)
+        if not words or not self.sfeeds_ids:
+            return
+        terms = models.SearchTerm.objects.filter(term__in=words)
+        if len(terms) < len(words):
+            # one of the words is in no post
+            return
+        if not total:
+            total = max([term.post_count for term in terms])
+        for term in terms:
+            self.terms[term.id] = math.log(1.0 + float(total) / \
+              max(term.post_count, 1))
+
+    def matches_sql(self):
+        """ Returns the SQL and parameters of the matching posts with their
+        score.
+        """
+        score = ' '.join(['WHEN %d THEN %r' % item \
+          for item in self.terms.items()])
+        sql = """
+          SELECT post_id, SUM(weight * CASE term_id %s END) AS score
+          FROM feedjack_searchposting
+          WHERE term_id IN (%s) AND feed_id IN (%s)
+          GROUP BY post_id
+          HAVING COUNT(*) = %d""" % (score, \
+            ', '.join(['%s'] * len(self.terms)), \
+            ', '.join(['%s'] * len(self.sfeeds_ids)), len(self.terms))
+        return sql, self.terms.keys() + self.sfeeds_ids
+
+    def count(self):
+        if self._count is None:
+            if not self.terms:
+                self._count = 0
+            else:
+                sql, params = self.matches_sql()
+                cursor = fjrouter.connection_for_read().cursor()
+                cursor.execute('SELECT COUNT(*) FROM (%s) matches' % sql, \
+                  params)
+                self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        if not self.terms:
+            return []
+        start = key.start or 0
+        sql, params = self.matches_sql()
+        sql += ' ORDER BY score DESC, post_id DESC'
+        if key.stop is not None:
+            sql += ' LIMIT %d OFFSET %d' % (key.stop - start, start)
+        cursor = fjrouter.connection_for_read().cursor()
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+        posts = models.Post.objects.filter(id__in=ids).select_related()
+        if self.site:
+            posts = fjlib.defer_content(posts, self.site)
+        posts = dict([(post.id, post) for post in posts])
+        return [posts[post_id] for post_id in ids if post_id in posts]
+
+
+def get_paginator(site, sfeeds_ids, query, page=0):
+    """ Returns a paginator object and the requested page of the results of
+    a query in a site.
+    """
+    results = SearchResults(query, sfeeds_ids, \
+      fjlib.site_summary(site).post_count, site)
+    paginator = fjlib.ObjectPaginator(results, site.posts_per_page)
+    try:
+        object_list = paginator.get_page(page)
+    except InvalidPage:
+        if page == 0:
+            object_list = []
+        else:
+            raise Http404
+    return (paginator, object_list)
+
+
+#~
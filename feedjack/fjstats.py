@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjstats.py
+
+Instrumentation of the feedjack views. To use it add the middleware before
+the other ones:
+
+    MIDDLEWARE_CLASSES = (
+        'feedjack.fjstats.StatsMiddleware',
+        ...
+    )
+
+For every request it counts the queries and their time, the fjcache hits and
+misses by key type and the time spent in the sections of the views (site
+summary, pagination, post tags, tag cloud and rendering, the tag cloud is
+built while rendering so it is also part of the render time). With DEBUG the
+numbers of the request are sent in X-Feedjack-* headers, and the totals of
+the process are served as JSON by the /stats/ view to the INTERNAL_IPS.
+"""
+
+import time
+import datetime
+import threading
+
+from django.conf import settings
+
+# set when the middleware is loaded, nothing is recorded otherwise
+ENABLED = False
+
+_state = threading.local()
+_lock = threading.Lock()
+_totals = {}
+
+
+class CursorWrapper(object):
+    """ A cursor that counts and times the queries of the current request.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            query_done(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            query_done(time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def install():
+    """ Wraps the cursors of the database connections, the queries are only
+    counted while a request is being recorded.
+    """
+    global ENABLED
+    _lock.acquire()
+    try:
+        if ENABLED:
+            return
+        from django.db.backends import BaseDatabaseWrapper
+        cursor = BaseDatabaseWrapper.cursor
+        def stats_cursor(self):
+            if getattr(_state, 'request', None) is None:
+                return cursor(self)
+            return CursorWrapper(cursor(self))
+        BaseDatabaseWrapper.cursor = stats_cursor
+        _totals.update(new_stats())
+        _totals['started'] = datetime.datetime.now()
+        ENABLED = True
+    finally:
+        _lock.release()
+
+def new_stats():
+    """ Returns an empty set of counters.
+    """
+    return {'requests': 0, 'time': 0.0, 'queries': 0, 'query_time': 0.0,
+            'cache': {}, 'sections': {}}
+
+def current():
+    """ Returns the counters of the request being recorded in this thread,
+    or None.
+    """
+    return getattr(_state, 'request', None)
+
+def begin():
+    """ Starts recording a request in this thread.
+    """
+    _state.request = new_stats()
+    _state.start = time.time()
+
+def end():
+    """ Stops recording the request of this thread, adds its counters to the
+    totals and returns them, or None if no request was being recorded.
+    """
+    stats = current()
+    if stats is None:
+        return None
+    _state.request = None
+    stats['time'] = time.time() - _state.start
+    add_totals(stats)
+    return stats
+
+def query_done(duration):
+    """ Records a query of the current request.
+    """
+    stats = current()
+    if stats is not None:
+        stats['queries'] += 1
+        stats['query_time'] += duration
+
+def cache_access(name, hit):
+    """ Records a lookup of a type of fjcache key.
+    """
+    stats = current()
+    if stats is not None:
+        counts = stats['cache'].setdefault(name, {'hits': 0, 'misses': 0})
+        if hit:
+            counts['hits'] += 1
+        else:
+            counts['misses'] += 1
+
+def timed(section, func, *args, **kwargs):
+    """ Calls a function, adding its duration to a section of the current
+    request.
+    """
+    stats = current()
+    if stats is None:
+        return func(*args, **kwargs)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        times = stats['sections'].setdefault(section,
+          {'count': 0, 'time': 0.0, 'max': 0.0})
+        duration = time.time() - start
+        times['count'] += 1
+        times['time'] += duration
+        times['max'] = max(times['max'], duration)
+
+def add_totals(stats):
+    """ Adds the counters of a request to the totals of the process.
+    """
+    _lock.acquire()
+    try:
+        _totals['requests'] += 1
+        for key in ('time', 'queries', 'query_time'):
+            _totals[key] += stats[key]
+        for name, counts in stats['cache'].items():
+            total = _totals['cache'].setdefault(name, {'hits': 0,
+                                                       'misses': 0})
+            total['hits'] += counts['hits']
+            total['misses'] += counts['misses']
+        for section, times in stats['sections'].items():
+            total = _totals['sections'].setdefault(section,
+              {'count': 0, 'time': 0.0, 'max': 0.0})
+            total['count'] += times['count']
+            total['time'] += times['time']
+            total['max'] = max(total['max'], times['max'])
+    finally:
+        _lock.release()
+
+def totals():
+    """ Returns a copy of the totals of the process.
+    """
+    _lock.acquire()
+    try:
+        data = dict(_totals)
+        data['cache'] = dict([(name, dict(counts)) \
+          for name, counts in _totals['cache'].items()])
+        data['sections'] = dict([(section, dict(times)) \
+          for section, times in _totals['sections'].items()])
+    finally:
+        _lock.release()
+    return data
+
+def headers(stats):
+    """ Returns the debug headers of the counters of a request.
+    """
+    return {
+        'X-Feedjack-Time': '%.4f' % stats['time'],
+        'X-Feedjack-Queries': '%d (%.4fs)' % (stats['queries'],
+                                             stats['query_time']),
+        'X-Feedjack-Cache': ' '.join(['%s=%d/%d' % (name, counts['hits'],
+          counts['hits'] + counts['misses']) \
+          for name, counts in sorted(stats['cache'].items())]),
+        'X-Feedjack-Sections': ' '.join(['%s=%.4f' % (section,
+          times['time']) for section, times in \
+          sorted(stats['sections'].items())]),
+    }
+
+
+class StatsMiddleware(object):
+    """ Records the counters of every request.
+    """
+
+    def __init__(self):
+        install()
+
+    def process_request(self, request):
+        begin()
+
+    def process_response(self, request, response):
+        stats = end()
+        if stats is None:
+            return response
+        if settings.DEBUG:
+            for header, value in headers(stats).items():
+                response[header] = value
+        return response
+
+
+#~
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjtimeline.py
+
+The precomputed timelines of the sites that use one (Site.use_timeline).
+
+Building the timeline of a big site takes too long for a request, so saving
+a site that turns its timeline on or off only flags it (Site.timeline_ready
+is cleared), and feedjack_update builds or drops the timelines of the
+flagged sites with rebuild_pending, at the start of a run or with
+--rebuild-timeline. The listings only read a timeline once it is ready, and
+the posts are only added to the timelines that are ready, a timeline being
+rebuilt gets them from the rebuild.
+"""
+
+from feedjack import models
+from feedjack import fjlib
+from feedjack import fjrouter
+
+
+def add_entries(site_id, post, tags):
+    """ Adds the river entry and the tag entries of a post to a site.
+    """
+    for tag in [None] + list(tags):
+        models.TimelineEntry(site_id=site_id, tag=tag, feed_id=post.feed_id,
+          post=post, date_modified=post.date_modified,
+          date_created=post.date_created).save()
+
+def index_post(post, tags=None):
+    """ Writes the timeline entries of a new or updated post.
+
+    The entries are written in every site that uses a timeline and has an
+    active subscriber for the post's feed, unless the site also has the
+    post's canonical post (see fjdupes.py).
+    """
+    models.TimelineEntry.objects.filter(post=post).delete()
+    subscribers = models.Subscriber.objects.filter(feed=post.feed_id, \
+      is_active=True, site__use_timeline=True, site__timeline_ready=True)
+    site_ids = [sub.site_id for sub in subscribers]
+    if site_ids and post.canonical_id:
+        canonical_feed = models.Post.objects.get(id=post.canonical_id).feed_id
+        dupe_sites = models.Subscriber.objects.filter(feed=canonical_feed, \
+          is_active=True, site__in=site_ids).values_list('site', flat=True)
+        site_ids = [site_id for site_id in site_ids \
+          if site_id not in dupe_sites]
+    if not site_ids:
+        return
+    if tags is None:
+        tags = post.tags.all()
+    tags = list(tags)
+    for site_id in site_ids:
+        add_entries(site_id, post, tags)
+
+def feed_tags(feed):
+    """ Returns a dictionary with the tags of every post in a feed.
+    """
+    cursor = fjrouter.connection_for_write().cursor()
+    cursor.execute("""
+      SELECT feedjack_post_tags.post_id, feedjack_post_tags.tag_id
+      FROM feedjack_post_tags, feedjack_post
+      WHERE feedjack_post_tags.post_id=feedjack_post.id AND
+      feedjack_post.feed_id=%s""", [feed.id])
+    tagobjs = {}
+    postd = {}
+    for post_id, tag_id in cursor.fetchall():
+        if tag_id not in tagobjs:
+            tagobjs[tag_id] = models.Tag(id=tag_id)
+        if post_id not in postd:
+            postd[post_id] = []
+        postd[post_id].append(tagobjs[tag_id])
+    return postd
+
+def index_feed(site, feed):
+    """ Adds all the posts of a feed to the timeline of a site.
+    """
+    postd = feed_tags(feed)
+    sfeeds_ids = site.subscriber_set.filter(is_active=True) \
+      .values_list('feed', flat=True)
+    for post in fjlib.exclude_duplicates( \
+      models.Post.objects.filter(feed=feed), sfeeds_ids):
+        add_entries(site.id, post, postd.get(post.id, []))
+
+def unindex_feed(site, feed):
+    """ Removes the posts of a feed from the timeline of a site.
+    """
+    models.TimelineEntry.objects.filter(site=site, feed=feed).delete()
+
+def rebuild(site):
+    """ Rebuilds the whole timeline of a site.
+    """
+    models.TimelineEntry.objects.filter(site=site).delete()
+    if not site.use_timeline:
+        return
+    for sub in site.subscriber_set.filter(is_active=True).select_related():
+        index_feed(site, sub.feed)
+
+def rebuild_site(site):
+    """ Rebuilds the timeline of a flagged site and marks it as ready, in a
+    single transaction. The site stays flagged if its use_timeline has been
+    changed in the meantime.
+    """
+    rebuild(site)
+    models.Site.objects.filter(id=site.id, use_timeline=site.use_timeline) \
+      .update(timeline_ready=True)
+rebuild_site = fjrouter.commit_on_success(rebuild_site)
+
+def rebuild_pending():
+    """ Builds or drops the timelines of the sites whose use_timeline has
+    changed. Returns the list of these sites.
+    """
+    sites = list(models.Site.objects.filter(timeline_ready=False))
+    for site in sites:
+        rebuild_site(site)
+    return sites
+
+def sync_subscriber(subscriber):
+    """ Adds or removes the posts of a subscriber after it has been saved.
+    """
+    site = subscriber.site
+    if not site.timeline_ready:
+        # the rebuild of the site adds them
+        return
+    entries = models.TimelineEntry.objects.filter(site=site, \
+      feed=subscriber.feed)
+    if site.use_timeline and subscriber.is_active:
+        if not entries.count():
+            index_feed(site, subscriber.feed)
+    elif entries.count():
+        entries.delete()
+
+
+#~
@@ -12,6 +12,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import smart_unicode
 
 from feedjack import fjcache
+from feedjack import fjfields
 
 SITE_ORDERBY_CHOICES = (
     (1, _('Date published.')),
@@ -53,6 +54,26 @@ class Site(models.Model):
         choices=SITE_ORDERBY_CHOICES)
     tagcloud_levels = models.IntegerField(_('tagcloud level'), default=5)
     show_tagcloud = models.BooleanField(_('show tagcloud'), default=True)
+    use_timeline = models.BooleanField(_('use timeline'), default=False,
+        help_text=_('Keep a precomputed timeline of this site\'s posts. Speeds '
+        'up the listing pages of sites with many subscribers. The timeline is '
+        'built by the next run of feedjack_update, the pages use it from '
+        'then on.') )
+    # the timeline entries match use_timeline, see fjtimeline.py
+    timeline_ready = models.BooleanField(_('timeline ready'), default=False,
+        editable=False)
+    show_excerpts = models.BooleanField(_('show excerpts'), default=False,
+        help_text=_('Show an excerpt of the posts instead of their whole '
+        'content in the pages and feeds. The content is not read from the '
+        'database.') )
+    keep_days = models.IntegerField(_('keep days'), null=True, blank=True,
+        help_text=_('feedjack_prune archives the posts older than this number '
+        'of days in the feeds of this site that don\'t have their own limit. '
+        'Keep blank to keep them forever.') )
+    keep_posts = models.IntegerField(_('keep posts'), null=True, blank=True,
+        help_text=_('feedjack_prune archives the older posts of the feeds of '
+        'this site that don\'t have their own limit, keeping this number of '
+        'posts per feed. Keep blank to keep them all.') )
     
     use_internal_cache = models.BooleanField(_('use internal cache'), default=True)
     cache_duration = models.IntegerField(_('cache duration'), default=60*60*24,
@@ -70,10 +91,19 @@ class Site(models.Model):
         verbose_name_plural = _('sites')
         ordering = ('name',)
 
+    def __init__(self, *args, **kwargs):
+        super(Site, self).__init__(*args, **kwargs)
+        self._use_timeline = self.use_timeline
+
     def __unicode__(self):
         return self.name
 
     def save(self):
+        if self.use_timeline != self._use_timeline:
+            # the timeline is built or dropped by feedjack_update, a big one
+            # takes too long for a request
+            self.timeline_ready = False
+            self._use_timeline = self.use_timeline
         if not self.template:
             self.template = 'default'
         # there must be only ONE default site
@@ -88,7 +118,37 @@ class Site(models.Model):
         self.url = self.url.rstrip('/')
         fjcache.hostcache_set({})
         super(Site, self).save()
+        fjcache.sidebar_delsite(self.id)
+        fjcache.fragment_delsite(self.id)
+
+
+
+
+def keep_duplicates(model, ids):
+    """ Unlinks the duplicates of the posts (model is Post) or of the posts
+    of the feeds (model is Feed) that are about to be deleted. Django would
+    delete the duplicates with them, they are shown again instead, as in
+    fjretention.delete_posts.
+    """
+    if not ids:
+        return
+    if model is Feed:
+        lookup = 'canonical__feed__in'
+    else:
+        lookup = 'canonical__in'
+    Post.objects.filter(**{lookup: ids}).update(canonical=None)
 
+class DuplicatesQuerySet(models.query.QuerySet):
+    """ QuerySet of feeds or posts that keeps the duplicates of the deleted
+    posts, the admin deletes the selected objects with it.
+    """
+    def delete(self):
+        keep_duplicates(self.model, list(self.values_list('id', flat=True)))
+        super(DuplicatesQuerySet, self).delete()
+
+class DuplicatesManager(models.Manager):
+    def get_query_set(self):
+        return DuplicatesQuerySet(self.model)
 
 
 
@@ -109,16 +169,59 @@ class Feed(models.Model):
     last_modified = models.DateTimeField(_('last modified'), null=True, blank=True)
     last_checked = models.DateTimeField(_('last checked'), null=True, blank=True)
 
+    keep_days = models.IntegerField(_('keep days'), null=True, blank=True,
+        help_text=_('feedjack_prune archives the posts older than this number '
+        'of days. Keep blank to use the limit of the sites.') )
+    keep_posts = models.IntegerField(_('keep posts'), null=True, blank=True,
+        help_text=_('feedjack_prune archives the older posts, keeping this '
+        'number of posts. Keep blank to use the limit of the sites.') )
+
+    # the updater that is processing the feed, see fjlease.py
+    lease_owner = models.CharField(_('lease owner'), max_length=100,
+      blank=True)
+    lease_expires = models.DateTimeField(_('lease expires'), null=True,
+      blank=True, db_index=True)
+
+    objects = DuplicatesManager()
+
     class Meta:
         verbose_name = _('feed')
         verbose_name_plural = _('feeds')
         ordering = ('name', 'feed_url',)
 
+    # the fields the pages show, a change drops the summaries and the
+    # sidebars of the sites of the feed
+    SHOWN_FIELDS = ('feed_url', 'name', 'shortname', 'is_active', 'title',
+      'tagline', 'link')
+
+    def __init__(self, *args, **kwargs):
+        super(Feed, self).__init__(*args, **kwargs)
+        self._shown = self.shown_values()
+
     def __unicode__(self):
         return u'%s (%s)' % (self.name, self.feed_url)
 
+    def shown_values(self):
+        return [getattr(self, field) for field in self.SHOWN_FIELDS]
+
     def save(self):
+        # feedjack_update saves every feed it checks, the sites are only
+        # looked up when something they show has changed
+        changed = self.shown_values() != self._shown
         super(Feed, self).save()
+        self._shown = self.shown_values()
+        if not changed:
+            return
+        site_ids = list(Subscriber.objects.filter(feed=self) \
+          .values_list('site', flat=True))
+        if site_ids:
+            SiteSummary.objects.filter(site__in=site_ids).delete()
+        for site_id in site_ids:
+            fjcache.sidebar_delsite(site_id, [self.id])
+
+    def delete(self):
+        keep_duplicates(Feed, [self.id])
+        super(Feed, self).delete()
 
 
 
@@ -133,14 +236,15 @@ class Tag(models.Model):
     def __unicode__(self):
         return self.name
 
-    def save(self):
-        super(Tag, self).save()
+    def save(self, *args, **kwargs):
+        super(Tag, self).save(*args, **kwargs)
 
 class Post(models.Model):
     feed = models.ForeignKey(Feed, verbose_name=_('feed'), null=False, blank=False)
     title = models.CharField(_('title'), max_length=255)
     link = models.URLField(_('link'), )
-    content = models.TextField(_('content'), blank=True)
+    content = fjfields.CompressedTextField(_('content'), blank=True)
+    excerpt = models.TextField(_('excerpt'), blank=True)
     date_modified = models.DateTimeField(_('date modified'), null=True, blank=True)
     guid = models.CharField(_('guid'), max_length=200, db_index=True)
     author = models.CharField(_('author'), max_length=50, blank=True)
@@ -149,6 +253,18 @@ class Post(models.Model):
     tags = models.ManyToManyField(Tag, verbose_name=_('tags'))
     date_created = models.DateField(_('date created'), auto_now_add=True)
 
+    # duplicate detection, see fjdupes.py
+    link_key = models.CharField(_('link key'), max_length=32, blank=True,
+      db_index=True)
+    fingerprint = models.CharField(_('fingerprint'), max_length=32,
+      blank=True, db_index=True)
+    canonical = models.ForeignKey('self', verbose_name=_('canonical post'),
+      null=True, blank=True, related_name='duplicates',
+      help_text=_('The same post in another feed. The listings that have '
+      'both posts only show the canonical one.') )
+
+    objects = DuplicatesManager()
+
     class Meta:
         verbose_name = _('post')
         verbose_name_plural = _('posts')
@@ -161,6 +277,10 @@ class Post(models.Model):
     def save(self):
         super(Post, self).save()
 
+    def delete(self):
+        keep_duplicates(Post, [self.id])
+        super(Post, self).delete()
+
     def get_absolute_url(self):
         return self.link
 
@@ -185,6 +305,10 @@ class Subscriber(models.Model):
         ordering = ('site', 'name', 'feed')
         unique_together = (('site', 'feed'),)
 
+    def __init__(self, *args, **kwargs):
+        super(Subscriber, self).__init__(*args, **kwargs)
+        self._feed_id = self.feed_id
+
     def __unicode__(self):
         return u'%s in %s' % (self.feed, self.site)
 
@@ -198,6 +322,219 @@ class Subscriber(models.Model):
         if not self.shortname:
             self.shortname = self.feed.shortname
         super(Subscriber, self).save()
+        SiteSummary.objects.filter(site=self.site).delete()
+        fjcache.sidebar_delsite(self.site.id)
+        # the post fragments show the name of the subscriber
+        fjcache.fragment_delsite(self.site.id)
+        from feedjack import fjtimeline
+        if self._feed_id and self._feed_id != self.feed_id:
+            # the posts of the feed it was subscribed to before
+            fjtimeline.unindex_feed(self.site_id, self._feed_id)
+        self._feed_id = self.feed_id
+        fjtimeline.sync_subscriber(self)
+
+def subscriber_deleted(sender, instance, **kwargs):
+    """ Removes a deleted subscriber from its site. It is a signal handler so
+    the querysets deleted by the admin ("delete selected") also run it.
+    """
+    SiteSummary.objects.filter(site=instance.site_id).delete()
+    fjcache.sidebar_delsite(instance.site_id)
+    fjcache.fragment_delsite(instance.site_id)
+    from feedjack import fjtimeline
+    fjtimeline.unindex_feed(instance.site_id, instance.feed_id)
+
+
+class TimelineEntry(models.Model):
+    """ A post as seen in a site's timeline.
+
+    Entries with no tag make up the site's river, and there is one more entry
+    per tag of the post for the tag pages. The dates are copied from the post
+    so the listings can be sorted without touching the post table.
+    """
+    site = models.ForeignKey(Site, verbose_name=_('site'))
+    tag = models.ForeignKey(Tag, verbose_name=_('tag'), null=True, blank=True)
+    feed = models.ForeignKey(Feed, verbose_name=_('feed'))
+    post = models.ForeignKey(Post, verbose_name=_('post'))
+    date_modified = models.DateTimeField(_('date modified'), null=True,
+      blank=True)
+    date_created = models.DateField(_('date created'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('timeline entry')
+        verbose_name_plural = _('timeline entries')
+
+    def __unicode__(self):
+        return u'%s in %s' % (self.post, self.site)
+
+
+class SiteSummary(models.Model):
+    """ Denormalized data of a site's subscribers and their feeds.
+
+    It is refreshed by feedjack_update at the end of every run, and read by
+    the views instead of querying the subscribers and feeds. See
+    fjlib.site_summary.
+    """
+    site = models.OneToOneField(Site, verbose_name=_('site'))
+    data = models.TextField(_('data'))
+    last_checked = models.DateTimeField(_('last checked'), null=True,
+      blank=True)
+    post_count = models.IntegerField(_('post count'), default=0)
+    date_updated = models.DateTimeField(_('date updated'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('site summary')
+        verbose_name_plural = _('site summaries')
+
+    def __unicode__(self):
+        return unicode(self.site)
+
+
+
+class SearchTerm(models.Model):
+    """ A word of the search index, with the number of posts that have it.
+    """
+    term = models.CharField(_('term'), max_length=50, unique=True)
+    post_count = models.IntegerField(_('post count'), default=0)
+
+    class Meta:
+        verbose_name = _('search term')
+        verbose_name_plural = _('search terms')
+
+    def __unicode__(self):
+        return self.term
+
+
+class SearchPosting(models.Model):
+    """ A word in a post, with its weight. See fjsearch.py.
+
+    The feed is copied from the post so the searches can be limited to the
+    feeds of a site without joining the post table.
+    """
+    term = models.ForeignKey(SearchTerm, verbose_name=_('term'))
+    post = models.ForeignKey(Post, verbose_name=_('post'))
+    feed = models.ForeignKey(Feed, verbose_name=_('feed'))
+    weight = models.IntegerField(_('weight'), default=1)
+
+    class Meta:
+        verbose_name = _('search posting')
+        verbose_name_plural = _('search postings')
+
+    def __unicode__(self):
+        return u'%s in %s' % (self.term, self.post)
+
+
+
+class ArchivedPost(models.Model):
+    """ A post removed by feedjack_prune.
+
+    The guid is always kept, so feedjack_update doesn't import the post again
+    while it is still in the feed. The rest of the data (and the names of
+    the tags) is only kept if the posts were archived and not deleted.
+    """
+    feed = models.ForeignKey(Feed, verbose_name=_('feed'))
+    guid = models.CharField(_('guid'), max_length=200)
+    title = models.CharField(_('title'), max_length=255, blank=True)
+    link = models.URLField(_('link'), blank=True)
+    content = fjfields.CompressedTextField(_('content'), blank=True)
+    date_modified = models.DateTimeField(_('date modified'), null=True,
+      blank=True)
+    author = models.CharField(_('author'), max_length=50, blank=True)
+    author_email = models.EmailField(_('author email'), blank=True)
+    comments = models.URLField(_('comments'), blank=True)
+    tags = models.TextField(_('tags'), blank=True,
+      help_text=_('One tag name per line.'))
+    date_created = models.DateField(_('date created'), null=True, blank=True)
+    date_archived = models.DateTimeField(_('date archived'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('archived post')
+        verbose_name_plural = _('archived posts')
+        unique_together = (('feed', 'guid'),)
+
+    def __unicode__(self):
+        return self.title or self.guid
+
+
+
+CHANGE_NEW, CHANGE_UPDATED, CHANGE_DELETED = 1, 2, 3
+CHANGE_CHOICES = (
+    (CHANGE_NEW, _('New')),
+    (CHANGE_UPDATED, _('Updated')),
+    (CHANGE_DELETED, _('Deleted')),
+)
+
+class PostChange(models.Model):
+    """ An entry of the change journal, see fjjournal.py.
+
+    The id is the sequence number of the change. The post and the feed are
+    plain ids so the entries of the deleted posts are kept.
+    """
+    post_id = models.IntegerField(_('post id'))
+    feed_id = models.IntegerField(_('feed id'), db_index=True)
+    change_type = models.IntegerField(_('change type'),
+      choices=CHANGE_CHOICES)
+    date_created = models.DateTimeField(_('date created'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('post change')
+        verbose_name_plural = _('post changes')
+
+    def __unicode__(self):
+        return u'%d: %s %d' % (self.id, self.get_change_type_display(),
+          self.post_id)
+
+
+class JournalCheckpoint(models.Model):
+    """ The last change of the journal read by a consumer.
+    """
+    name = models.CharField(_('name'), max_length=100, unique=True)
+    sequence = models.IntegerField(_('sequence'), default=0)
+    date_updated = models.DateTimeField(_('date updated'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('journal checkpoint')
+        verbose_name_plural = _('journal checkpoints')
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.name, self.sequence)
+
+
+
+class FeedStats(models.Model):
+    """ Rolling statistics of the fetches of a feed, updated by
+    feedjack_update after every fetch. See fjmetrics.py.
+    """
+    feed = models.OneToOneField(Feed, verbose_name=_('feed'))
+    fetches = models.IntegerField(_('fetches'), default=0)
+    errors = models.IntegerField(_('errors'), default=0)
+    consecutive_errors = models.IntegerField(_('consecutive errors'),
+      default=0)
+    last_result = models.CharField(_('last result'), max_length=20,
+      blank=True)
+    last_status = models.IntegerField(_('last HTTP status'), null=True,
+      blank=True)
+    last_duration = models.FloatField(_('last duration'), default=0)
+    avg_duration = models.FloatField(_('average duration'), default=0)
+    max_duration = models.FloatField(_('maximum duration'), default=0)
+    last_bytes = models.IntegerField(_('last size'), default=0)
+    avg_bytes = models.FloatField(_('average size'), default=0)
+    last_new = models.IntegerField(_('last new posts'), default=0)
+    last_updated = models.IntegerField(_('last updated posts'), default=0)
+    total_new = models.IntegerField(_('total new posts'), default=0)
+    total_updated = models.IntegerField(_('total updated posts'), default=0)
+    last_fetched = models.DateTimeField(_('last fetched'), null=True,
+      blank=True)
+    last_error = models.DateTimeField(_('last error'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('feed statistics')
+        verbose_name_plural = _('feed statistics')
+
+    def __unicode__(self):
+        return unicode(self.feed)
+
+
+models.signals.post_delete.connect(subscriber_deleted, sender=Subscriber)
 
 
 #~
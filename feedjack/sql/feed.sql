@@ -0,0 +1,2 @@
+-- fjlib.get_extra_content looks for the last checked feed of a site.
+CREATE INDEX feedjack_feed_last_checked ON feedjack_feed (last_checked);
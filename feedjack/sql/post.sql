@@ -0,0 +1,10 @@
+-- Composite indexes for the listings in fjlib.get_paginator. The river is
+-- read in date order, the user pages in date order for a single feed, and
+-- sites ordered by creation date sort on (date_created, date_modified).
+CREATE INDEX feedjack_post_modified ON feedjack_post (date_modified);
+CREATE INDEX feedjack_post_created ON feedjack_post (date_created, date_modified);
+CREATE INDEX feedjack_post_feed_modified ON feedjack_post (feed_id, date_modified);
+CREATE INDEX feedjack_post_feed_created ON feedjack_post (feed_id, date_created, date_modified);
+-- The tag pages go from a tag to its posts, the other way around of the
+-- unique (post_id, tag_id) index created by django.
+CREATE INDEX feedjack_post_tags_tag ON feedjack_post_tags (tag_id, post_id);
@@ -0,0 +1,3 @@
+-- Index for the searches (see fjsearch.py). It covers the whole query, the
+-- postings of a term in the feeds of a site are read from the index alone.
+CREATE INDEX feedjack_searchposting_search ON feedjack_searchposting (term_id, feed_id, post_id, weight);
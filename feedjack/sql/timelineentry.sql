@@ -0,0 +1,4 @@
+-- Indexes for the site timeline listings (see fjtimeline.py). The river is
+-- stored with a NULL tag_id, the tag pages with the tag's id.
+CREATE INDEX feedjack_timelineentry_modified ON feedjack_timelineentry (site_id, tag_id, date_modified);
+CREATE INDEX feedjack_timelineentry_created ON feedjack_timelineentry (site_id, tag_id, date_created, date_modified);
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+__init__.py
+"""
+
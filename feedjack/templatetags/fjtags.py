@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+fjtags.py
+"""
+
+from django import template
+from django.utils import translation
+
+from feedjack import fjcache
+
+register = template.Library()
+
+
+class PostFragmentNode(template.Node):
+    def __init__(self, name, post, nodelist):
+        self.name = name
+        self.post = template.Variable(post)
+        self.nodelist = nodelist
+
+    def render(self, context):
+        post = self.post.resolve(context)
+        site = context.get('site')
+        if not site or not site.use_internal_cache:
+            return self.nodelist.render(context)
+        name = '%s.%s' % (self.name, translation.get_language())
+        if site.show_excerpts:
+            name += '.excerpt'
+        # the fragments of the whole page are retrieved with the first one
+        data = fjcache.fragment_get(site.id, post, name,
+                                    context.get('object_list') or ())
+        if data is None:
+            data = self.nodelist.render(context)
+            fjcache.fragment_set(site, post, name, data)
+        return data
+
+def postfragment(parser, token):
+    """ Caches the rendered content of the block for a post.
+
+    Usage: {% postfragment "name" post %} ... {% endpostfragment %}
+
+    The name must be unique for every template using the tag. The cached
+    fragment is shared by all the pages of the site showing the post, and is
+    rendered again when the post, its tags, the site or the subscribers of
+    the site change. The block must only depend on them.
+    """
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError('%r tag requires a name and a ' \
+          'post' % bits[0])
+    nodelist = parser.parse(('endpostfragment',))
+    parser.delete_first_token()
+    return PostFragmentNode(bits[1].strip('"\''), bits[2], nodelist)
+
+register.tag('postfragment', postfragment)
+
+
+class SidebarFragmentNode(template.Node):
+    def __init__(self, name, feed_id, nodelist):
+        self.name = name
+        if feed_id:
+            self.feed_id = template.Variable(feed_id)
+        else:
+            self.feed_id = None
+        self.nodelist = nodelist
+
+    def render(self, context):
+        site = context.get('site')
+        if not site or not site.use_internal_cache:
+            return self.nodelist.render(context)
+        feed_id = 0
+        if self.feed_id:
+            try:
+                feed_id = int(self.feed_id.resolve(context) or 0)
+            except (template.VariableDoesNotExist, ValueError):
+                pass
+        name = '%s.%s' % (self.name, translation.get_language())
+        data = fjcache.sidebar_get(site.id, feed_id, name)
+        if data is None:
+            data = self.nodelist.render(context)
+            fjcache.sidebar_set(site, feed_id, name, data)
+        return data
+
+def sidebarfragment(parser, token):
+    """ Caches the rendered content of the block for a site or a subscriber.
+
+    Usage: {% sidebarfragment "name" [feed_id] %} ... {% endsidebarfragment %}
+
+    Without a feed id (or if it is empty) the fragment is shared by all the
+    pages of the site. The fragments are removed by feedjack_update when the
+    site or the subscriber get new posts.
+    """
+    bits = token.split_contents()
+    if len(bits) not in (2, 3):
+        raise template.TemplateSyntaxError('%r tag requires a name and an ' \
+          'optional feed id' % bits[0])
+    nodelist = parser.parse(('endsidebarfragment',))
+    parser.delete_first_token()
+    if len(bits) == 3:
+        feed_id = bits[2]
+    else:
+        feed_id = None
+    return SidebarFragmentNode(bits[1].strip('"\''), feed_id, nodelist)
+
+register.tag('sidebarfragment', sidebarfragment)
+
+
+#~
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+
+"""
+feedjack
+Gustavo Picón
+tests.py
+
+Run with "django-admin.py test feedjack" in a project that has feedjack in
+its INSTALLED_APPS.
+"""
+
+import time
+import datetime
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
+from django.test.client import Client
+from django.utils import simplejson
+
+from feedjack import models
+from feedjack import fjlib
+from feedjack import fjcache
+from feedjack import fjdupes
+from feedjack import fjjournal
+from feedjack import fjtimeline
+from feedjack import fjdataset
+from feedjack import fjplan
+from feedjack import fjrouter
+from feedjack import fjfetch
+from feedjack import fjparse
+from feedjack import fjmetrics
+from feedjack import fjfarm
+
+
+class DuplicatesTest(TestCase):
+    """ The posts of different feeds are only linked when they are the same
+    article (see fjdupes.py).
+    """
+    # the same teaser at the end of every post of both feeds
+    TEASER = u'<p>%s</p><p>Continue reading...</p>' % (u'lorem ipsum ' * 30)
+
+    def setUp(self):
+        self.feeds = []
+        for num in range(2):
+            feed = models.Feed(feed_url='http://feed%d.example.com/' % num,
+                               name='Feed %d' % num, shortname='f%d' % num)
+            feed.save()
+            self.feeds.append(feed)
+
+    def new_post(self, feed, title, link, content=TEASER):
+        post = models.Post(feed=feed, title=title, link=link, guid=link,
+                           content=content,
+                           date_modified=datetime.datetime.now())
+        fjdupes.link_post(post)
+        post.save()
+        return post
+
+    def test_distinct_articles(self):
+        for num in range(3):
+            self.new_post(self.feeds[0], u'Entry %d of feed 0' % num,
+                          'http://a.example.com/%d' % num)
+        for num in range(3):
+            post = self.new_post(self.feeds[1], u'Entry %d of feed 1' % num,
+                                 'http://b.example.com/%d' % num)
+            self.assertEqual(post.canonical_id, None)
+        self.assertEqual(fjdupes.rebuild(), 0)
+
+    def test_same_link(self):
+        orig = self.new_post(self.feeds[0], u'Title', 'http://a.example.com/1')
+        dupe = self.new_post(self.feeds[1], u'Other title',
+          'https://www.a.example.com/1/?utm_source=feedburner', u'')
+        self.assertEqual(dupe.canonical_id, orig.id)
+
+    def test_same_title_and_text(self):
+        orig = self.new_post(self.feeds[0], u'Title', 'http://a.example.com/1')
+        dupe = self.new_post(self.feeds[1], u' title ',
+                             'http://feeds.example.com/~r/1')
+        self.assertEqual(dupe.canonical_id, orig.id)
+        self.assertEqual(fjdupes.rebuild(), 1)
+
+    def assert_kept(self, *dupes):
+        for dupe in dupes:
+            dupe = models.Post.objects.get(pk=dupe.pk)
+            self.assertEqual(dupe.canonical_id, None)
+        self.assertEqual(self.feeds[1].post_set.count(), len(dupes))
+
+    def test_delete_feed(self):
+        self.new_post(self.feeds[0], u'Title', 'http://a.example.com/1')
+        dupe = self.new_post(self.feeds[1], u'Title', 'http://a.example.com/1')
+        self.assertNotEqual(dupe.canonical_id, None)
+        self.feeds[0].delete()
+        self.assert_kept(dupe)
+
+    def test_delete_selected(self):
+        # the admin deletes the selected feeds and posts with a queryset
+        orig = self.new_post(self.feeds[0], u'Title', 'http://a.example.com/1')
+        dupe = self.new_post(self.feeds[1], u'Title', 'http://a.example.com/1')
+        models.Post.objects.filter(pk=orig.pk).delete()
+        self.assert_kept(dupe)
+        self.new_post(self.feeds[0], u'Other', 'http://a.example.com/2', u'')
+        other = self.new_post(self.feeds[1], u'Other',
+                              'http://a.example.com/2', u'')
+        self.assertNotEqual(other.canonical_id, None)
+        models.Feed.objects.filter(pk=self.feeds[0].pk).delete()
+        self.assert_kept(dupe, other)
+
+
+class JournalTest(TestCase):
+    """ The journal is only read up to the entries older than the lag.
+    """
+    def setUp(self):
+        self.lag = getattr(settings, 'FEEDJACK_JOURNAL_LAG', 60)
+        settings.FEEDJACK_JOURNAL_LAG = 60
+        old = datetime.datetime.now() - datetime.timedelta(seconds=120)
+        for post_id in range(1, 5):
+            change = models.PostChange(post_id=post_id, feed_id=1,
+                                       change_type=models.CHANGE_NEW)
+            change.save()
+            if post_id != 3:
+                models.PostChange.objects.filter(id=change.id) \
+                  .update(date_created=old)
+
+    def tearDown(self):
+        settings.FEEDJACK_JOURNAL_LAG = self.lag
+
+    def test_api_not_cached(self):
+        site = models.Site(name='Site', url='http://testserver',
+                           title='Site', description='Site',
+                           use_internal_cache=True)
+        site.save()
+        feed = models.Feed(id=1, feed_url='http://feed.example.com/',
+                           name='Feed', shortname='feed')
+        feed.save()
+        models.Subscriber(site=site, feed=feed).save()
+        fjcache.cache_delsite(site.id)
+        client = Client(HTTP_HOST='testserver')
+        def posts():
+            data = simplejson.loads(client.get('/api/changes/').content)
+            return [change['post'] for change in data['changes']]
+        self.assertEqual(posts(), [1, 2])
+        # the entry of the post 3 is old enough now
+        settings.FEEDJACK_JOURNAL_LAG = 0
+        self.assertEqual(posts(), [1, 2, 3, 4])
+
+    def test_read_up_to_lag(self):
+        # the entry of the post 3 is recent, the one of the post 4 has to
+        # wait for it
+        self.assertEqual([change.post_id for change in fjjournal.read()],
+                         [1, 2])
+        settings.FEEDJACK_JOURNAL_LAG = 0
+        self.assertEqual([change.post_id for change in fjjournal.read()],
+                         [1, 2, 3, 4])
+
+
+class SummaryTest(TestCase):
+    """ The summary of a site is dropped when a feed shown in it changes.
+    """
+    def setUp(self):
+        self.site = models.Site(name='Site', url='http://testserver',
+                                title='Site', description='Site')
+        self.site.save()
+        feed = models.Feed(feed_url='http://feed.example.com/', name='Feed',
+                           shortname='feed')
+        feed.save()
+        models.Subscriber(site=self.site, feed=feed).save()
+        fjlib.refresh_summary(self.site)
+
+    def test_feed_save(self):
+        feed = models.Feed.objects.get(shortname='feed')
+        feed.last_checked = datetime.datetime.now()
+        feed.save()
+        self.assertEqual(models.SiteSummary.objects.count(), 1)
+        feed.name = 'Renamed'
+        feed.save()
+        self.assertEqual(models.SiteSummary.objects.count(), 0)
+        site = models.Site.objects.get(pk=self.site.pk)
+        self.assertEqual([feed.name for feed in fjlib.site_summary(site).feeds],
+                         ['Renamed'])
+
+
+    def test_json(self):
+        feed = models.Feed.objects.get(shortname='feed')
+        feed.last_checked = datetime.datetime(2010, 1, 2, 3, 4, 5)
+        feed.save()
+        models.Post(feed=feed, title=u'Post', guid='1',
+                    link='http://feed.example.com/1').save()
+        fjlib.refresh_summary(self.site)
+        summary = models.SiteSummary.objects.get(site=self.site)
+        self.assertEqual(simplejson.loads(summary.data)['post_counts'],
+                         [[feed.id, 1]])
+        site = models.Site.objects.get(pk=self.site.pk)
+        summary = fjlib.site_summary(site)
+        self.assertEqual(summary.feeds[0].last_checked, feed.last_checked)
+        self.assertEqual(summary.subscribers[0].post_count, 1)
+
+    def test_old_format(self):
+        # the base64 pickles of the older versions are replaced
+        models.SiteSummary.objects.filter(site=self.site) \
+          .update(data='gAJ9cQEu')
+        site = models.Site.objects.get(pk=self.site.pk)
+        self.assertEqual([feed.name for feed in fjlib.site_summary(site).feeds],
+                         ['Feed'])
+
+
+class TimelineTest(TestCase):
+    """ Saving a site only flags its timeline, the updater builds it.
+    """
+    def setUp(self):
+        self.site = models.Site(name='Site', url='http://testserver',
+                                title='Site', description='Site')
+        self.site.save()
+        self.feed = models.Feed(feed_url='http://feed.example.com/',
+                                name='Feed', shortname='feed')
+        self.feed.save()
+        models.Subscriber(site=self.site, feed=self.feed).save()
+        for num in range(3):
+            models.Post(feed=self.feed, title=u'Post %d' % num, guid=str(num),
+                        link='http://feed.example.com/%d' % num,
+                        date_modified=datetime.datetime(2010, 1, 1 + num)) \
+              .save()
+        fjtimeline.rebuild_pending()
+
+    def listing_model(self):
+        site = models.Site.objects.get(pk=self.site.pk)
+        return fjlib.get_listing(site, [self.feed.id]).model
+
+    def test_rebuild_pending(self):
+        entries = models.TimelineEntry.objects.filter(site=self.site)
+        self.site.use_timeline = True
+        self.site.save()
+        self.assertEqual(entries.count(), 0)
+        self.assertEqual(self.listing_model(), models.Post)
+        self.assertEqual(fjtimeline.rebuild_pending(), [self.site])
+        self.assertEqual(entries.count(), 3)
+        self.assertEqual(self.listing_model(), models.TimelineEntry)
+        self.assertEqual(fjtimeline.rebuild_pending(), [])
+        self.site.use_timeline = False
+        self.site.save()
+        self.assertEqual(entries.count(), 3)
+        self.assertEqual(self.listing_model(), models.Post)
+        fjtimeline.rebuild_pending()
+        self.assertEqual(entries.count(), 0)
+
+    def test_unsubscribe(self):
+        self.site.use_timeline = True
+        self.site.save()
+        fjtimeline.rebuild_pending()
+        entries = models.TimelineEntry.objects.filter(site=self.site)
+        self.assertEqual(entries.count(), 3)
+        other = models.Feed(feed_url='http://other.example.com/',
+                            name='Other', shortname='other')
+        other.save()
+        models.Post(feed=other, title=u'Other', guid='other',
+                    link='http://other.example.com/1').save()
+        subscriber = models.Subscriber.objects.get(site=self.site)
+        subscriber.feed = other
+        subscriber.save()
+        self.assertEqual([entry.feed_id for entry in entries.all()],
+                         [other.id])
+        # the admin deletes the selected subscribers with a queryset
+        models.Subscriber.objects.filter(site=self.site).delete()
+        self.assertEqual(entries.count(), 0)
+
+
+class APITest(TestCase):
+    """ The JSON views of a site.
+    """
+    def setUp(self):
+        self.client = Client(HTTP_HOST='testserver')
+        self.site = models.Site(name='Site', url='http://testserver',
+                                title='Site', description='Site')
+        self.site.save()
+        feed = models.Feed(feed_url='http://feed.example.com/', name='Feed',
+                           shortname='feed')
+        feed.save()
+        models.Subscriber(site=self.site, feed=feed).save()
+        for num in range(6):
+            # posts without a date in the middle of the listing
+            if num in (2, 3):
+                date = None
+            else:
+                date = datetime.datetime(2010, 1, 1 + num)
+            models.Post(feed=feed, title=u'Post %d' % num, guid=str(num),
+                        link='http://feed.example.com/%d' % num,
+                        date_modified=date).save()
+
+    def read_listing(self):
+        """ Returns the titles of the listing, read one post at a time.
+        """
+        fjcache.cache_delsite(self.site.id)
+        titles, cursor = [], None
+        for num in range(10):
+            params = {'fields': 'title', 'limit': 1}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get('/api/posts/', params)
+            self.assertEqual(response.status_code, 200)
+            data = simplejson.loads(response.content)
+            titles.extend([post['title'] for post in data['posts']])
+            cursor = data['next']
+            if not cursor:
+                break
+        return sorted(titles)
+
+    def test_cursor_with_nulls(self):
+        titles = [u'Post %d' % num for num in range(6)]
+        self.assertEqual(self.read_listing(), titles)
+        self.site.order_posts_by = 2
+        self.site.save()
+        self.assertEqual(self.read_listing(), titles)
+        self.site.use_timeline = True
+        self.site.save()
+        self.assertEqual(fjtimeline.rebuild_pending(), [self.site])
+        self.site = models.Site.objects.get(pk=self.site.pk)
+        self.assertEqual(self.site.timeline_ready, True)
+        self.assertEqual(self.read_listing(), titles)
+
+    def test_not_modified(self):
+        response = self.client.get('/api/posts/')
+        not_modified = self.client.get('/api/posts/',
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(not_modified['Vary'], response['Vary'])
+
+
+class ParserTest(TestCase):
+    """ The fast parser sanitizes the same fields as feedparser and leaves the
+    feeds to feedparser when its private helpers are missing.
+    """
+    FEED = '''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel>
+<title>Feed &lt;b onclick="x()"&gt;bold&lt;/b&gt;</title>
+<link>http://feed.example.com/</link>
+<description>&lt;a href="/about" onclick="x()"&gt;About&lt;/a&gt;</description>
+<item><title>AT&amp;T &lt;i onclick="x()"&gt;news&lt;/i&gt;</title>
+<link>http://feed.example.com/1</link>
+<description>&lt;p&gt;Text&lt;script&gt;x()&lt;/script&gt;&lt;/p&gt;</description>
+</item>
+<item><title>AT&amp;T</title><link>http://feed.example.com/2</link></item>
+</channel></rss>'''
+
+    def parse(self):
+        response = fjfetch.Response('http://feed.example.com/feed', 200,
+          {'content-type': 'application/rss+xml',
+           'last-modified': 'Sat, 02 Jan 2010 10:00:00 GMT'}, self.FEED)
+        return fjparse.parse(response)
+
+    def test_sanitized(self):
+        fast = self.parse()
+        self.assertEqual(fast['parser'], 'fast')
+        self.assertEqual(fast.modified[:6], (2010, 1, 2, 10, 0, 0))
+        # feedparser only knows the URL of the feed from the headers
+        feed = fjfetch.parse(fjfetch.Response('http://feed.example.com/feed',
+          200, {'content-type': 'application/rss+xml',
+                'content-location': 'http://feed.example.com/feed'},
+          self.FEED))
+        for key in ('title', 'subtitle'):
+            self.assertEqual(fast.feed[key], feed.feed[key])
+            self.assert_('onclick' not in fast.feed[key])
+        for fast_entry, entry in zip(fast.entries, feed.entries):
+            for key in ('title', 'summary'):
+                self.assertEqual(fast_entry.get(key), entry.get(key))
+        self.assert_('onclick' not in fast.entries[0].title)
+        self.assert_('script' not in fast.entries[0].summary)
+        self.assertEqual(fast.entries[1].title, u'AT&T')
+        self.assert_('http://feed.example.com/about' in fast.feed.subtitle)
+
+    def test_missing_helpers(self):
+        sanitize = fjparse._sanitizeHTML
+        fjparse._sanitizeHTML = None
+        try:
+            self.assertEqual(self.parse()['parser'], 'feedparser')
+        finally:
+            fjparse._sanitizeHTML = sanitize
+
+
+class SearchTest(TestCase):
+    """ The search results are not kept in the cache of the site.
+    """
+    def setUp(self):
+        self.client = Client(HTTP_HOST='testserver')
+        self.site = models.Site(name='Site', url='http://testserver',
+                                title='Site', description='Site',
+                                use_internal_cache=True)
+        self.site.save()
+        fjcache.cache_delsite(self.site.id)
+
+    def cached_keys(self):
+        return fjcache.lookup(fjcache.T_META,
+                              fjcache.getkey(fjcache.T_META, self.site.id))
+
+    def test_not_cached(self):
+        keys = []
+        for query in ('one', 'two', 'three'):
+            response = self.client.get('/search/', {'q': query})
+            self.assertEqual(response.status_code, 200)
+            keys.append(self.cached_keys())
+        # only the tag cloud of the site is cached
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(keys[1], keys[2])
+
+
+class FragmentTest(TestCase):
+    """ The cached fragments of the posts are rendered again when something
+    they show changes.
+    """
+    def setUp(self):
+        self.client = Client(HTTP_HOST='testserver')
+        self.site = models.Site(name='Site', url='http://testserver',
+                                title='Site', description='Site',
+                                use_internal_cache=True)
+        self.site.save()
+        feed = models.Feed(feed_url='http://feed.example.com/', name='Feed',
+                           shortname='feed')
+        feed.save()
+        models.Subscriber(site=self.site, feed=feed, name='Before').save()
+        # the posts without a title show the name of their subscriber
+        self.post = models.Post(feed=feed, title=u'', guid='1',
+                                link='http://feed.example.com/1',
+                                date_modified=datetime.datetime(2010, 1, 1))
+        self.post.save()
+
+    def page(self):
+        fjcache.cache_delsite(self.site.id)
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_changes(self):
+        title = u'<div class="post-title">\xbb %s</div>'
+        self.assert_((title % u'Before').encode('utf-8') in self.page())
+        subscriber = models.Subscriber.objects.get(site=self.site)
+        subscriber.name = 'After'
+        subscriber.save()
+        self.assert_((title % u'After').encode('utf-8') in self.page())
+        self.client.get('/feed/rss/')
+        tag = models.Tag(name='newtag')
+        tag.save()
+        self.post.tags.add(tag)
+        self.assert_('newtag' in self.page())
+        self.assert_('newtag' in self.client.get('/feed/rss/').content)
+
+
+class StagesTest(TestCase):
+    """ The DNS lookups are timed apart from the downloads.
+    """
+    def test_dns_apart(self):
+        stages = fjmetrics.StageTimes()
+        stages.timed_apart('fetch', 'dns', stages.timed, 'dns', time.sleep,
+                           0.1)
+        times = stages.summary()
+        self.assert_(times['dns']['total'] >= 0.1)
+        self.assert_(times['fetch']['total'] < 0.05)
+
+    def test_dns_cache(self):
+        stages = fjmetrics.StageTimes()
+        dns = fjfetch.DNSCache(stages=stages)
+        for num in range(2):
+            dns.lookup('localhost', 80)
+        self.assertEqual(stages.summary()['dns']['count'], 1)
+
+
+class DeadlineTest(TestCase):
+    """ The downloads that take more than their deadline are cut by a single
+    watchdog thread.
+    """
+    def setUp(self):
+        self.farm = fjfarm.FeedFarm(feeds=4, entries=1, latency=2.0)
+        self.farm.start()
+
+    def tearDown(self):
+        self.farm.stop()
+
+    def test_deadline(self):
+        fetcher = fjfetch.Fetcher(deadline=0.3)
+        start = time.time()
+        for num in range(4):
+            self.assertRaises(fjfetch.FetchError, fetcher.fetch,
+                              self.farm.url(num))
+        self.assert_(time.time() - start < 4)
+        fetcher.close()
+        self.assertEqual(len([thread for thread in threading.enumerate() \
+          if thread.getName() == 'fjfetch watchdog']), 1)
+
+
+class PlanTest(TransactionTestCase):
+    """ The hot queries are read from the indexes (see fjplan.py). Only on
+    SQLite, feedjack_plancheck.py runs the same checks on a bigger database.
+    """
+    def tearDown(self):
+        # ANALYZE commits the generated data
+        call_command('flush', verbosity=0, interactive=False)
+
+    def test_plans(self):
+        if 'sqlite' not in connection.__module__:
+            return
+        sites = fjdataset.generate(sites=3, feeds=100, posts=5000, tags=200)
+        connection.cursor().execute('ANALYZE')
+        self.assertEqual(fjplan.check_all(*sites), [])
+
+
+class RouterTest(TestCase):
+    """ The routes of fjrouter.FeedjackRouter. With multiple databases
+    (django 1.2+) and the two SQLite databases of fjrouter.py as settings,
+    the writes are also checked to go to the primary and the reads to the
+    replica.
+    """
+    def setUp(self):
+        self.settings = {}
+        for name, value in (('FEEDJACK_DB_PRIMARY', 'default'),
+                            ('FEEDJACK_DB_REPLICAS', ('replica',))):
+            self.settings[name] = getattr(settings, name, None)
+            if self.settings[name] is None:
+                setattr(settings, name, value)
+        self.router = fjrouter.FeedjackRouter()
+        # the views pin the reads of a thread after an update
+        fjrouter.use_primary(False)
+
+    def tearDown(self):
+        for name, value in self.settings.items():
+            if value is None:
+                delattr(settings, name)
+        fjrouter.use_primary(False)
+
+    def test_routes(self):
+        from django.contrib.contenttypes.models import ContentType
+        primary, replicas = fjrouter.primary(), fjrouter.replicas()
+        self.assertEqual(self.router.db_for_write(models.Post), primary)
+        self.assert_(self.router.db_for_read(models.Post) in replicas)
+        fjrouter.use_primary()
+        self.assertEqual(self.router.db_for_read(models.Post), primary)
+        fjrouter.use_primary(False)
+        self.assert_(self.router.db_for_read(models.Post) in replicas)
+        self.assertEqual(self.router.allow_syncdb(primary, models.Post), True)
+        self.assertEqual(self.router.allow_syncdb(replicas[0], models.Post),
+                         False)
+        # the other applications are left to the default database
+        self.assertEqual(self.router.db_for_read(ContentType), None)
+        self.assertEqual(self.router.db_for_write(ContentType), None)
+
+    def test_two_databases(self):
+        try:
+            from django.db import connections
+        except ImportError:
+            # django without multiple database support
+            return
+        replicas = fjrouter.replicas()
+        if not [alias for alias in replicas if alias in connections]:
+            return
+        feed = models.Feed(feed_url='http://feed.example.com/', name='Feed',
+                           shortname='feed')
+        feed.save()
+        self.assertEqual(feed._state.db, fjrouter.primary())
+        self.assert_(models.Feed.objects.all().db in replicas)
+        fjrouter.use_primary()
+        self.assertEqual(models.Feed.objects.all().db, fjrouter.primary())
+        self.assertEqual(models.Feed.objects.get(pk=feed.pk).name, 'Feed')
+
+
+#~
@@ -39,6 +39,16 @@ urlpatterns = patterns('',
     (r'^user/(?P<user>\d+)/$', views.mainview),
     (r'^tag/(?P<tag>.*)/$', views.mainview),
 
+    (r'^search/$', views.search),
+
+    (r'^api/posts/user/(?P<user>\d+)/tag/(?P<tag>.*)/$', views.api_posts),
+    (r'^api/posts/user/(?P<user>\d+)/$', views.api_posts),
+    (r'^api/posts/tag/(?P<tag>.*)/$', views.api_posts),
+    (r'^api/posts/$', views.api_posts),
+    (r'^api/subscribers/$', views.api_subscribers),
+    (r'^api/changes/$', views.api_changes),
+    (r'^stats/$', views.stats),
+
     (r'^opml/$', views.opml),
     (r'^foaf/$', views.foaf),
     (r'^$', views.mainview),
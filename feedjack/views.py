@@ -6,16 +6,23 @@ Gustavo Picón
 views.py
 """
 
+from cStringIO import StringIO
 
 from django.utils import feedgenerator
+from django.utils.xmlutils import SimplerXMLGenerator
 from django.shortcuts import render_to_response
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, \
+  HttpResponseNotModified, HttpResponseForbidden, Http404
+from django.conf import settings
 from django.utils.cache import patch_vary_headers
 from django.template import Context, loader
 
 from feedjack import models
 from feedjack import fjlib
 from feedjack import fjcache
+from feedjack import fjrouter
+from feedjack import fjapi
+from feedjack import fjstats
 
 def initview(request):
     """ Retrieves the basic data needed by all feeds (host, feeds, etc)
@@ -35,9 +42,14 @@ def initview(request):
     if response:
         return response, None, cachekey, [], []
 
+    # if the updater just refreshed the site, don't rebuild its pages with
+    # data from a replica that may be lagging
+    fjrouter.use_primary(fjcache.fresh_get(site_id))
+
     site = models.Site.objects.get(pk=site_id)
-    sfeeds_obj = fjlib.sitefeeds(site)
-    sfeeds_ids = [subscriber.feed.id for subscriber in sfeeds_obj]
+    summary = fjstats.timed('site', fjlib.site_summary, site)
+    sfeeds_obj = summary.subscribers
+    sfeeds_ids = summary.feed_ids
 
     return None, site, cachekey, sfeeds_obj, sfeeds_ids
 
@@ -61,7 +73,7 @@ def blogroll(request, btype):
     ctx = {}
     fjlib.get_extra_content(site, sfeeds_ids, ctx)
     ctx = Context(ctx)
-    response = HttpResponse(template.render(ctx) , \
+    response = HttpResponse(fjstats.timed('render', template.render, ctx), \
       mimetype='text/xml; charset=utf-8')
 
 
@@ -82,6 +94,42 @@ def opml(request):
     return blogroll(request, 'opml')
 
 
+class FragmentFeed(object):
+    """ Mixin for the feed generators that writes the items from their
+    serialized XML, so it can be cached per post.
+    """
+
+    def item_fragment(self, **kwargs):
+        """ Returns the serialized XML of an item, the arguments are the
+        ones of add_item.
+        """
+        self.add_item(**kwargs)
+        item = self.items.pop()
+        out = StringIO()
+        handler = SimplerXMLGenerator(out, 'utf-8')
+        items, self.items = self.items, [item]
+        try:
+            super(FragmentFeed, self).write_items(handler)
+        finally:
+            self.items = items
+        return out.getvalue().decode('utf-8')
+
+    def add_fragment(self, fragment, pubdate):
+        """ Adds an item from its serialized XML.
+        """
+        self.items.append({'fragment': fragment, 'pubdate': pubdate})
+
+    def write_items(self, handler):
+        for item in self.items:
+            # ignorableWhitespace writes the string as it is
+            handler.ignorableWhitespace(item['fragment'])
+
+class Rss201rev2Feed(FragmentFeed, feedgenerator.Rss201rev2Feed):
+    fragment_name = 'rss'
+
+class Atom1Feed(FragmentFeed, feedgenerator.Atom1Feed):
+    fragment_name = 'atom'
+
 def buildfeed(request, feedclass, tag=None, user=None):
     """ View that handles the feeds.
     """
@@ -90,30 +138,52 @@ def buildfeed(request, feedclass, tag=None, user=None):
     if response:
         return response
 
-    object_list = fjlib.get_paginator(site, sfeeds_ids, page=0, tag=tag, \
-      user=user)[1]
+    object_list = list(fjstats.timed('pagination', fjlib.get_paginator, \
+      site, sfeeds_ids, page=0, tag=tag, user=user)[1])
 
     feed = feedclass(\
         title=site.title,
         link=site.url,
         description=site.description,
         feed_url='%s/%s' % (site.url, '/feed/rss/'))
-    for post in object_list:
-        feed.add_item( \
-          title = '%s: %s' % (post.feed.name, post.title), \
-          link = post.link, \
-          description = post.content, \
-          author_email = post.author_email, \
-          author_name = post.author, \
-          pubdate = post.date_modified, \
-          unique_id = post.link, \
-          categories = [tag.name for tag in post.tags.all()])
+
+    fragment_name = feed.fragment_name
+    if site.show_excerpts:
+        fragment_name += '.excerpt'
+
+    # the serialized items are cached per post, the tags are part of the
+    # digest of the posts
+    if object_list:
+        fjstats.timed('tags', fjlib.get_posts_tags, object_list, sfeeds_obj,
+                      None, None)
+    if site.use_internal_cache:
+        fragments = fjcache.fragments_get(site.id, object_list, fragment_name)
+    else:
+        fragments = [None] * len(object_list)
+    for post, fragment in zip(object_list, fragments):
+        if fragment is None:
+            if site.show_excerpts:
+                description = post.excerpt
+            else:
+                description = post.content
+            fragment = feed.item_fragment( \
+              title = '%s: %s' % (post.feed.name, post.title), \
+              link = post.link, \
+              description = description, \
+              author_email = post.author_email, \
+              author_name = post.author, \
+              pubdate = post.date_modified, \
+              unique_id = post.link, \
+              categories = [tag.name for tag in post.qtags])
+            if site.use_internal_cache:
+                fjcache.fragment_set(site, post, fragment_name, fragment)
+        feed.add_fragment(fragment, post.date_modified)
     response = HttpResponse(mimetype=feed.mime_type)
 
     # per host caching
     patch_vary_headers(response, ['Host'])
 
-    feed.write(response, 'utf-8')
+    fjstats.timed('render', feed.write, response, 'utf-8')
     if site.use_internal_cache:
         fjcache.cache_set(site, cachekey, response)
     return response
@@ -121,12 +191,12 @@ def buildfeed(request, feedclass, tag=None, user=None):
 def rssfeed(request, tag=None, user=None):
     """ Generates the RSS2 feed.
     """
-    return buildfeed(request, feedgenerator.Rss201rev2Feed, tag, user)
+    return buildfeed(request, Rss201rev2Feed, tag, user)
 
 def atomfeed(request, tag=None, user=None):
     """ Generates the Atom 1.0 feed. 
     """
-    return buildfeed(request, feedgenerator.Atom1Feed, tag, user)
+    return buildfeed(request, Atom1Feed, tag, user)
 
 def mainview(request, tag=None, user=None):
     """ View that handles all page requests.
@@ -139,8 +209,8 @@ def mainview(request, tag=None, user=None):
     ctx = fjlib.page_context(request, site, tag, user, (sfeeds_obj, \
       sfeeds_ids))
 
-    response = render_to_response('feedjack/%s/post_list.html' % \
-      (site.template), ctx)
+    response = fjstats.timed('render', render_to_response, \
+      'feedjack/%s/post_list.html' % (site.template), ctx)
     
     # per host caching, in case the cache middleware is enabled
     patch_vary_headers(response, ['Host'])
@@ -149,5 +219,94 @@ def mainview(request, tag=None, user=None):
         fjcache.cache_set(site, cachekey, response)
     return response
 
+def search(request):
+    """ View that handles the search results. They are not cached, every
+    query would add a key to the meta key of the site.
+    """
+
+    response, site, cachekey, sfeeds_obj, sfeeds_ids = initview(request)
+    if response:
+        return response
+
+    ctx = fjlib.page_context(request, site, sfeeds=(sfeeds_obj, \
+      sfeeds_ids), query=request.GET.get('q', ''))
+
+    response = fjstats.timed('render', render_to_response, \
+      'feedjack/%s/post_list.html' % (site.template), ctx)
+    patch_vary_headers(response, ['Host'])
+    return response
+
+def jsonview(request, builder, cached=True):
+    """ Handles the JSON views. The data is built by calling
+    builder(request, site, sfeeds_obj, sfeeds_ids), and the response is
+    kept in the site's cache if cached is True.
+    """
+
+    response, site, cachekey, sfeeds_obj, sfeeds_ids = initview(request)
+    if not response:
+        try:
+            data = builder(request, site, sfeeds_obj, sfeeds_ids)
+        except fjapi.APIError, err:
+            return HttpResponseBadRequest(fjapi.dumps({'error': \
+              unicode(err)}), mimetype='application/json; charset=utf-8')
+        response = HttpResponse(fjstats.timed('render', fjapi.dumps, data), \
+          mimetype='application/json; charset=utf-8')
+        response['ETag'] = fjapi.etag(response.content)
+        patch_vary_headers(response, ['Host'])
+        if cached and site.use_internal_cache:
+            fjcache.cache_set(site, cachekey, response)
+
+    if request.META.get('HTTP_IF_NONE_MATCH') == response['ETag']:
+        # the caches need the validator and the caching headers of the
+        # response on the 304 too
+        not_modified = HttpResponseNotModified()
+        for header in ('ETag', 'Cache-Control', 'Vary', 'Expires'):
+            if response.has_header(header):
+                not_modified[header] = response[header]
+        return not_modified
+    return response
+
+def api_posts(request, tag=None, user=None):
+    """ JSON view of the river, tag and user listings.
+
+    Parameters: fields (comma separated, see fjapi.POST_FIELDS), limit and
+    cursor (the "next" value of the previous page).
+    """
+    def builder(request, site, sfeeds_obj, sfeeds_ids):
+        return fjapi.posts(request, site, sfeeds_ids, tag, user)
+    return jsonview(request, builder)
+
+def api_changes(request):
+    """ JSON view of the change journal of a site.
+
+    Parameters: after (the "last" value of the previous call) and limit.
+
+    Not cached: the journal only shows the entries older than
+    FEEDJACK_JOURNAL_LAG, the ones of the last update would stay hidden from
+    a cached page until the next update.
+    """
+    def builder(request, site, sfeeds_obj, sfeeds_ids):
+        return fjapi.changes(request, site, sfeeds_ids)
+    return jsonview(request, builder, False)
+
+def api_subscribers(request):
+    """ JSON view of the subscribers of a site.
+    """
+    def builder(request, site, sfeeds_obj, sfeeds_ids):
+        return fjapi.subscribers(request, site, sfeeds_obj)
+    return jsonview(request, builder)
+
+def stats(request):
+    """ JSON view of the counters of the views in this process, only
+    available with the fjstats middleware and to the INTERNAL_IPS.
+    """
+    if not fjstats.ENABLED:
+        raise Http404
+    if not settings.DEBUG and \
+      request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(fjapi.dumps(fjstats.totals()), \
+      mimetype='application/json; charset=utf-8')
+
 #~
 
@@ -16,7 +16,11 @@ setup(
     license = 'BSD',
     packages = find_packages(),
     package_data = find_package_data(where='feedjack', package='feedjack'),
-    scripts = ['feedjack/bin/feedjack_update.py'],
+    scripts = ['feedjack/bin/feedjack_update.py',
+               'feedjack/bin/feedjack_compress.py',
+               'feedjack/bin/feedjack_prune.py',
+               'feedjack/bin/feedjack_plancheck.py',
+               'feedjack/bin/feedjack_bench.py'],
     zip_safe = False,
     description = 'Multisite Feed Agregator (Planet)',
     long_description = '''